@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 from .models import Base, UserRole
 import urllib.parse
@@ -81,6 +81,37 @@ def init_engine():
         engine = create_engine(DATABASE_URL)
         SessionLocal = sessionmaker(bind=engine)
 
+# create_all не добавляет колонки в существующие таблицы, поэтому новые
+# колонки и индексы для уже развернутых баз добавляем здесь
+SCHEMA_UPDATES = [
+    "ALTER TABLE challenges ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP",
+    "CREATE INDEX IF NOT EXISTS idx_challenges_status_scheduled ON challenges (status, scheduled_for)",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS unreachable_at TIMESTAMP",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS unreachable_reason VARCHAR(50)",
+    "ALTER TABLE message_schedules ADD COLUMN IF NOT EXISTS spread_minutes INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE message_schedules ADD COLUMN IF NOT EXISTS attachment_type VARCHAR(20)",
+    "ALTER TABLE message_schedules ADD COLUMN IF NOT EXISTS attachment_file_id VARCHAR(255)",
+    "ALTER TABLE message_schedules ADD COLUMN IF NOT EXISTS attachment_path VARCHAR(500)",
+    "ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS attachment_type VARCHAR(20)",
+    "ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS attachment_file_id VARCHAR(255)",
+    "ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS attachment_path VARCHAR(500)",
+    "ALTER TABLE pending_challenges ADD COLUMN IF NOT EXISTS team_analysis JSONB",
+    "ALTER TABLE pending_challenges ADD COLUMN IF NOT EXISTS valid_for DATE",
+    "ALTER TABLE pending_challenges ALTER COLUMN user_id DROP NOT NULL",
+    "ALTER TABLE pending_challenges ALTER COLUMN chat_id DROP NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_pending_org_status ON pending_challenges (org_id, status)",
+    "CREATE INDEX IF NOT EXISTS idx_message_sent_logs_schedule_sent ON message_sent_logs (schedule_id, sent_at)",
+]
+
+def apply_schema_updates():
+    """Применить обновления схемы к существующей базе"""
+    if engine.dialect.name != "postgresql":
+        return
+    
+    with engine.begin() as connection:
+        for statement in SCHEMA_UPDATES:
+            connection.execute(text(statement))
+
 def init_db():
     """Создание таблиц"""
     try:
@@ -89,6 +120,7 @@ def init_db():
         
         # Создаем все таблицы
         Base.metadata.create_all(engine)
+        apply_schema_updates()
         print("✅ База данных инициализирована")
         return True
     except Exception as e:
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, BigInteger, Text, Time
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, BigInteger, Text, Time, Date, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime, timezone as tz
@@ -38,6 +38,7 @@ class ChallengeStatus(enum.Enum):
     FAILED = "FAILED"         
     SCHEDULED = "SCHEDULED"    
     OFFERED = "OFFERED"
+    SENDING = "SENDING"         # Забран воркером очереди отправки
 
 class SurveyType(PythonEnum):
     MORNING = "morning"    # Утренний опрос (6:00 - 12:00)
@@ -96,6 +97,11 @@ class User(Base):
     last_survey_at = Column(DateTime, nullable=True)
     last_survey_type = Column(String(20), nullable=True)
     last_active = Column(DateTime, default=datetime.now)
+    
+    # Бот не может писать пользователю (заблокирован, аккаунт удален, чат не найден).
+    # Такие пользователи пропускаются в рассылках до следующего входящего сообщения
+    unreachable_at = Column(DateTime, nullable=True)
+    unreachable_reason = Column(String(50), nullable=True)
 
     message_logs = relationship("MessageSentLog", back_populates="user", cascade="all, delete-orphan")
     organization = relationship("Organization", back_populates="users")
@@ -192,6 +198,7 @@ class Challenge(Base):
 
     scheduled_for = Column(DateTime, nullable=True)  
     sent_at = Column(DateTime, nullable=True)        
+    claimed_at = Column(DateTime, nullable=True)  # Когда забран воркером отправки (UTC)
     challenge_time = Column(String(20), nullable=True) 
 
     difficulty = Column(String(20), nullable=True)     
@@ -201,19 +208,29 @@ class Challenge(Base):
     user_rel = relationship("User", foreign_keys=[user_id], back_populates="challenges")
     creator_rel = relationship("User", foreign_keys=[created_by], back_populates="created_challenges")
 
+    __table_args__ = (
+        Index('idx_challenges_status_scheduled', 'status', 'scheduled_for'),
+    )
+
 
 
 class PendingChallenge(Base):
-    """Временное хранилище сгенерированных челленджей"""
+    """Временное хранилище сгенерированных челленджей
+
+    Записи со статусом PRECOMPUTED - заранее подготовленный ночной задачей
+    набор на день для всей организации (без user_id и chat_id).
+    """
     __tablename__ = "pending_challenges"
     
     id = Column(Integer, primary_key=True)
-    user_id = Column(BigInteger, nullable=False)  
+    user_id = Column(BigInteger)  
     org_id = Column(Integer, nullable=False)    
-    chat_id = Column(BigInteger, nullable=False)  
+    chat_id = Column(BigInteger)  
     
     challenges = Column(JSONB, nullable=False)   
     status = Column(String(20), default="PENDING")  
+    team_analysis = Column(JSONB)  # Анализ уровня команды, на котором основан набор
+    valid_for = Column(Date)  # Локальная дата организации, на которую подготовлен набор
     
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     expires_at = Column(DateTime(timezone=True), nullable=False) 
@@ -222,6 +239,7 @@ class PendingChallenge(Base):
         Index('idx_pending_user_id', 'user_id'),
         Index('idx_pending_expires', 'expires_at'),
         Index('idx_pending_status', 'status'),
+        Index('idx_pending_org_status', 'org_id', 'status'),
     )
     
     def is_expired(self):
@@ -243,6 +261,10 @@ class MessageSchedule(Base):
     is_daily = Column(Boolean, default=True)  # Ежедневное сообщение
     day_of_week = Column(Integer, nullable=True)  # 0-6 (пн-вс), если не ежедневное
     order_index = Column(Integer, default=0)  # Порядок отображения
+    spread_minutes = Column(Integer, default=0, nullable=False, server_default="0")  # Растянуть отправку на N минут
+    attachment_type = Column(String(20), nullable=True)  # photo, document
+    attachment_file_id = Column(String(255), nullable=True)  # file_id в Telegram (после первой загрузки)
+    attachment_path = Column(String(500), nullable=True)  # Локальный файл, если file_id еще нет
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -264,6 +286,117 @@ class MessageSentLog(Base):
     # Отношения
     schedule = relationship("MessageSchedule", back_populates="sent_logs")
     user = relationship("User", back_populates="message_logs")
+    
+    __table_args__ = (
+        Index('idx_message_sent_logs_schedule_sent', 'schedule_id', 'sent_at'),
+    )
+
+
+class ScheduleFireLog(Base):
+    """Последнее срабатывание расписания сообщений
+
+    Одна запись на расписание: по ней планировщик решает, отправлять ли
+    очередное сообщение, и догоняет пропущенные после перезапуска отправки.
+    """
+    __tablename__ = "schedule_fire_logs"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    schedule_id = Column(
+        Integer,
+        ForeignKey("message_schedules.id", ondelete="CASCADE"),
+        nullable=False,
+        unique=True
+    )
+    last_occurrence_at = Column(DateTime, nullable=False)  # Плановое время срабатывания (UTC)
+    last_fired_at = Column(DateTime, nullable=False)  # Когда реально обработано (UTC)
+    status = Column(String(20), default="fired")  # fired, skipped, sending, interrupted, partial
+
+class ReminderLog(Base):
+    """Отправленные напоминания о невыполненных челленджах
+
+    Уникальность (user_id, local_date) гарантирует не больше одного
+    напоминания пользователю за день по времени его организации.
+    """
+    __tablename__ = "reminder_logs"
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False)
+    local_date = Column(Date, nullable=False)  # День по времени организации
+    sent_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    
+    __table_args__ = (
+        UniqueConstraint('user_id', 'local_date', name='uq_reminder_user_day'),
+    )
+
+class DeadLetter(Base):
+    """Сообщения, которые не удалось доставить окончательно"""
+    __tablename__ = "dead_letters"
+    
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(BigInteger, nullable=False, index=True)
+    method = Column(String(50), nullable=False)  # send_message, send_photo...
+    payload = Column(JSONB, nullable=True)  # Аргументы запроса (текст, parse_mode...)
+    reason = Column(String(50), nullable=False)  # bot_blocked, chat_not_found, network...
+    error_message = Column(Text, nullable=True)
+    attempts = Column(Integer, default=1)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class BroadcastJob(Base):
+    """Рассылка администратора, поставленная в очередь отправки"""
+    __tablename__ = "broadcast_jobs"
+    
+    id = Column(Integer, primary_key=True)
+    org_id = Column(Integer, ForeignKey("organizations.id"), nullable=False, index=True)
+    created_by = Column(BigInteger, nullable=False)  # user_id администратора
+    text = Column(Text, nullable=False)
+    status = Column(String(20), default="pending", index=True)  # pending, sending, completed
+    total = Column(Integer, default=0)
+    report_chat_id = Column(BigInteger, nullable=True)  # Куда отправить итоговый отчет
+    attachment_type = Column(String(20), nullable=True)  # photo, document
+    attachment_file_id = Column(String(255), nullable=True)  # file_id в Telegram (после первой загрузки)
+    attachment_path = Column(String(500), nullable=True)  # Локальный файл, если file_id еще нет
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    
+    recipients = relationship("BroadcastRecipient", back_populates="job", cascade="all, delete-orphan")
+
+
+class BroadcastRecipient(Base):
+    """Получатель рассылки и статус доставки ему"""
+    __tablename__ = "broadcast_recipients"
+    
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, ForeignKey("broadcast_jobs.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(BigInteger, nullable=False)
+    chat_id = Column(BigInteger, nullable=False)
+    status = Column(String(20), default="pending")  # pending, sending, sent, failed
+    error = Column(String(255), nullable=True)  # Причина неудачи (bot_blocked, chat_not_found...)
+    claimed_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    job = relationship("BroadcastJob", back_populates="recipients")
+    
+    __table_args__ = (
+        UniqueConstraint('job_id', 'user_id', name='uq_broadcast_recipient'),
+        Index('idx_broadcast_recipients_job_status', 'job_id', 'status'),
+    )
+
+
+class MotivationPhrase(Base):
+    """Заранее сгенерированная мотивационная фраза (пул для быстрой выдачи)"""
+    __tablename__ = "motivation_phrases"
+    
+    id = Column(Integer, primary_key=True)
+    situation = Column(String(50), nullable=False)  # on_demand, after_survey, challenge_completed, general
+    text = Column(Text, nullable=False)
+    used_count = Column(Integer, default=0, nullable=False)  # Сколько раз фраза уже выдана
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    
+    __table_args__ = (
+        Index('idx_motivation_phrases_situation_used', 'situation', 'used_count'),
+    )
 
 
 class PlayerMetrics(Base):
@@ -38,6 +38,13 @@ class AdminMenuManager:
             )
         )
 
+        builder.row(
+            InlineKeyboardButton(
+                text="⚙️ Фоновые задачи",
+                callback_data="admin_job_stats"
+            )
+        )
+
         builder.row(
             InlineKeyboardButton(
                 text="Команды",
@@ -1,11 +1,14 @@
 # handlers/admins/modules/broadcast.py
 from aiogram import Router, F, types
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message
-from datetime import datetime
 from aiogram.fsm.context import FSMContext
 from database import get_session, UserRole
 from database.models import User, Organization
 from utils.states import BroadcastStates
+from services.broadcast_outbox import broadcast_outbox
+from services.media_delivery import MEDIA_NAMES, attachment_from_message
+from services.recipient_health import reachable_filter
 import logging
 
 router = Router()
@@ -43,6 +46,7 @@ async def start_broadcast(callback: types.CallbackQuery, state: FSMContext) -> N
         active_users_count = session.query(User).filter(
             User.org_id == user.org_id,
             User.chat_id.isnot(None),
+            reachable_filter(),
             User.role.in_([UserRole.MEMBER.value, UserRole.TRAINER.value])
         ).count()
         
@@ -63,6 +67,7 @@ async def start_broadcast(callback: types.CallbackQuery, state: FSMContext) -> N
             f"📝 *Напишите текст рассылки:*\n"
             f"• Вы можете использовать форматирование\n"
             f"• Можно добавить эмодзи\n"
+            f"• Можно прислать фото или документ с подписью\n"
             f"• Максимум 4000 символов\n\n"
             f"💡 *Пример:*\n"
             f"Привет, команда! 👋\n"
@@ -89,10 +94,13 @@ async def start_broadcast(callback: types.CallbackQuery, state: FSMContext) -> N
 async def process_broadcast_text(message: types.Message, state: FSMContext) -> None:
     """Обработка текста рассылки и подтверждение"""
     
-    broadcast_text = message.text.strip()
+    # Фото или документ рассылаются с подписью; файл уже в Telegram,
+    # поэтому всем получателям уйдет его file_id без повторной загрузки
+    attachment_type, attachment_file_id = attachment_from_message(message)
+    broadcast_text = (message.text or message.caption or "").strip()
     
     # Валидация текста
-    if len(broadcast_text) < 2:
+    if not attachment_type and len(broadcast_text) < 2:
         await message.answer("❌ Текст слишком короткий. Минимум 2 символа.\nВведите текст заново:")
         return
     
@@ -105,7 +113,11 @@ async def process_broadcast_text(message: types.Message, state: FSMContext) -> N
     active_users_count = data.get("active_users_count", 0)
     
     # Сохраняем текст рассылки
-    await state.update_data(broadcast_text=broadcast_text)
+    await state.update_data(
+        broadcast_text=broadcast_text,
+        attachment_type=attachment_type,
+        attachment_file_id=attachment_file_id
+    )
     
     # Показываем предварительный просмотр
     preview_text = (
@@ -116,7 +128,8 @@ async def process_broadcast_text(message: types.Message, state: FSMContext) -> N
         f"```\n{broadcast_text[:300]}{'...' if len(broadcast_text) > 300 else ''}\n```\n\n"
         f"📊 *Статистика:*\n"
         f"• Символов: {len(broadcast_text)}\n"
-        f"• Строк: {broadcast_text.count('\\n') + 1}\n\n"
+        f"• Строк: {len(broadcast_text.splitlines())}\n"
+        f"• Вложение: {MEDIA_NAMES.get(attachment_type, 'нет')}\n\n"
         f"⚠️ *Внимание:* Рассылка будет отправлена всем активным участникам организации.\n\n"
         f"Подтвердить отправку?"
     )
@@ -143,7 +156,7 @@ async def process_broadcast_text(message: types.Message, state: FSMContext) -> N
 
 @router.callback_query(BroadcastStates.waiting_confirmation, F.data == "confirm_broadcast")
 async def confirm_broadcast(callback: types.CallbackQuery, state: FSMContext) -> None:
-    """Подтверждение и отправка рассылки"""
+    """Подтверждение рассылки: ставим ее в очередь отправки"""
     
     data = await state.get_data()
     org_id = data.get("org_id")
@@ -156,97 +169,45 @@ async def confirm_broadcast(callback: types.CallbackQuery, state: FSMContext) ->
         await callback.answer("❌ Доступ запрещен", show_alert=True)
         return
     
-    session = get_session()
     try:
-        # Показываем статус отправки
-        status_msg = await callback.message.edit_text(
-            f"📤 *Отправка рассылки...*\n\n"
-            f"🏢 Организация: {org_name}\n"
-            f"⏳ Пожалуйста, подождите...",
-            parse_mode="Markdown"
+        job_id, total_members = broadcast_outbox.create_job(
+            org_id=org_id,
+            created_by=callback.from_user.id,
+            text=broadcast_text,
+            report_chat_id=callback.message.chat.id,
+            attachment_type=data.get("attachment_type"),
+            attachment_file_id=data.get("attachment_file_id")
         )
         
-        # Получаем всех активных пользователей организации
-        members = session.query(User).filter(
-            User.org_id == org_id,
-            User.chat_id.isnot(None),
-            User.role.in_([UserRole.MEMBER.value, UserRole.TRAINER.value])
-        ).all()
-        
-        total_members = len(members)
-        
         if total_members == 0:
             await callback.message.edit_text(
                 f"❌ *Нет получателей*\n\n"
                 f"В организации {org_name} нет активных участников.",
                 parse_mode="Markdown"
             )
-            await state.clear()
             return
         
-        # Отправляем рассылку
-        sent_count = 0
-        failed_count = 0
-        failed_users = []
-        
-        for member in members:
-            try:
-                await callback.bot.send_message(
-                    chat_id=member.chat_id,
-                    text=broadcast_text
-                )
-                sent_count += 1
-                
-                # Небольшая задержка, чтобы не превысить лимиты Telegram
-                import asyncio
-                await asyncio.sleep(0.1)
-                
-            except Exception as e:
-                failed_count += 1
-                failed_users.append(f"{member.name} (ID: {member.user_id})")
-                logger.warning(f"Не удалось отправить сообщение пользователю {member.user_id}: {e}")
+        # Если эта реплика - лидер, начинаем отправку сразу
+        from services import job_scheduler as job_scheduler_module
+        if job_scheduler_module.job_scheduler:
+            job_scheduler_module.job_scheduler.run_soon("broadcast_outbox")
         
-        # Формируем отчет
-        report_text = (
-            f"✅ *Рассылка завершена!*\n\n"
-            f"🏢 *Организация:* {org_name}\n"
-            f"👤 *Отправил:* {data.get('admin_name', 'Администратор')}\n"
-            f"📅 *Время отправки:* {datetime.now().strftime('%d.%m.%Y %H:%M')}\n\n"
-            f"📊 *Статистика:*\n"
-            f"• Всего получателей: {total_members}\n"
-            f"• Успешно отправлено: {sent_count}\n"
-            f"• Не удалось отправить: {failed_count}\n"
-            f"• Успешность: {(sent_count/total_members*100 if total_members > 0 else 0):.1f}%\n\n"
-        )
-        
-        if failed_count > 0:
-            report_text += f"❌ *Не отправлено ({failed_count}):*\n"
-            for i, user in enumerate(failed_users[:5], 1):  # Показываем только первые 5
-                report_text += f"{i}. {user}\n"
-            if failed_count > 5:
-                report_text += f"... и еще {failed_count - 5} пользователей\n"
-        
-        # Кнопки после отправки
-        after_send_kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📨 Создать новую рассылку", callback_data="admin_send_broadcast")],
+        progress_kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔄 Прогресс рассылки", callback_data=f"broadcast_progress_{job_id}")],
             [InlineKeyboardButton(text="◀️ Назад в меню", callback_data="back_to_admin_panel")]
         ])
         
-        await callback.message.edit_text(report_text, parse_mode="Markdown")
-        await callback.message.answer("Что дальше?", reply_markup=after_send_kb)
-        
-        # Логируем отправку
-        logger.info(
-            f"Рассылка отправлена: организация={org_name} ({org_id}), "
-            f"отправитель={callback.from_user.id}, "
-            f"получателей={total_members}, "
-            f"успешно={sent_count}, "
-            f"неудачно={failed_count}"
+        await callback.message.edit_text(
+            f"📤 *Рассылка поставлена в очередь*\n\n"
+            f"🏢 Организация: {org_name}\n"
+            f"👥 Получателей: {total_members}\n\n"
+            f"Отправка идет в фоне, по завершении придет отчет.",
+            parse_mode="Markdown",
+            reply_markup=progress_kb
         )
         
     except Exception as e:
-        logger.error(f"Ошибка отправки рассылки: {e}")
-        await callback.answer(f"❌ Ошибка отправки: {str(e)[:100]}", show_alert=True)
+        logger.error(f"Ошибка постановки рассылки в очередь: {e}")
         
         error_kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🔄 Попробовать снова", callback_data="admin_send_broadcast")],
@@ -261,11 +222,50 @@ async def confirm_broadcast(callback: types.CallbackQuery, state: FSMContext) ->
             reply_markup=error_kb
         )
     finally:
-        session.close()
         await state.clear()
     
     await callback.answer()
 
+@router.callback_query(F.data.startswith("broadcast_progress_"))
+async def broadcast_progress(callback: types.CallbackQuery) -> None:
+    """Прогресс рассылки из очереди"""
+    job_id = int(callback.data.split("_")[2])
+    progress = broadcast_outbox.get_progress(job_id)
+    
+    if not progress or progress["created_by"] != callback.from_user.id:
+        await callback.answer("❌ Рассылка не найдена", show_alert=True)
+        return
+    
+    status_names = {
+        "pending": "⏳ В очереди",
+        "sending": "📤 Отправляется",
+        "completed": "✅ Завершена",
+    }
+    total = progress["total"]
+    done = progress["sent"] + progress["failed"]
+    
+    progress_kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data=f"broadcast_progress_{job_id}")],
+        [InlineKeyboardButton(text="◀️ Назад в меню", callback_data="back_to_admin_panel")]
+    ])
+    
+    try:
+        await callback.message.edit_text(
+            f"📨 *Рассылка #{job_id}*\n\n"
+            f"Статус: {status_names.get(progress['status'], progress['status'])}\n"
+            f"📊 Обработано: {done}/{total} ({(done / total * 100 if total else 100):.0f}%)\n"
+            f"• Отправлено: {progress['sent']}\n"
+            f"• Не удалось: {progress['failed']}\n"
+            f"• Осталось: {progress['pending']}",
+            parse_mode="Markdown",
+            reply_markup=progress_kb
+        )
+    except TelegramBadRequest:
+        # Прогресс не изменился с прошлого нажатия
+        pass
+    
+    await callback.answer()
+
 @router.callback_query(BroadcastStates.waiting_confirmation, F.data == "edit_broadcast_text")
 async def edit_broadcast_text(callback: types.CallbackQuery, state: FSMContext) -> None:
     """Редактирование текста рассылки"""
@@ -41,66 +41,18 @@ from database import get_session
 from database.models import User, UserRole, MessageSchedule, MessageScheduleStatus, Organization
 from services.shedule_manager import ScheduleManager
 from services.scheduler_service import MESSAGE_TEMPLATES
+from services.fanout import fan_out
+from services.media_delivery import MEDIA_NAMES, attachment_from_message, media_for, save_file_id
+from services.message_dispatcher import Priority, get_message_dispatcher
+from services.recipient_health import reachable_filter
 from .members import is_admin
 
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
-
 router = Router()
 logger = logging.getLogger(__name__)
 
 # Константы
 PAGE_SIZE = 5  # Количество сообщений на странице
-
-class BotScheduler:
-    """Планировщик задач бота"""
-    
-    def __init__(self, bot):
-        self.bot = bot
-        self.scheduler = AsyncIOScheduler(timezone="UTC")
-        
-    def start(self):
-        """Запуск планировщика"""
-        
-        # 1. Основная проверка - каждый час
-        self.scheduler.add_job(
-            self._check_and_send_reminders,
-            CronTrigger(minute=0, timezone="UTC"),  # Каждый час в 00 минут
-            id="hourly_reminders",
-            name="Напоминания каждый час",
-            replace_existing=True
-        )
-        
-        # 2. Для теста - каждые 10 минут
-        self.scheduler.add_job(
-            self._check_and_send_reminders,
-            CronTrigger(minute="*/10", timezone="UTC"),
-            id="test_reminders",
-            name="Тест напоминаний каждые 10 мин",
-            replace_existing=True
-        )
-        
-        self.scheduler.start()
-        logger.info("✅ Планировщик задач запущен")
-        logger.info("⏰ Напоминания будут проверяться каждый час (в 18:00 по времени организации)")
-    
-    async def _check_and_send_reminders(self):
-        """Проверяем и отправляем напоминания"""
-        logger.info("⏰ Проверка напоминаний...")
-        
-        try:
-            from services.reminder import SimpleReminderService
-            service = SimpleReminderService(self.bot)
-            await service.send_daily_reminders()
-        except Exception as e:
-            logger.error(f"❌ Ошибка отправки напоминаний: {e}")
-    
-    def shutdown(self):
-        """Остановка планировщика"""
-        if self.scheduler.running:
-            self.scheduler.shutdown(wait=False)
-            logger.info("🛑 Планировщик остановлен")
-
+SPREAD_OPTIONS = [5, 15, 30, 60]  # Варианты окна растягивания отправки, минут
 
 @router.callback_query(F.data == "admin_schedule_preview")
 async def admin_schedule_preview(callback: types.CallbackQuery) -> None:
@@ -428,7 +380,9 @@ async def schedule_edit_detail(callback: types.CallbackQuery) -> None:
             f"📌 Заголовок: {schedule.title}\n"
             f"📝 Содержание:\n{content_preview}\n\n"
             f"📊 Статус: {status_text}\n"
-            f"📅 Режим: {'Ежедневно' if schedule.is_daily else f'День недели: {schedule.day_of_week}'}"
+            f"📅 Режим: {'Ежедневно' if schedule.is_daily else f'День недели: {schedule.day_of_week}'}\n"
+            f"🌊 Растянуть отправку: {f'{schedule.spread_minutes} мин' if schedule.spread_minutes else 'нет'}\n"
+            f"📎 Вложение: {MEDIA_NAMES.get(schedule.attachment_type, 'нет')}"
         )
         
         # Создаем клавиатуру действий
@@ -444,6 +398,12 @@ async def schedule_edit_detail(callback: types.CallbackQuery) -> None:
                 ),
                 InlineKeyboardButton(text="📤 Отправить сейчас", callback_data=f"schedule_send_now_{schedule.id}")
             ],
+            [
+                InlineKeyboardButton(text="🌊 Растянуть отправку", callback_data=f"schedule_spread_{schedule.id}")
+            ],
+            *([[
+                InlineKeyboardButton(text="📎 Убрать вложение", callback_data=f"schedule_detach_{schedule.id}")
+            ]] if schedule.attachment_type else []),
             [
                 InlineKeyboardButton(text="🗑️ Удалить", callback_data=f"schedule_delete_{schedule.id}"),
                 InlineKeyboardButton(text="◀️ Назад", callback_data="schedule_select_edit")
@@ -600,7 +560,8 @@ async def schedule_change_text_start(callback: types.CallbackQuery, state: FSMCo
             f"Сообщение: {schedule.title}\n"
             f"Текущее время: {schedule.scheduled_time.strftime('%H:%M')}\n\n"
             f"*Текущий текст:*\n{content_preview}\n\n"
-            f"*Отправьте новый текст сообщения.*\n\n"
+            f"*Отправьте новый текст сообщения.*\n"
+            f"Можно прислать фото или документ с подписью - он будет прикреплен к сообщению.\n\n"
             f"Поддерживается форматирование Markdown:\n"
             f"• *жирный текст*\n"
             f"• _курсив_\n"
@@ -712,6 +673,99 @@ async def schedule_toggle_status(callback: types.CallbackQuery) -> None:
         logger.error(f"Ошибка переключения статуса: {e}")
         await callback.answer("❌ Ошибка", show_alert=True)
 
+@router.message(ScheduleEditStates.waiting_for_text, F.photo | F.document)
+async def process_attachment_input(message: Message, state: FSMContext) -> None:
+    """Фото или документ вместо текста - прикрепляем к сообщению расписания"""
+    try:
+        data = await state.get_data()
+        schedule_id = data.get('schedule_id')
+        
+        if not schedule_id:
+            await message.answer("❌ Ошибка: данные сессии утеряны")
+            await state.clear()
+            return
+        
+        # file_id уже есть в Telegram: при рассылке файл не загружается заново
+        attachment_type, file_id = attachment_from_message(message)
+        success = ScheduleManager.update_schedule_attachment(schedule_id, attachment_type, file_id)
+        
+        caption = (message.caption or "").strip()
+        if success and caption:
+            success = ScheduleManager.update_schedule_content(schedule_id, caption)
+        
+        if success:
+            await message.answer(
+                f"✅ *Вложение прикреплено!*\n\n"
+                f"📎 Тип: {MEDIA_NAMES[attachment_type]}\n"
+                f"📝 Текст: {'обновлен из подписи' if caption else 'без изменений'}",
+                parse_mode="Markdown",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
+                    InlineKeyboardButton(text="✏️ К редактированию", 
+                                       callback_data=f"schedule_edit_{schedule_id}")
+                ]])
+            )
+        else:
+            await message.answer("❌ Ошибка при сохранении вложения")
+        
+        await state.clear()
+        
+    except Exception as e:
+        logger.error(f"Ошибка обработки вложения: {e}")
+        await message.answer("❌ Ошибка при сохранении вложения")
+        await state.clear()
+
+@router.callback_query(F.data.startswith("schedule_detach_"))
+async def schedule_detach_attachment(callback: types.CallbackQuery) -> None:
+    """Убрать вложение из сообщения расписания"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Нет прав", show_alert=True)
+        return
+    
+    try:
+        schedule_id = int(callback.data.split("_")[2])
+        
+        if ScheduleManager.update_schedule_attachment(schedule_id, None, None):
+            await callback.answer("✅ Вложение убрано")
+            await schedule_edit_detail(callback)
+        else:
+            await callback.answer("❌ Ошибка при изменении", show_alert=True)
+            
+    except Exception as e:
+        logger.error(f"Ошибка удаления вложения: {e}")
+        await callback.answer("❌ Ошибка", show_alert=True)
+
+@router.callback_query(F.data.startswith("schedule_spread_"))
+async def schedule_change_spread(callback: types.CallbackQuery) -> None:
+    """Переключение окна, на которое растягивается отправка"""
+    user_id = callback.from_user.id
+    
+    if not is_admin(user_id):
+        await callback.answer("❌ Нет прав", show_alert=True)
+        return
+    
+    try:
+        schedule_id = int(callback.data.split("_")[2])
+        schedule = ScheduleManager.get_schedule_by_id(schedule_id)
+        if not schedule:
+            await callback.answer("❌ Сообщение не найдено", show_alert=True)
+            return
+        
+        # Перебираем варианты по кругу: нет -> 5 -> 15 -> 30 -> 60 -> нет
+        current = schedule.spread_minutes or 0
+        next_spread = next((option for option in SPREAD_OPTIONS if option > current), 0)
+        
+        if ScheduleManager.update_schedule_spread(schedule_id, next_spread):
+            await callback.answer(
+                f"✅ Отправка растянута на {next_spread} мин" if next_spread else "✅ Отправка без растягивания"
+            )
+            await schedule_edit_detail(callback)
+        else:
+            await callback.answer("❌ Ошибка при изменении", show_alert=True)
+            
+    except Exception as e:
+        logger.error(f"Ошибка изменения окна отправки: {e}")
+        await callback.answer("❌ Ошибка", show_alert=True)
+
 @router.callback_query(F.data == "schedule_add_new")
 async def schedule_add_new(callback: types.CallbackQuery) -> None:
     """Добавление нового сообщения"""
@@ -974,7 +1028,8 @@ async def schedule_send_all_now(callback: types.CallbackQuery) -> None:
         # Получаем пользователей организации
         users = session.query(User).filter(
             User.org_id == user.org_id,
-            User.chat_id.isnot(None)
+            User.chat_id.isnot(None),
+            reachable_filter()
         ).all()
         
         if not users:
@@ -986,7 +1041,7 @@ async def schedule_send_all_now(callback: types.CallbackQuery) -> None:
             )
             return
         
-        bot = callback.bot
+        dispatcher = get_message_dispatcher(callback.bot)
         total_sent = 0
         total_failed = 0
         
@@ -1006,18 +1061,14 @@ async def schedule_send_all_now(callback: types.CallbackQuery) -> None:
                 f"👥 Пользователей: {len(users)}"
             )
             
-            for u in users:
-                try:
-                    await bot.send_message(
-                        u.chat_id,
-                        f"{schedule.title}\n\n{schedule.content}"
-                    )
+            results = await send_schedule_to_users(dispatcher, schedule, users)
+            
+            for result in results:
+                if result.ok:
                     total_sent += 1
-                    await asyncio.sleep(0.05)
-                    
-                except Exception as e:
+                else:
                     total_failed += 1
-                    logger.warning(f"Ошибка отправки пользователю {u.user_id}: {e}")
+                    logger.warning(f"Ошибка отправки пользователю {result.item.user_id}: {result.error}")
         
         result_text = (
             f"✅ Рассылка завершена!\n\n"
@@ -1042,6 +1093,26 @@ async def schedule_send_all_now(callback: types.CallbackQuery) -> None:
     finally:
         session.close()
 
+async def send_schedule_to_users(dispatcher, schedule: MessageSchedule, users: List[User], on_progress=None):
+    """Отправить сообщение расписания пользователям (вложение загружается один раз)"""
+    text = f"{schedule.title}\n\n{schedule.content}"
+    media = media_for(schedule)
+    
+    async def send(user: User):
+        if media:
+            return await media.send(
+                dispatcher, user.chat_id, text, priority=Priority.BULK, org_id=schedule.org_id
+            )
+        return await dispatcher.send_message(
+            user.chat_id, text, priority=Priority.BULK, org_id=schedule.org_id
+        )
+    
+    results = await fan_out(users, send, on_progress=on_progress)
+    
+    if media and media.uploads and media.file_id:
+        save_file_id(MessageSchedule, schedule.id, media.file_id)
+    return results
+
 @router.callback_query(F.data.startswith("schedule_delete_"))
 async def schedule_delete_confirmation(callback: types.CallbackQuery) -> None:
     """Подтверждение удаления сообщения"""
@@ -1139,14 +1210,15 @@ async def schedule_send_now(callback: types.CallbackQuery) -> None:
             # Получаем пользователей организации
             users = session.query(User).filter(
                 User.org_id == schedule.org_id,
-                User.chat_id.isnot(None)
+                User.chat_id.isnot(None),
+                reachable_filter()
             ).all()
             
             if not users:
                 await callback.answer("❌ Нет пользователей для отправки", show_alert=True)
                 return
             
-            bot = callback.bot
+            dispatcher = get_message_dispatcher(callback.bot)
             sent_count = 0
             failed_count = 0
             
@@ -1158,28 +1230,32 @@ async def schedule_send_now(callback: types.CallbackQuery) -> None:
                 f"⏳ Отправлено: 0/{len(users)}"
             )
             
-            for i, user in enumerate(users, 1):
-                try:
-                    await bot.send_message(
-                        user.chat_id,
-                        f"{schedule.title}\n\n{schedule.content}"
-                    )
+            last_progress_at = 0.0
+            
+            async def update_progress(done: int, total: int):
+                # Редактируем не чаще раза в 2 секунды, чтобы не упереться в лимит
+                nonlocal last_progress_at
+                now = asyncio.get_running_loop().time()
+                if done < total and now - last_progress_at < 2:
+                    return
+                last_progress_at = now
+                await progress_msg.edit_text(
+                    f"📤 Отправка сообщения...\n"
+                    f"📝 {schedule.title}\n"
+                    f"👥 Пользователей: {total}\n"
+                    f"⏳ Обработано: {done}/{total}"
+                )
+            
+            results = await send_schedule_to_users(
+                dispatcher, schedule, users, on_progress=update_progress
+            )
+            
+            for result in results:
+                if result.ok:
                     sent_count += 1
-                    
-                    # Обновляем прогресс каждые 5 пользователей
-                    if i % 5 == 0 or i == len(users):
-                        await progress_msg.edit_text(
-                            f"📤 Отправка сообщения...\n"
-                            f"📝 {schedule.title}\n"
-                            f"👥 Пользователей: {len(users)}\n"
-                            f"✅ Отправлено: {sent_count}/{len(users)}"
-                        )
-                    
-                    await asyncio.sleep(0.05)
-                    
-                except Exception as e:
+                else:
                     failed_count += 1
-                    logger.warning(f"Ошибка отправки пользователю {user.user_id}: {e}")
+                    logger.warning(f"Ошибка отправки пользователю {result.item.user_id}: {result.error}")
             
             result_text = (
                 f"✅ Сообщение отправлено!\n\n"
@@ -1235,7 +1311,21 @@ async def cancel_text_handler(message: Message, state: FSMContext) -> None:
 
 @router.callback_query(F.data == "admin_generate_challenges")
 async def admin_generate_challenges(callback: types.CallbackQuery):
-    """Генерация AI-челленджей для команды"""
+    """Генерация AI-челленджей для команды (готовый набор, если он подготовлен ночью)"""
+    await generate_team_challenges(callback, regenerate=False)
+
+@router.callback_query(F.data == "admin_regenerate_challenges")
+async def admin_regenerate_challenges(callback: types.CallbackQuery):
+    """Сгенерировать новый набор челленджей, не используя подготовленный"""
+    await generate_team_challenges(callback, regenerate=True)
+
+async def generate_team_challenges(callback: types.CallbackQuery, regenerate: bool):
+    """Набор челленджей на день для команды тренера
+
+    Ночная задача challenge_precompute заранее готовит набор и анализ
+    команды, поэтому обычно ответ мгновенный; к модели обращаемся, только
+    если набора нет или тренер попросил сгенерировать заново.
+    """
     user_id = callback.from_user.id
     session = get_session()
     
@@ -1246,10 +1336,18 @@ async def admin_generate_challenges(callback: types.CallbackQuery):
             await callback.message.edit_text("❌ Вы не администратор команды")
             return
         
-        await callback.message.edit_text("🎯 Анализирую команду и генерирую челленджи...")
-        
-        # Генерируем челленджи через AI
-        challenges = await challenge_planner.generate_daily_challenges(user.org_id)
+        precomputed = await challenge_storage.get_precomputed(user.org_id)
+        if precomputed and not regenerate:
+            challenges = precomputed["challenges"]
+            logger.info(f"Челленджи команды {user.org_id} взяты из подготовленного набора ID={precomputed['id']}")
+        else:
+            await callback.message.edit_text("🎯 Анализирую команду и генерирую челленджи...")
+            
+            # Генерируем челленджи через AI; анализ команды берем из подготовленного набора
+            challenges = await challenge_planner.generate_daily_challenges(
+                user.org_id,
+                team_analysis=precomputed["team_analysis"] if precomputed else None
+            )
         
         if not challenges:
             await callback.message.edit_text("❌ Не удалось сгенерировать челленджи")
@@ -1340,7 +1438,7 @@ async def show_generated_challenges(
         [
             InlineKeyboardButton(
                 text="🔄 Сгенерировать заново", 
-                callback_data="admin_generate_challenges"
+                callback_data="admin_regenerate_challenges"
             )
         ],
         [
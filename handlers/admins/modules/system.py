@@ -45,6 +45,118 @@ async def admin_storage_stats(callback: types.CallbackQuery):
         logger.error(f"Ошибка получения статистики: {e}")
         await callback.message.edit_text("❌ Ошибка получения статистики")
 
+@router.callback_query(F.data == "admin_job_stats")
+async def admin_job_stats(callback: types.CallbackQuery):
+    """Показать статистику фоновых задач"""
+    from .members import is_super_admin
+    if not is_super_admin(callback.from_user.id):
+        await callback.answer("❌ Нет прав", show_alert=True)
+        return
+    
+    from services import job_scheduler as job_scheduler_module
+    scheduler = job_scheduler_module.job_scheduler
+    
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_job_stats")],
+        [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_admin_panel")]
+    ])
+    
+    def fmt_seconds(value) -> str:
+        return f"{value:.1f} с" if value is not None else "—"
+    
+    # Очередь AI-запросов есть на каждой реплике, в том числе не лидере
+    from services.ai_scheduler import get_ai_scheduler
+    ai_stats = get_ai_scheduler().get_stats()
+    ai_text = (
+        f"🤖 *Очередь AI-запросов*\n"
+        f"В работе: {ai_stats['in_flight']}/{ai_stats['max_concurrency']}\n"
+    )
+    for priority_name, stats in ai_stats['priorities'].items():
+        ai_text += (
+            f"• {priority_name}: в очереди {stats['queued']}, "
+            f"выполнено {stats['completed']}, ошибок {stats['failed']}, "
+            f"ожидание {fmt_seconds(stats['avg_wait'])} (макс {fmt_seconds(stats['max_wait'])})\n"
+        )
+    
+    from services.ai_guard import get_ai_breaker, get_ai_budget, STATE_CLOSED, STATE_OPEN
+    breaker_stats = get_ai_breaker().get_stats()
+    budget_stats = get_ai_budget().get_stats()
+    breaker_labels = {
+        STATE_CLOSED: "🟢 работает",
+        STATE_OPEN: f"🔴 отключен еще на {fmt_seconds(breaker_stats['open_for'])}",
+    }
+    ai_text += (
+        f"Breaker: {breaker_labels.get(breaker_stats['state'], '🟡 пробный запрос')}, "
+        f"отклонено {breaker_stats['rejected']}\n"
+        f"Бюджет за сутки: {budget_stats['requests']}/{budget_stats['daily_requests'] or '∞'} запросов, "
+        f"{budget_stats['tokens']}/{budget_stats['daily_tokens'] or '∞'} токенов\n"
+    )
+    
+    from services.ai_service import AIService
+    flight_stats = AIService.single_flight_stats
+    ai_text += (
+        f"Одинаковых запросов объединено: {flight_stats['coalesced']} из {flight_stats['calls']}\n"
+    )
+    
+    from services.motivation_pool import motivation_pool
+    pool_stats = motivation_pool.stats
+    ai_text += (
+        f"Мотивация из пула: {pool_stats['served']}, пул пуст: {pool_stats['misses']}, "
+        f"сгенерировано: {pool_stats['generated']}\n"
+    )
+    
+    from services.prompt_builder import get_prompt_stats
+    for task, prompt_stats in get_prompt_stats().items():
+        ai_text += (
+            f"Промпт `{task}`: ~{prompt_stats['avg_tokens']:.0f} ток. в среднем, "
+            f"макс {prompt_stats['max_tokens']}/{prompt_stats['budget']}, "
+            f"сокращено {prompt_stats['truncated']} из {prompt_stats['count']}\n"
+        )
+    
+    from services.json_output import get_json_stats
+    json_stats = get_json_stats()
+    if json_stats['attempts']:
+        ai_text += (
+            f"JSON-ответы: ошибок разбора {json_stats['failure_rate']:.0%} "
+            f"из {json_stats['attempts']} попыток (целиком {json_stats['native']}, "
+            f"из текста {json_stats['extracted']}, исправлено {json_stats['repaired']}), "
+            f"повторов {json_stats['retries']}, не получено {json_stats['failed']}\n"
+        )
+    
+    if not scheduler or not scheduler.running:
+        await callback.message.edit_text(
+            "⚙️ *ФОНОВЫЕ ЗАДАЧИ*\n\n"
+            "Эта реплика не лидер: задачи выполняются на другой реплике.\n\n"
+            f"{ai_text}",
+            parse_mode="Markdown",
+            reply_markup=kb
+        )
+        return
+    
+    def fmt_time(value) -> str:
+        return value.strftime("%d.%m %H:%M:%S UTC") if value else "—"
+    
+    stats_text = "⚙️ *ФОНОВЫЕ ЗАДАЧИ*\n\n"
+    for job_id, stats in scheduler.get_stats().items():
+        stats_text += (
+            f"*{stats['name']}* (`{job_id}`)\n"
+            f"▶️ Запусков: {stats['runs']}, ошибок: {stats['failures']}, "
+            f"пропущено: {stats['missed']}, перекрытий: {stats['overlaps']}\n"
+            f"⏱ Длительность: {fmt_seconds(stats['last_duration'])} "
+            f"(средняя {fmt_seconds(stats['avg_duration'])}, макс {fmt_seconds(stats['max_duration'])})\n"
+            f"🐢 Задержка старта: {fmt_seconds(stats['last_lag'])} (макс {fmt_seconds(stats['max_lag'])})\n"
+            f"🕐 Последний запуск: {fmt_time(stats['last_run_at'])}\n"
+            f"⏭ Следующий: {fmt_time(stats['next_run_at'])}\n"
+        )
+        if stats['last_error']:
+            error_text = re.sub(r"[*_`\[\]]", "", stats['last_error'][:100])
+            stats_text += f"❌ Последняя ошибка: {error_text}\n"
+        stats_text += "\n"
+    
+    stats_text += ai_text
+    
+    await callback.message.edit_text(stats_text, parse_mode="Markdown", reply_markup=kb)
+
 @router.callback_query(F.data == "admin_manage_admins")
 async def admin_manage_admins(callback: types.CallbackQuery):
     """Управление администраторами системы"""
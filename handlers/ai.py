@@ -8,9 +8,12 @@ from aiogram.fsm.state import State, StatesGroup
 import asyncio
 from datetime import datetime
 import json
+from sqlalchemy import func
 
 from services.ai_helper import AIHelper
 from services.ai_service import AIService
+from services.stream_renderer import TelegramStreamRenderer
+from config import load_config
 from database import User, Challenge, Survey, Organization, get_session
 from keyboards import main_menu, challenge_types, report_types, progress_actions
 from utils.motivation import MotivationSystem
@@ -81,7 +84,16 @@ async def process_direction(callback: CallbackQuery, state: FSMContext):
         
         # Собираем данные пользователя
         surveys = session.query(Survey).filter(Survey.user_id == user.id).order_by(Survey.created_at.desc()).limit(3).all()
-        challenges = session.query(Challenge).filter(Challenge.user_id == user.id).all()
+        # История челленджей растет без ограничений: считаем ее в БД и берем
+        # только последние успехи, а не все записи пользователя
+        status_counts = dict(session.query(
+            Challenge.status, func.count(Challenge.id)
+        ).filter(Challenge.user_id == user.id).group_by(Challenge.status).all())
+        total_challenges = sum(status_counts.values())
+        recent_successes = session.query(Challenge).filter(
+            Challenge.user_id == user.id,
+            Challenge.status == "COMPLETED"
+        ).order_by(Challenge.id.desc()).limit(3).all()
         
         user_data = {
             "user_id": user.id,
@@ -93,12 +105,12 @@ async def process_direction(callback: CallbackQuery, state: FSMContext):
             "last_metrics": {
                 "last_survey_score": surveys[0].score if surveys else 0,
                 "avg_energy": sum(s.energy for s in surveys) / len(surveys) if surveys else 0,
-                "completion_rate": len([c for c in challenges if c.status == "COMPLETED"]) / len(challenges) * 100 if challenges else 0
+                "completion_rate": status_counts.get("COMPLETED", 0) / total_challenges * 100 if total_challenges else 0
             } if surveys else {},
             "previous_successes": [
                 {"challenge": c.text[:50] + "...", "completed_at": c.completed_at.strftime("%d.%m.%Y") if c.completed_at else "N/A"}
-                for c in challenges[-3:] if c.status == "COMPLETED"
-            ] if challenges else []
+                for c in recent_successes
+            ]
         }
         
         # Генерация персонализированного челленджа через AI
@@ -232,6 +244,21 @@ async def complete_challenge(message: Message, state: FSMContext):
     finally:
         session.close()
 
+async def _answer_question(typing_msg: Message, question: str, context: dict):
+    """Ответить на вопрос в сообщении-индикаторе: потоком или целиком"""
+    if load_config().ai_streaming:
+        # Ответ появляется по мере генерации, а не после долгой паузы
+        await TelegramStreamRenderer(typing_msg).render(
+            ai_service.stream_ai_response(question, context)
+        )
+        return
+    
+    # ВАЖНО: используем ПЕРЕИМЕНОВАННЫЙ метод
+    answer = await ai_service.get_ai_response(question, context)
+    
+    await typing_msg.delete()
+    await typing_msg.answer(answer, parse_mode="Markdown")
+
 @router.message(F.text.contains("?"))
 async def handle_question(message: Message):
     """Обработчик вопросов с '?'"""
@@ -253,12 +280,7 @@ async def handle_question(message: Message):
         
         # Показываем индикатор
         typing_msg = await message.answer("🤔 Думаю...")
-        
-        # ВАЖНО: используем ПЕРЕИМЕНОВАННЫЙ метод
-        answer = await ai_service.get_ai_response(question, context)
-        
-        await typing_msg.delete()
-        await message.answer(answer, parse_mode="Markdown")
+        await _answer_question(typing_msg, question, context)
         
     except Exception as e:
         logger.error(f"Ошибка обработки вопроса: {e}")
@@ -558,10 +580,7 @@ async def handle_ask_command(message: Message):
         typing_msg = await message.answer("🤔 Думаю над ответом...")
         
         # Используем тот же метод что и для "?"
-        answer = await ai_service.get_ai_response(question, context)
-        
-        await typing_msg.delete()
-        await message.answer(answer, parse_mode="Markdown")
+        await _answer_question(typing_msg, question, context)
         
     except Exception as e:
         logger.error(f"Ошибка команды /ask: {e}")
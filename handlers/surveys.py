@@ -1,4 +1,8 @@
+import asyncio
 import logging
+import time
+import weakref
+from typing import Dict, List, Tuple
 from aiogram import Router, types, F
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
 from aiogram.utils.keyboard import InlineKeyboardBuilder
@@ -22,6 +26,75 @@ class SurveyStates(StatesGroup):
 
 metrics_analyzer = ProffKonstaltingMetrics()
 
+# Вопросы следующих метрик полного AI-опроса генерируются заранее, пока
+# пользователь отвечает на текущие (user_id -> (время запуска, метрика -> задача))
+_question_prefetch: Dict[int, Tuple[float, Dict[str, asyncio.Task]]] = {}
+
+# Предзагрузка брошенного опроса (состояние сброшено другим меню) удаляется через
+_PREFETCH_TTL = 60 * 60
+
+# Ответы одного пользователя обрабатываются по одному: пока готовится
+# следующий вопрос, новые сообщения не должны сдвигать индекс опроса.
+# Замок живет, пока его держит обработчик ответа
+_answer_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def _answer_lock(user_id: int) -> asyncio.Lock:
+    lock = _answer_locks.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _answer_locks[user_id] = lock
+    return lock
+
+def _prefetch_questions(user_id: int, user_context: dict, metric_keys: List[str]):
+    """Запустить генерацию вопросов по метрикам в фоне (по порядку опроса)"""
+    _cancel_prefetch(user_id)
+    _drop_stale_prefetch()
+    _question_prefetch[user_id] = (time.monotonic(), {
+        metric_key: asyncio.create_task(
+            metrics_analyzer.generate_ai_questions_based_on_answers(user_context, [metric_key])
+        )
+        for metric_key in metric_keys
+    })
+
+def _cancel_prefetch(user_id: int):
+    _, tasks = _question_prefetch.pop(user_id, (None, {}))
+    for task in tasks.values():
+        task.cancel()
+
+def _drop_stale_prefetch():
+    deadline = time.monotonic() - _PREFETCH_TTL
+    for user_id in [user_id for user_id, (started, _) in _question_prefetch.items() if started < deadline]:
+        _cancel_prefetch(user_id)
+
+async def _take_prefetched_questions(user_id: int, user_context: dict, metric_key: str) -> List[str]:
+    """Вопросы метрики из предзагрузки (или сгенерировать сейчас, если ее нет)"""
+    _, tasks = _question_prefetch.get(user_id, (None, {}))
+    task = tasks.pop(metric_key, None)
+    if task is None:
+        # Например, бот перезапустился посреди опроса
+        ai_questions = await metrics_analyzer.generate_ai_questions_based_on_answers(user_context, [metric_key])
+    else:
+        ai_questions = await task
+    return ai_questions.get(metric_key, [])
+
+async def _ensure_next_question(user_id: int, state: FSMContext) -> bool:
+    """Подгрузить вопросы следующих метрик, если текущие закончились
+
+    Возвращает False, если вопросов больше нет и опрос пора завершать.
+    """
+    data = await state.get_data()
+    all_questions = data.get('all_questions', [])
+    pending_metrics = data.get('pending_metrics', [])
+    current_index = data.get('current_question_index', 0)
+
+    while current_index >= len(all_questions) and pending_metrics:
+        metric_key = pending_metrics.pop(0)
+        questions = await _take_prefetched_questions(user_id, data.get('user_context', {}), metric_key)
+        all_questions.extend({'metric': metric_key, 'question': question} for question in questions)
+
+    await state.update_data(all_questions=all_questions, pending_metrics=pending_metrics)
+    return current_index < len(all_questions)
+
 # Клавиатуры для ответов
 def get_rating_keyboard(metric_key: str, question_index: int, max_rating: int) -> InlineKeyboardMarkup:
     """Клавиатура для оценки по шкале"""
@@ -67,6 +140,7 @@ def get_metrics_selection_keyboard() -> InlineKeyboardMarkup:
 async def start_survey_menu(call: types.CallbackQuery):
     """Начало меню опросов"""
     await call.answer()
+    _cancel_prefetch(call.from_user.id)
 
     text = (
         "📊 *Опросы ProffKonstalting*\n\n"
@@ -106,9 +180,10 @@ async def start_survey(call: types.CallbackQuery, state: FSMContext):
     if data == 'full':
         # Проверяем квоту AI перед началом полного опроса
         if hasattr(metrics_analyzer.ai_service, 'hf_service') and metrics_analyzer.ai_service.hf_service:
-            if metrics_analyzer.ai_service.hf_service.quota_exceeded:
+            unavailable = metrics_analyzer.ai_service.hf_service.unavailable_message
+            if unavailable:
                 await call.message.edit_text(
-                    "❌ Квота AI запросов исчерпана. Полный AI-опрос требует большого количества запросов.\n\n"
+                    f"{unavailable}\nПолный AI-опрос требует большого количества запросов.\n\n"
                     "Попробуйте:\n"
                     "• Пройти опрос по одной метрике\n"
                     "• Повторить попытку позже\n"
@@ -133,27 +208,31 @@ async def start_survey(call: types.CallbackQuery, state: FSMContext):
         # Получаем контекст пользователя для генерации вопросов
         user_context = await get_user_context(call.from_user.id)
 
-        # Генерируем AI-вопросы на основе начальных ответов пользователя
-        ai_questions = await metrics_analyzer.generate_ai_questions_based_on_answers(user_context)
-
-        # Преобразуем в плоский список вопросов с метриками
-        all_questions = []
-        for metric_key, questions in ai_questions.items():
-            for question in questions:
-                all_questions.append({
-                    'metric': metric_key,
-                    'question': question
-                })
+        # Генерируем AI-вопросы по всем метрикам в фоне: первый вопрос ждет
+        # только свою метрику, остальные готовятся, пока пользователь отвечает
+        metric_keys = metrics_analyzer.get_ai_survey_metrics()
+        _prefetch_questions(call.from_user.id, user_context, metric_keys)
 
         await state.update_data(
             survey_type='full',
-            all_questions=all_questions,
+            all_questions=[],
+            metric_keys=metric_keys,
+            pending_metrics=list(metric_keys),
             current_question_index=0,
             user_context=user_context
         )
-        await ask_next_ai_question(call.from_user.id, call.bot, state)
+        if await _ensure_next_question(call.from_user.id, state):
+            await ask_next_ai_question(call.from_user.id, call.bot, state)
+        else:
+            await call.bot.send_message(
+                chat_id=call.from_user.id,
+                text="❌ Не удалось подготовить вопросы. Попробуйте начать опрос позже."
+            )
+            _cancel_prefetch(call.from_user.id)
+            await state.clear()
     else:
         # Опрос по конкретной метрике
+        _cancel_prefetch(call.from_user.id)
         try:
             await call.message.edit_text("📊 Начинаем опрос...")
         except Exception as e:
@@ -230,6 +309,16 @@ async def process_rating(call: types.CallbackQuery, state: FSMContext):
 @router.message(SurveyStates.answering_questions)
 async def process_text_answer(message: types.Message, state: FSMContext):
     """Обработка текстового ответа на AI-вопрос"""
+    lock = _answer_lock(message.from_user.id)
+    if lock.locked():
+        # Предыдущий ответ еще обрабатывается - этот вопрос пользователь еще не видел
+        await message.answer("⏳ Готовлю следующий вопрос, подождите немного и ответьте на него.")
+        return
+
+    async with lock:
+        await _process_text_answer(message, state)
+
+async def _process_text_answer(message: types.Message, state: FSMContext):
     try:
         data = await state.get_data()
         survey_type = data.get('survey_type')
@@ -259,12 +348,11 @@ async def process_text_answer(message: types.Message, state: FSMContext):
 async def process_next_ai_question(message: types.Message, state: FSMContext):
     """Обработка следующего AI-вопроса в полном опросе"""
     data = await state.get_data()
-    all_questions = data.get('all_questions', [])
     current_question_index = data.get('current_question_index', 0)
 
-    if current_question_index + 1 < len(all_questions):
-        # Есть еще вопросы
-        await state.update_data(current_question_index=current_question_index + 1)
+    await state.update_data(current_question_index=current_question_index + 1)
+    if await _ensure_next_question(message.from_user.id, state):
+        # Есть еще вопросы (вопросы следующей метрики обычно уже готовы)
         await ask_next_ai_question(message.chat.id, message.bot, state)
     else:
         # Все вопросы заданы, завершаем опрос
@@ -279,9 +367,13 @@ async def ask_next_ai_question(chat_id: int, bot, state: FSMContext):
     if current_index < len(all_questions):
         question_data = all_questions[current_index]
 
+        # Вопросы следующих метрик еще генерируются, поэтому прогресс - по метрикам
+        metric_keys = data.get('metric_keys', [])
+        metric_position = metric_keys.index(question_data['metric']) + 1 if question_data['metric'] in metric_keys else 1
+
         text = (
             f"🤖 *AI-ВОПРОС*\n\n"
-            f"*{current_index + 1}/{len(all_questions)}*\n\n"
+            f"*Вопрос {current_index + 1} · метрика {metric_position}/{len(metric_keys) or 1}*\n\n"
             f"{question_data['question']}\n\n"
             f"💡 _Ответьте подробно для точного анализа_"
         )
@@ -345,6 +437,7 @@ async def finish_ai_full_survey(message: types.Message, state: FSMContext):
     """Завершение полного AI-опроса"""
     data = await state.get_data()
     user_context = data.get('user_context', {})
+    _cancel_prefetch(message.from_user.id)
 
     await message.answer("🤖 Проводим комплексный анализ ваших ответов...")
 
@@ -352,8 +445,12 @@ async def finish_ai_full_survey(message: types.Message, state: FSMContext):
     answers = user_context.get('answers', [])
     if answers:
         try:
-            # Генерируем вопросы и оцениваем ответы
-            ai_questions = await metrics_analyzer.generate_ai_questions_based_on_answers(user_context)
+            # Оцениваем ответы по тем же вопросам, что задавали пользователю
+            ai_questions = {}
+            for question_data in data.get('all_questions', []):
+                ai_questions.setdefault(question_data['metric'], []).append(question_data['question'])
+            if not ai_questions:
+                ai_questions = await metrics_analyzer.generate_ai_questions_based_on_answers(user_context)
             scores = await metrics_analyzer.score_answers_with_ai(answers, ai_questions)
         except Exception as e:
             logger.error(f"Ошибка AI-оценки ответов: {e}")
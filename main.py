@@ -18,7 +18,10 @@ def handle_sigterm(signum, frame):
 
 # Создаем aiohttp сервер для Render
 async def handle_root(request):
-    return web.Response(text="✅ Bot is running on Render")
+    from services import leader_election as election_module
+    election = election_module.leader_election
+    role = "leader" if election and election.is_leader else "follower"
+    return web.Response(text=f"✅ Bot is running on Render ({role})")
 
 async def handle_health(request):
     return web.Response(text="OK")
@@ -81,47 +84,23 @@ def create_temp_dirs():
         os.makedirs(dir_name, exist_ok=True)
         logger.info(f"✅ Создана директория: {dir_name}")
 
-# Фоновая задача для очистки устаревших записей
-async def cleanup_pending_challenges(bot: Bot):
-    """Фоновая задача для очистки устаревших записей"""
-    logger.info("Запуск задачи очистки устаревших челленджей...")
-    
+# Фоновые задачи, которые должны работать только на реплике-лидере
+async def start_background_jobs(bot: Bot):
+    """Запуск планировщика задач после избрания лидером"""
+    logger.info("Запускаю планировщик фоновых задач...")
     try:
-        from services.challenge_storage import challenge_storage
-        
-        while True:
-            try:
-                cleaned = await challenge_storage.cleanup_expired()
-                if cleaned > 0:
-                    logger.info(f"Очищено {cleaned} просроченных записей")
-                
-                stats = await challenge_storage.get_statistics()
-                logger.debug(f"Статистика хранилища: {stats}")
-                
-            except Exception as e:
-                logger.error(f"Ошибка в задаче очистки: {e}")
-            
-            # Спим 6 часов между проверками
-            await asyncio.sleep(6 * 3600)
-            
+        from services.job_scheduler import init_job_scheduler
+        init_job_scheduler(bot).start()
+        logger.info("✅ Планировщик фоновых задач запущен")
     except Exception as e:
-        logger.error(f"Критическая ошибка задачи очистки: {e}")
+        logger.error(f"❌ Ошибка запуска планировщика задач: {e}")
 
-# Фоновая задача для проверки запланированных челленджей
-async def check_and_send_scheduled_challenges(bot: Bot):
-    """Фоновая задача для проверки и отправки запланированных челленджей"""
-    logger.info("Запуск задачи проверки запланированных челленджей...")
-    
-    try:
-        from services.challenge_sheduler import ChallengeScheduler
-        
-        scheduler = ChallengeScheduler(bot)
-        await scheduler.start()
-        
-        logger.info("✅ Задача проверки запланированных челленджей запущена")
-        
-    except Exception as e:
-        logger.error(f"Ошибка запуска задачи проверки челленджей: {e}")
+async def stop_background_jobs():
+    """Остановка планировщика при потере лидерства или завершении работы"""
+    from services import job_scheduler as job_scheduler_module
+    if job_scheduler_module.job_scheduler:
+        job_scheduler_module.job_scheduler.shutdown()
+    logger.info("⏹️ Фоновые задачи остановлены")
 
 # Инициализация шрифтов для PDF
 def init_dejavu_fonts():
@@ -184,6 +163,10 @@ async def bot_main():
             bot = Bot(token=config.token) 
             dp = Dispatcher(storage=storage)
             logger.info("✅ Бот и диспетчер инициализированы")
+            
+            from services.message_dispatcher import init_message_dispatcher
+            message_dispatcher = init_message_dispatcher(bot)
+            message_dispatcher.start()
         except Exception as e:
             logger.error(f"❌ Ошибка инициализации бота: {e}")
             raise
@@ -195,7 +178,9 @@ async def bot_main():
                 ClearStateMiddleware,
                 AutoRegisterUserMiddleware,
                 LoggingMiddleware,
-                AntiFloodMiddleware
+                AntiFloodMiddleware,
+                RecipientHealthMiddleware,
+                AIUserContextMiddleware
             )
             from middlewares.middlewares import CacheMiddleware
             
@@ -203,6 +188,8 @@ async def bot_main():
             dp.update.middleware(AntiFloodMiddleware(delay=0.3))
             dp.update.middleware(ClearStateMiddleware())
             dp.update.middleware(AutoRegisterUserMiddleware())
+            dp.update.middleware(RecipientHealthMiddleware())
+            dp.update.middleware(AIUserContextMiddleware())
             dp.update.middleware(CacheMiddleware())
             
             logger.info("✅ Мидлвари зарегистрированы")
@@ -232,37 +219,25 @@ async def bot_main():
             traceback.print_exc()
             raise
         
-        # 7. Запускаем планировщики
-        logger.info("Запускаю планировщик...")
-        try:
-            from services import SchedulerManager
-            scheduler_manager = SchedulerManager(bot)
-            scheduler_manager.start()
-            logger.info("✅ Планировщик запущен")
-        except Exception as e:
-            logger.warning(f"⚠️ Ошибка запуска планировщика: {e}")
-        
-        # 8. Запускаем планировщик сообщений
-        logger.info("Запускаю планировщик сообщений...")
+        # 7. Запускаем выбор лидера: планировщики работают только на одной реплике
+        logger.info("Запускаю выбор лидера для фоновых задач...")
         try:
-            from services.timezone_scheduler import TimezoneMessageScheduler
-            message_scheduler = TimezoneMessageScheduler(bot)
-            asyncio.create_task(message_scheduler.start())
-            logger.info("✅ Планировщик сообщений запущен")
+            from services.leader_election import init_leader_election
+            election = init_leader_election(
+                lock_id=config.leader_lock_id,
+                heartbeat_interval=config.leader_heartbeat_interval,
+                retry_interval=config.leader_retry_interval
+            )
+            leader_task = asyncio.create_task(election.run(
+                on_elected=lambda: start_background_jobs(bot),
+                on_demoted=stop_background_jobs
+            ))
+            logger.info("✅ Выбор лидера запущен")
         except Exception as e:
-            logger.warning(f"⚠️ Ошибка запуска планировщика сообщений: {e}")
-        
-        # 9. Запускаем планировщик челленджей
-        logger.info("Запускаю планировщик челленджей...")
-        asyncio.create_task(check_and_send_scheduled_challenges(bot))
-        logger.info("✅ Планировщик челленджей запущен")
-        
-        # 10. Запускаем очистку устаревших данных
-        logger.info("Запускаю очистку устаревших данных...")
-        asyncio.create_task(cleanup_pending_challenges(bot))
-        logger.info("✅ Очистка устаревших данных запущена")
+            logger.error(f"❌ Ошибка запуска выбора лидера: {e}")
+            raise
         
-        # 11. Инициализируем шрифты для PDF
+        # 8. Инициализируем шрифты для PDF
         logger.info("Инициализирую шрифты для PDF отчетов...")
         fonts_loaded = init_dejavu_fonts()
         if fonts_loaded:
@@ -273,9 +248,17 @@ async def bot_main():
             except Exception as e:
                 logger.warning(f"⚠️ Не удалось установить шрифт: {e}")
         
-        # 12. Запускаем бота
+        # 9. Запускаем бота
         logger.info("🎉 Все системы готовы! Запускаю опрос сообщений...")
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        try:
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        finally:
+            # Отдаем лидерство, чтобы другая реплика подхватила задачи сразу
+            election.stop()
+            await leader_task
+            await message_dispatcher.stop()
+            from services.hf_service import close_ai_client
+            await close_ai_client()
         
     except Exception as e:
         logger.error(f"❌ Критическая ошибка: {e}")
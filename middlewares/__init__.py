@@ -3,7 +3,9 @@ from .middlewares import (
     AutoRegisterUserMiddleware,
     LoggingMiddleware,
     AntiFloodMiddleware,
-    DatabaseSessionMiddleware
+    DatabaseSessionMiddleware,
+    RecipientHealthMiddleware,
+    AIUserContextMiddleware
 )
 
 __all__ = [
@@ -11,5 +13,7 @@ __all__ = [
     'AutoRegisterUserMiddleware', 
     'LoggingMiddleware',
     'AntiFloodMiddleware',
-    'DatabaseSessionMiddleware'
+    'DatabaseSessionMiddleware',
+    'RecipientHealthMiddleware',
+    'AIUserContextMiddleware'
 ]
\ No newline at end of file
@@ -85,6 +85,44 @@ class AutoRegisterUserMiddleware(BaseMiddleware):
         return await handler(event, data)
 
 
+class RecipientHealthMiddleware(BaseMiddleware):
+    """Снимает отметку недоступности, когда пользователь снова пишет боту"""
+    
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message | CallbackQuery,
+        data: Dict[str, Any]
+    ) -> Any:
+        from services.recipient_health import mark_reachable
+        
+        # Мидлварь висит на update, поэтому пользователя берем из контекста aiogram
+        from_user = data.get("event_from_user")
+        if from_user:
+            mark_reachable(from_user.id)
+        
+        return await handler(event, data)
+
+
+class AIUserContextMiddleware(BaseMiddleware):
+    """Запоминает пользователя для очереди AI-запросов (справедливость по пользователям)"""
+    
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message | CallbackQuery,
+        data: Dict[str, Any]
+    ) -> Any:
+        from services.ai_scheduler import set_ai_user
+        
+        # Обработчик выполняется в той же задаче, поэтому контекст доходит
+        # до всех AI-запросов, которые он сделает
+        from_user = data.get("event_from_user")
+        set_ai_user(from_user.id if from_user else None)
+        
+        return await handler(event, data)
+
+
 class LoggingMiddleware(BaseMiddleware):
     """Логирование всех событий"""
     
@@ -6,9 +6,15 @@ import json
 import random
 import traceback
 
+import pytz
+from sqlalchemy import func
+
 from services.ai_service import AIService
 from database import get_session, User, Organization, Challenge, Survey
 from config import load_config
+from services.ai_scheduler import AIPriority, ai_request_context
+from services.challenge_storage import challenge_storage
+from services.fanout import fan_out
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +27,9 @@ class AIChallengePlanner:
         "evening": time(19, 0)    # 19:00 вечера
     }
     
+    # Ожидаемая структура ответа модели с челленджами на день
+    CHALLENGES_SCHEMA = {"challenges": [{"time": str, "title": str, "description": str}]}
+    
     CHALLENGE_POINTS = {
         "easy": {"min": 3, "max": 3},
         "medium": {"min": 3, "max": 3},
@@ -63,24 +72,21 @@ class AIChallengePlanner:
                 team_level = "advanced"
             
             # Определяем уровень активности
-            # Анализируем выполненные челленджи
+            # Анализируем выполненные челленджи одним запросом на всю команду
             completed_challenges = 0
             total_challenges = 0
             
-            for user in users:
-                try:
-                    user_challenges = session.query(Challenge).filter(
-                        Challenge.user_id == user.id
-                    ).all()
-                    
-                    total_challenges += len(user_challenges)
-                    
-                    for challenge in user_challenges:
-                        if hasattr(challenge, 'status') and challenge.status == "COMPLETED":
-                            completed_challenges += 1
-                except Exception as e:
-                    logger.warning(f"Ошибка получения челленджей для пользователя {user.id}: {e}")
-                    continue
+            try:
+                status_counts = dict(session.query(
+                    Challenge.status, func.count(Challenge.id)
+                ).filter(
+                    Challenge.user_id.in_([user.id for user in users])
+                ).group_by(Challenge.status).all())
+                
+                total_challenges = sum(status_counts.values())
+                completed_challenges = status_counts.get("COMPLETED", 0)
+            except Exception as e:
+                logger.warning(f"Ошибка получения челленджей команды {org_id}: {e}")
             
             completion_rate = (completed_challenges / total_challenges * 100) if total_challenges > 0 else 0
             
@@ -145,10 +151,18 @@ class AIChallengePlanner:
         finally:
             session.close()
     
-    async def generate_daily_challenges(self, org_id: int) -> List[Dict]:
-        """Генерация 3 челленджей на день"""
+    async def generate_daily_challenges(self, org_id: int, team_analysis: Optional[Dict] = None,
+                                        fallback: bool = True) -> List[Dict]:
+        """Генерация 3 челленджей на день
+        
+        Args:
+            org_id: ID организации
+            team_analysis: Готовый анализ команды (если уже посчитан)
+            fallback: Вернуть стандартные челленджи, если AI недоступен (иначе пустой список)
+        """
         # Получаем уровень команды
-        team_analysis = await self.analyze_team_level(org_id)
+        if not team_analysis:
+            team_analysis = await self.analyze_team_level(org_id)
         
         if "error" in team_analysis:
             difficulty = "medium"
@@ -206,17 +220,18 @@ class AIChallengePlanner:
         try:
             logger.info(f"Запрос AI для генерации челленджей")
             
-            response = await self.ai_service.get_json_response(prompt)
+            # Приоритет задает вызывающий: тренер ждет ответа, ночная подготовка - нет
+            response = await self.ai_service.get_json_response(prompt, schema=self.CHALLENGES_SCHEMA)
             
             if "error" in response:
                 logger.error(f"Ошибка AI: {response['error']}")
-                return self._get_fallback_challenges(difficulty)
+                return self._get_fallback_challenges(difficulty) if fallback else []
             
             challenges = response.get("challenges", [])
             
             if not challenges:
                 logger.warning("AI не вернул челленджи")
-                return self._get_fallback_challenges(difficulty)
+                return self._get_fallback_challenges(difficulty) if fallback else []
             
             # Добавляем очки в зависимости от сложности
             points_config = self.CHALLENGE_POINTS.get(difficulty, self.CHALLENGE_POINTS["medium"])
@@ -231,7 +246,82 @@ class AIChallengePlanner:
             
         except Exception as e:
             logger.error(f"Ошибка генерации челленджей: {e}")
-            return self._get_fallback_challenges(difficulty)
+            return self._get_fallback_challenges(difficulty) if fallback else []
+    
+    async def precompute_due_orgs(self) -> int:
+        """Подготовить наборы челленджей на день для организаций, у которых
+        по их часовому поясу наступил час подготовки, а набора на сегодня еще нет
+        
+        Задача запускается каждый час; организация, пропустившая свой час
+        (новая или AI был недоступен), догоняется при следующем запуске.
+        
+        Returns:
+            Сколько наборов подготовлено
+        """
+        precompute_hour = load_config().challenge_precompute_hour
+        now_utc = datetime.now(pytz.UTC)
+        
+        session = get_session()
+        try:
+            orgs = session.query(Organization.id, Organization.timezone).all()
+        finally:
+            session.close()
+        
+        ready = await challenge_storage.get_precomputed_dates()
+        due = []
+        for org_id, org_timezone in orgs:
+            try:
+                org_tz = pytz.timezone(org_timezone or "Asia/Novosibirsk")
+            except pytz.UnknownTimeZoneError:
+                org_tz = pytz.timezone("Asia/Novosibirsk")
+            
+            now_local = now_utc.astimezone(org_tz)
+            if now_local.hour < precompute_hour or ready.get(org_id) == now_local.date():
+                continue
+            
+            # Набор действует до часа подготовки следующего дня
+            expires_local = org_tz.localize(datetime.combine(
+                now_local.date() + timedelta(days=1), time(precompute_hour, 0)
+            ))
+            due.append((org_id, now_local.date(), expires_local.astimezone(pytz.UTC)))
+        
+        if not due:
+            return 0
+        
+        outcomes = await fan_out(
+            due,
+            lambda entry: self.precompute_daily_challenges(*entry),
+            concurrency=load_config().ai_batch_concurrency
+        )
+        prepared = sum(1 for outcome in outcomes if outcome.ok and outcome.result)
+        logger.info(f"🌙 Подготовлено наборов челленджей: {prepared}/{len(due)}")
+        return prepared
+    
+    async def precompute_daily_challenges(self, org_id: int, valid_for, expires_at: datetime) -> Optional[int]:
+        """Подготовить и сохранить набор челленджей организации на день
+        
+        Returns:
+            ID записи PendingChallenge или None, если набор не подготовлен
+        """
+        team_analysis = await self.analyze_team_level(org_id)
+        if "error" in team_analysis:
+            return None
+        
+        # Стандартные челленджи не сохраняем: тренер получит их и так,
+        # а при следующем запуске задача попробует AI еще раз
+        with ai_request_context(AIPriority.BACKGROUND, org_id=org_id):
+            challenges = await self.generate_daily_challenges(org_id, team_analysis=team_analysis, fallback=False)
+        if not challenges:
+            logger.warning(f"Не удалось заранее подготовить челленджи для команды {org_id}")
+            return None
+        
+        return await challenge_storage.save_precomputed(
+            org_id=org_id,
+            challenges=challenges,
+            team_analysis=team_analysis,
+            valid_for=valid_for,
+            expires_at=expires_at
+        )
     
     def _get_fallback_challenges(self, difficulty: str) -> List[Dict]:
         """Fallback челленджи если AI недоступен"""
@@ -0,0 +1,321 @@
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from config import load_config
+from database import get_session, User
+
+logger = logging.getLogger(__name__)
+
+# Состояния circuit breaker
+STATE_CLOSED = "closed"  # Запросы идут как обычно
+STATE_OPEN = "open"  # Бэкенд считается недоступным, сразу отдаем fallback
+STATE_HALF_OPEN = "half_open"  # Пробный запрос: проверяем, ожил ли бэкенд
+
+# Причины недоступности AI
+REASON_CIRCUIT_OPEN = "circuit_open"
+REASON_QUOTA = "quota_exceeded"
+REASON_BUDGET = "budget_exceeded"
+
+
+class AIUnavailableError(Exception):
+    """Запрос к модели не выполнялся: breaker открыт или бюджет исчерпан"""
+
+    messages = {
+        REASON_CIRCUIT_OPEN: "🤖 AI временно недоступен. Попробуйте через несколько минут.",
+        REASON_QUOTA: "🤖 Квота AI запросов исчерпана. Попробуйте позже или обратитесь к администратору.",
+        REASON_BUDGET: "🤖 Дневной лимит AI запросов исчерпан. Попробуйте завтра.",
+    }
+
+    def __init__(self, reason: str, detail: str = ""):
+        super().__init__(detail or reason)
+        self.reason = reason
+
+    @property
+    def user_message(self) -> str:
+        return self.messages.get(self.reason, self.messages[REASON_CIRCUIT_OPEN])
+
+
+class CircuitBreaker:
+    """Circuit breaker для AI API по доле ошибок и медленных ответов
+
+    - closed: считаем исходы запросов за последние window_seconds; если их
+      не меньше min_calls и доля ошибок или медленных ответов превысила
+      порог, breaker открывается;
+    - open: запросы не выполняются, пользователи сразу получают fallback;
+    - half_open: после паузы пропускается один пробный запрос; успех
+      закрывает breaker, ошибка снова открывает его на вдвое большее время.
+
+    402 (квота) и 429 с Retry-After открывают breaker сразу на указанное время.
+    """
+
+    def __init__(self, window_seconds: float = 60.0, min_calls: int = 5,
+                 failure_rate: float = 0.5, slow_call_seconds: float = 10.0,
+                 open_seconds: float = 30.0, max_open_seconds: float = 600.0,
+                 quota_open_seconds: float = 900.0):
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.quota_open_seconds = quota_open_seconds
+
+        self.state = STATE_CLOSED
+        self.reason: Optional[str] = None
+        self.opened_until = 0.0
+        self._current_open_seconds = open_seconds
+        self._probe: Optional[object] = None  # Токен пробного запроса в half_open
+        # (время, успех, медленный)
+        self._outcomes: Deque[Tuple[float, bool, bool]] = deque()
+        self.stats = {"opened": 0, "rejected": 0, "failures": 0, "successes": 0}
+
+    @property
+    def is_open(self) -> bool:
+        """Breaker открыт и пауза еще не прошла (без побочных эффектов)"""
+        return self.state == STATE_OPEN and time.monotonic() < self.opened_until
+
+    def allow_request(self) -> Tuple[bool, Optional[object]]:
+        """Можно ли выполнить запрос сейчас: (разрешен, токен пробного запроса)
+
+        Токен получает единственный запрос, пропущенный в half_open: только
+        он может начаться до закрытия breaker и только его отмена
+        освобождает пробный слот.
+        """
+        if self.state == STATE_OPEN:
+            if time.monotonic() < self.opened_until:
+                self.stats["rejected"] += 1
+                return False, None
+            self.state = STATE_HALF_OPEN
+            logger.info("🟡 AI breaker: пробный запрос после паузы")
+
+        if self.state == STATE_HALF_OPEN:
+            if self._probe is not None:
+                self.stats["rejected"] += 1
+                return False, None
+            self._probe = object()
+            return True, self._probe
+
+        return True, None
+
+    def can_start(self, probe: Optional[object] = None) -> bool:
+        """Может ли допущенный запрос начаться после ожидания в очереди
+
+        Пока запрос ждал, breaker мог открыться и снова дойти до half_open:
+        тогда к бэкенду идет только владелец пробного слота.
+        """
+        if self.state == STATE_CLOSED or (probe is not None and probe is self._probe):
+            return True
+        self.stats["rejected"] += 1
+        return False
+
+    def record_success(self, latency: float):
+        self.stats["successes"] += 1
+        if self.state == STATE_HALF_OPEN:
+            self._close()
+            return
+        self._record(True, latency)
+
+    def record_failure(self, latency: float = 0.0):
+        self.stats["failures"] += 1
+        if self.state == STATE_HALF_OPEN:
+            # Бэкенд еще не ожил - ждем дольше
+            self._open(min(self._current_open_seconds * 2, self.max_open_seconds), REASON_CIRCUIT_OPEN)
+            return
+        self._record(False, latency)
+
+    def record_cancelled(self, probe: Optional[object] = None):
+        """Запрос отменен до ответа: пробный слот освобождается, если он был у этого запроса"""
+        if probe is not None and probe is self._probe:
+            self._probe = None
+
+    def trip(self, seconds: Optional[float] = None, reason: str = REASON_CIRCUIT_OPEN):
+        """Открыть breaker сразу (квота, 429 с Retry-After)"""
+        self._open(seconds if seconds is not None else self.open_seconds, reason)
+
+    def reset(self):
+        self._close()
+
+    def _record(self, ok: bool, latency: float):
+        now = time.monotonic()
+        self._outcomes.append((now, ok, latency >= self.slow_call_seconds))
+        while self._outcomes and self._outcomes[0][0] < now - self.window_seconds:
+            self._outcomes.popleft()
+
+        if self.state != STATE_CLOSED or len(self._outcomes) < self.min_calls:
+            return
+
+        total = len(self._outcomes)
+        failures = sum(1 for _, success, _ in self._outcomes if not success)
+        slow = sum(1 for _, _, is_slow in self._outcomes if is_slow)
+        if failures / total >= self.failure_rate or slow / total >= self.failure_rate:
+            logger.warning(
+                f"AI breaker: {failures}/{total} ошибок, {slow}/{total} медленных ответов за "
+                f"{self.window_seconds:.0f} с"
+            )
+            self._open(self.open_seconds, REASON_CIRCUIT_OPEN)
+
+    def _open(self, seconds: float, reason: str):
+        self.state = STATE_OPEN
+        self.reason = reason
+        self._current_open_seconds = seconds
+        self.opened_until = time.monotonic() + seconds
+        self._probe = None
+        self._outcomes.clear()
+        self.stats["opened"] += 1
+        logger.warning(f"🔴 AI breaker открыт на {seconds:.0f} с ({reason})")
+
+    def _close(self):
+        if self.state != STATE_CLOSED:
+            logger.info("🟢 AI breaker закрыт, запросы к AI возобновлены")
+        self.state = STATE_CLOSED
+        self.reason = None
+        self._current_open_seconds = self.open_seconds
+        self._probe = None
+        self._outcomes.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "state": self.state,
+            "reason": self.reason,
+            "open_for": max(self.opened_until - time.monotonic(), 0.0) if self.state == STATE_OPEN else 0.0,
+        }
+
+
+class RollingCounter:
+    """Запросы и токены за последние 24 часа (почасовые корзины)"""
+
+    buckets = 24
+
+    def __init__(self):
+        self._hours: Dict[int, list] = {}
+
+    @staticmethod
+    def _hour() -> int:
+        return int(time.time() // 3600)
+
+    def add(self, requests: int = 0, tokens: int = 0):
+        hour = self._hour()
+        bucket = self._hours.setdefault(hour, [0, 0])
+        bucket[0] += requests
+        bucket[1] += tokens
+        # Старые корзины больше не нужны
+        for old in [h for h in self._hours if h <= hour - self.buckets]:
+            del self._hours[old]
+
+    def totals(self) -> Tuple[int, int]:
+        since = self._hour() - self.buckets
+        requests = tokens = 0
+        for hour, (bucket_requests, bucket_tokens) in self._hours.items():
+            if hour > since:
+                requests += bucket_requests
+                tokens += bucket_tokens
+        return requests, tokens
+
+
+class AIBudget:
+    """Скользящий суточный бюджет запросов и токенов: общий и на организацию
+
+    Лимит 0 означает "без ограничения". Счетчики хранятся в памяти процесса.
+    """
+
+    def __init__(self, daily_requests: int = 0, daily_tokens: int = 0,
+                 org_daily_requests: int = 0, org_daily_tokens: int = 0):
+        self.daily_requests = daily_requests
+        self.daily_tokens = daily_tokens
+        self.org_daily_requests = org_daily_requests
+        self.org_daily_tokens = org_daily_tokens
+        self._total = RollingCounter()
+        self._orgs: Dict[int, RollingCounter] = {}
+
+    @staticmethod
+    def _exceeded(counter: RollingCounter, max_requests: int, max_tokens: int) -> bool:
+        requests, tokens = counter.totals()
+        return (max_requests and requests >= max_requests) or (max_tokens and tokens >= max_tokens)
+
+    def global_exhausted(self) -> bool:
+        return bool(self._exceeded(self._total, self.daily_requests, self.daily_tokens))
+
+    def check(self, org_id: Optional[int]):
+        """Проверить бюджет перед запросом (AIUnavailableError, если исчерпан)"""
+        if self.global_exhausted():
+            raise AIUnavailableError(REASON_BUDGET, "Суточный бюджет AI исчерпан")
+        if org_id is not None and org_id in self._orgs and self._exceeded(
+            self._orgs[org_id], self.org_daily_requests, self.org_daily_tokens
+        ):
+            raise AIUnavailableError(REASON_BUDGET, f"Суточный бюджет AI организации {org_id} исчерпан")
+
+    def record(self, org_id: Optional[int], tokens: int):
+        self._total.add(requests=1, tokens=tokens)
+        if org_id is not None:
+            self._orgs.setdefault(org_id, RollingCounter()).add(requests=1, tokens=tokens)
+
+    def get_stats(self) -> Dict[str, Any]:
+        requests, tokens = self._total.totals()
+        return {
+            "requests": requests,
+            "tokens": tokens,
+            "daily_requests": self.daily_requests,
+            "daily_tokens": self.daily_tokens,
+            "orgs": {org_id: counter.totals() for org_id, counter in self._orgs.items()},
+        }
+
+
+# Организация пользователя для бюджета; кэш, чтобы не ходить в БД на каждый запрос
+_ORG_CACHE_TTL_SECONDS = 600
+_user_orgs: Dict[int, Tuple[Optional[int], float]] = {}
+
+
+def resolve_org_id(user_id: Optional[int]) -> Optional[int]:
+    """org_id пользователя Telegram (None, если пользователь неизвестен)"""
+    if user_id is None:
+        return None
+
+    now = time.monotonic()
+    cached = _user_orgs.get(user_id)
+    if cached and now - cached[1] < _ORG_CACHE_TTL_SECONDS:
+        return cached[0]
+
+    session = get_session()
+    try:
+        org_id = session.query(User.org_id).filter(User.user_id == user_id).scalar()
+    except Exception as e:
+        logger.warning(f"Не удалось определить организацию пользователя {user_id}: {e}")
+        org_id = None
+    finally:
+        session.close()
+
+    if len(_user_orgs) > 10000:
+        _user_orgs.clear()
+    _user_orgs[user_id] = (org_id, now)
+    return org_id
+
+
+ai_breaker: Optional[CircuitBreaker] = None
+ai_budget: Optional[AIBudget] = None
+
+def get_ai_breaker() -> CircuitBreaker:
+    """Общий circuit breaker AI API (создается при первом обращении)"""
+    global ai_breaker
+    if ai_breaker is None:
+        config = load_config()
+        ai_breaker = CircuitBreaker(
+            slow_call_seconds=config.ai_slow_call_seconds,
+            open_seconds=config.ai_breaker_open_seconds
+        )
+    return ai_breaker
+
+def get_ai_budget() -> AIBudget:
+    """Общий бюджет AI-запросов (создается при первом обращении)"""
+    global ai_budget
+    if ai_budget is None:
+        config = load_config()
+        ai_budget = AIBudget(
+            daily_requests=config.ai_daily_request_budget,
+            daily_tokens=config.ai_daily_token_budget,
+            org_daily_requests=config.ai_org_daily_request_budget,
+            org_daily_tokens=config.ai_org_daily_token_budget
+        )
+    return ai_budget
@@ -2,16 +2,51 @@
 AI Helper - вспомогательный сервис для работы с AI функциями
 """
 
+import asyncio
 import logging
+import time
 from typing import Dict, List, Optional, Any
 from datetime import datetime
 
+from config import load_config
+from services.ai_scheduler import AIPriority, ai_request_context
+from services.fanout import fan_out
+
 logger = logging.getLogger(__name__)
 
 
 class AIHelper:
     """Вспомогательный класс для AI операций"""
     
+    # Задачи, которые умеют обрабатывать несколько текстов одним запросом:
+    # что сделать с каждым текстом и какие поля вернуть
+    BATCH_TASKS = {
+        "sentiment": (
+            "Проанализируй настроение каждого текста",
+            '"sentiment": "positive/negative/neutral", "confidence": 0-1, '
+            '"keywords": ["ключевое слово 1", "ключевое слово 2"], "summary": "Краткое резюме настроения"'
+        ),
+        "keywords": (
+            "Извлеки до 5 ключевых слов из каждого текста",
+            '"keywords": ["слово1", "слово2"]'
+        ),
+        "categorize": (
+            "Определи категорию каждого сообщения. Возможные категории: "
+            "question, feedback, complaint, suggestion, greeting, farewell, "
+            "challenge_related, progress_related, other",
+            '"category": "название категории", "confidence": 0-1, '
+            '"urgency": "low/medium/high", "needs_response": true/false'
+        ),
+    }
+    
+    # Ответ на пакетный запрос: результат для каждого пронумерованного текста
+    PACKED_SCHEMA = {"results": [{"index": (int, str)}]}
+    
+    CATEGORIES = {
+        "question", "feedback", "complaint", "suggestion", "greeting", "farewell",
+        "challenge_related", "progress_related", "other"
+    }
+    
     def __init__(self, ai_service):
         """
         Args:
@@ -213,7 +248,7 @@ class AIHelper:
             }}
             """
             
-            response = await self.ai_service.get_json_response(prompt)
+            response = await self.ai_service.get_json_response(prompt, schema={"keywords": [str]})
             
             if "error" in response or "keywords" not in response:
                 # Fallback: простой список слов
@@ -373,46 +408,149 @@ class AIHelper:
     async def batch_process(
         self, 
         items: List[str], 
-        process_type: str
+        process_type: str,
+        chunk_size: Optional[int] = None,
+        concurrency: Optional[int] = None,
+        item_timeout: Optional[float] = None
     ) -> List[Dict[str, Any]]:
         """
         Пакетная обработка элементов
         
+        Тексты упаковываются по chunk_size в один запрос к модели, запросы
+        идут параллельно (не больше concurrency одновременно). Элементы,
+        которых нет в ответе пакета или которые не прошли проверку,
+        обрабатываются отдельными запросами. Запрос дольше item_timeout
+        секунд считается неудачным.
+        
         Args:
             items: Список элементов
-            process_type: Тип обработки
+            process_type: Тип обработки (sentiment, keywords, categorize)
+            chunk_size: Сколько элементов отправлять в одном запросе
+            concurrency: Максимум одновременных запросов
+            item_timeout: Таймаут одного запроса в секундах
         
         Returns:
-            Результаты обработки
+            Результаты обработки в порядке items; у неудачных success=False
         """
-        results = []
+        if process_type not in self.BATCH_TASKS:
+            return [
+                {"item": item, "result": {"processed": item, "type": process_type}, "success": True}
+                for item in items
+            ]
         
-        for item in items:
-            try:
-                if process_type == "sentiment":
-                    result = await self.analyze_text_sentiment(item)
-                elif process_type == "keywords":
-                    keywords = await self.extract_keywords(item)
-                    result = {"keywords": keywords}
-                elif process_type == "categorize":
-                    result = await self.categorize_message(item)
+        config = load_config()
+        chunk_size = chunk_size or config.ai_batch_chunk_size
+        concurrency = concurrency or config.ai_batch_concurrency
+        item_timeout = item_timeout or config.ai_batch_item_timeout
+        started = time.monotonic()
+        results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+        
+        with ai_request_context(AIPriority.REPORT):
+            if chunk_size > 1 and len(items) > 1:
+                chunks = [list(range(i, min(i + chunk_size, len(items)))) for i in range(0, len(items), chunk_size)]
+                outcomes = await fan_out(
+                    chunks,
+                    lambda chunk: asyncio.wait_for(self._process_packed(items, chunk, process_type), item_timeout),
+                    concurrency=concurrency
+                )
+                for outcome in outcomes:
+                    if not outcome.ok:
+                        logger.warning(f"Пакет из {len(outcome.item)} элементов не обработан: {outcome.error!r}")
+                        continue
+                    for index, result in outcome.result.items():
+                        results[index] = {"item": items[index], "result": result, "success": True}
+            
+            # Что не удалось упаковать - по одному элементу за запрос
+            missing = [index for index, result in enumerate(results) if result is None]
+            outcomes = await fan_out(
+                missing,
+                lambda index: asyncio.wait_for(self._process_single(items[index], process_type), item_timeout),
+                concurrency=concurrency
+            )
+            for outcome in outcomes:
+                if outcome.ok:
+                    result = {"item": items[outcome.item], "result": outcome.result, "success": True}
                 else:
-                    result = {"processed": item, "type": process_type}
-                
-                results.append({
-                    "item": item,
-                    "result": result,
-                    "success": True
-                })
-                
-            except Exception as e:
-                results.append({
-                    "item": item,
-                    "result": {"error": str(e)},
-                    "success": False
-                })
+                    error = "timeout" if isinstance(outcome.error, asyncio.TimeoutError) else str(outcome.error)
+                    result = {"item": items[outcome.item], "result": {"error": error}, "success": False}
+                results[outcome.item] = result
         
+        failed = sum(1 for result in results if not result["success"])
+        logger.info(
+            f"Пакетная обработка {process_type}: {len(items) - failed}/{len(items)} успешно, "
+            f"отдельных запросов {len(missing)}, за {time.monotonic() - started:.1f} с"
+        )
         return results
+    
+    async def _process_packed(self, items: List[str], indexes: List[int], process_type: str) -> Dict[int, Any]:
+        """Обработать несколько элементов одним запросом: {индекс: результат}"""
+        instruction, fields = self.BATCH_TASKS[process_type]
+        texts = "\n".join(f'[{number}] "{items[index]}"' for number, index in enumerate(indexes, 1))
+        prompt = f"""
+            {instruction}. Тексты пронумерованы:
+            
+            {texts}
+            
+            Верни JSON с результатом для каждого текста, index - номер текста:
+            {{
+                "results": [{{"index": 1, {fields}}}]
+            }}
+            """
+        
+        response = await self.ai_service.get_json_response(prompt, schema=self.PACKED_SCHEMA)
+        if not isinstance(response, dict) or "error" in response:
+            logger.warning(f"Пакетный запрос {process_type} не удался: {response}")
+            return {}
+        
+        packed = {}
+        for entry in response.get("results", []):
+            if not isinstance(entry, dict):
+                continue
+            try:
+                number = int(entry.get("index"))
+            except (TypeError, ValueError):
+                continue
+            if not 1 <= number <= len(indexes):
+                continue
+            result = self._validate_batch_result(process_type, entry)
+            if result is not None:
+                packed[indexes[number - 1]] = result
+        return packed
+    
+    def _validate_batch_result(self, process_type: str, entry: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Результат для одного текста из пакетного ответа (None, если он некорректен)"""
+        if process_type == "sentiment":
+            if entry.get("sentiment") not in ("positive", "negative", "neutral"):
+                return None
+            return {
+                "sentiment": entry["sentiment"],
+                "confidence": entry.get("confidence", 0.5),
+                "keywords": entry.get("keywords", []),
+                "summary": entry.get("summary", "")
+            }
+        if process_type == "keywords":
+            keywords = entry.get("keywords")
+            if not isinstance(keywords, list):
+                return None
+            return {"keywords": [str(keyword) for keyword in keywords][:5]}
+        if process_type == "categorize":
+            if entry.get("category") not in self.CATEGORIES:
+                return None
+            return {
+                "category": entry["category"],
+                "confidence": entry.get("confidence", 0.5),
+                "urgency": entry.get("urgency", "low"),
+                "needs_response": entry.get("needs_response", True)
+            }
+        return None
+    
+    async def _process_single(self, item: str, process_type: str) -> Dict[str, Any]:
+        """Обработать один элемент отдельным запросом"""
+        if process_type == "sentiment":
+            return await self.analyze_text_sentiment(item)
+        if process_type == "keywords":
+            return {"keywords": await self.extract_keywords(item)}
+        return await self.categorize_message(item)
 
 
 # Создаем глобальный экземпляр (будет инициализирован позже)
@@ -3,18 +3,26 @@ from typing import Dict, List, Optional
 from datetime import datetime, timedelta
 import json
 import traceback
+from sqlalchemy import func
 
 from io import BytesIO
 from services.report_formatter import ReportFormatter
 from services.ai_service import AIService
 from services.metrics_analyzer import ProffKonstaltingMetrics
 from database import get_session, User, Organization, Challenge, Survey, MetricsSurvey
+from services.ai_scheduler import AIPriority, ai_request_context
+from services.prompt_builder import PromptBuilder
 
 logger = logging.getLogger(__name__)
 
 class AIReportAnalyzer:
     """AI-анализатор для генерации умных отчетов"""
     
+    # Обязательные поля AI-анализа в ответах модели
+    DAILY_SCHEMA = {"executive_summary": str, "team_mood": str, "ai_recommendations?": [dict]}
+    MEMBER_SCHEMA = {"player_summary": str, "strengths": [str], "personal_recommendations": [str]}
+    TEAM_SCHEMA = {"team_assessment": str}
+    
     def __init__(self):
         self.ai_service = AIService()
         logger.info("AIReportAnalyzer инициализирован")
@@ -77,7 +85,6 @@ class AIReportAnalyzer:
                             challenges_today.append(challenge)
 
                     # Получаем опросы пользователя за сегодня с правильной фильтрацией по времени
-                    from sqlalchemy import func
                     surveys_today = session.query(Survey).filter(
                         Survey.user_id == user.id,
                         func.date(Survey.date) == today
@@ -152,8 +159,23 @@ class AIReportAnalyzer:
             
             logger.info(f"Данные для отчета собраны: {daily_stats}")
             
-            # Генерируем AI-анализ
-            prompt = f"""
+            # Генерируем AI-анализ: списки игроков передаем компактными строками,
+            # длинный список неактивных сворачиваем в итог, чтобы промпт не рос с командой
+            prompt_builder = PromptBuilder("daily_report")
+            prompt_builder.add_list(
+                "top_performers", report_data['top_performers'], self._format_player,
+                priority=2, min_items=1
+            )
+            prompt_builder.add_list(
+                "needs_attention",
+                sorted(report_data['needs_attention'], key=self._attention_rank),
+                self._format_player,
+                priority=1,
+                limit=15,
+                summarize=lambda rest: self._summarize_players(rest, "неактивных игроков"),
+                empty="все игроки активны"
+            )
+            prompt = prompt_builder.render(f"""
             Ты спортивный аналитик команды. Проанализируй ежедневный отчет.
             
             ДАННЫЕ КОМАНДЫ "{report_data['org_name']}" за {report_data['date']}:
@@ -167,10 +189,10 @@ class AIReportAnalyzer:
             Средняя готовность: {report_data['team_overview']['avg_readiness']:.1f}
             
             ЛУЧШИЕ ИГРОКИ СЕГОДНЯ:
-            {report_data['top_performers']}
+            {prompt_builder.slot('top_performers')}
             
             ТРЕБУЮТ ВНИМАНИЯ (не активны сегодня):
-            {report_data['needs_attention']}
+            {prompt_builder.slot('needs_attention')}
             
             СОЗДАЙ АНАЛИТИЧЕСКИЙ ОТЧЕТ ВКЛЮЧАЮЩИЙ:
             1. Краткое резюме дня (2-3 предложения)
@@ -194,11 +216,12 @@ class AIReportAnalyzer:
             }}
             
             ВАЖНО: Ответ должен быть ТОЛЬКО JSON, без дополнительного текста.
-            """
+            """)
             
             try:
                 # Используем get_json_response вместо answer_user_question
-                analysis = await self.ai_service.get_json_response(prompt)
+                with ai_request_context(AIPriority.REPORT, org_id=org_id):
+                    analysis = await self.ai_service.get_json_response(prompt, schema=self.DAILY_SCHEMA)
                 
                 if "error" in analysis:
                     logger.error(f"Ошибка AI-анализа: {analysis['error']}")
@@ -226,6 +249,51 @@ class AIReportAnalyzer:
         finally:
             session.close()
     
+    @staticmethod
+    def _format_player(player: Dict) -> str:
+        """Строка об игроке для промпта"""
+        line = (
+            f"- {player.get('name', 'Неизвестно')}: уровень {player.get('level', 1)}, "
+            f"очки {player.get('points', 0)}, сегодня +{player.get('points_today', 0)} "
+            f"(челленджей {player.get('challenges_today', 0)}, опросов {player.get('surveys_today', 0)})"
+        )
+        if player.get("energy") is not None:
+            line += f", энергия {player['energy']}"
+        if player.get("readiness") is not None:
+            line += f", готовность {player['readiness']}"
+        return line
+
+    @staticmethod
+    def _format_metric(metric) -> str:
+        """Строка о результате метрики для промпта"""
+        metric_key, metric_result = metric
+        if isinstance(metric_result, dict):
+            score = metric_result.get('score', 0)
+            interpretation = metric_result.get('interpretation', 'Нет данных')
+            return f"- {metric_result.get('name', metric_key)}: {score} - {interpretation}"
+        return f"- {metric_key}: {metric_result}"
+
+    @staticmethod
+    def _attention_rank(player: Dict):
+        """Первыми - игроки с самой низкой энергией и готовностью"""
+        energy = player.get("energy")
+        readiness = player.get("readiness")
+        return (
+            energy if energy is not None else float("inf"),
+            readiness if readiness is not None else float("inf"),
+            player.get("points", 0)
+        )
+
+    @staticmethod
+    def _summarize_players(players: List[Dict], label: str) -> str:
+        """Итог по игрокам, не попавшим в промпт"""
+        avg_points = sum(p.get('points', 0) or 0 for p in players) / len(players)
+        summary = f"… и еще {len(players)} {label}, средние очки {avg_points:.0f}"
+        energies = [p["energy"] for p in players if p.get("energy") is not None]
+        if energies:
+            summary += f", средняя энергия {sum(energies) / len(energies):.1f}"
+        return summary
+
     def _get_fallback_analysis(self, report_data: Dict) -> Dict:
         """Fallback анализ если AI недоступен"""
         return {
@@ -256,18 +324,18 @@ class AIReportAnalyzer:
             for user in users:
                 # Собираем статистику пользователя
                 try:
-                    challenges = session.query(Challenge).filter(
+                    # Челленджи считаем в БД, из опросов берем последние 5
+                    status_counts = dict(session.query(
+                        Challenge.status, func.count(Challenge.id)
+                    ).filter(
                         Challenge.user_id == user.user_id
-                    ).all()
+                    ).group_by(Challenge.status).all())
+                    total_challenges = sum(status_counts.values())
+                    completed_count = status_counts.get("COMPLETED", 0)
 
-                    surveys = session.query(Survey).filter(
+                    recent_surveys = session.query(Survey).filter(
                         Survey.user_id == user.id
-                    ).all()
-                    
-                    # Берем последние 5 опросов
-                    recent_surveys = surveys[-5:] if len(surveys) > 5 else surveys
-                    
-                    completed_challenges = [c for c in challenges if hasattr(c, 'status') and c.status == "COMPLETED"]
+                    ).order_by(Survey.id.desc()).limit(5).all()
                     
                     # Безопасно получаем энергию из опросов
                     total_energy = 0
@@ -281,8 +349,8 @@ class AIReportAnalyzer:
                     
                 except Exception as e:
                     logger.warning(f"Ошибка сбора данных для {user.name}: {e}")
-                    challenges = []
-                    completed_challenges = []
+                    total_challenges = 0
+                    completed_count = 0
                     avg_energy = 0
                     recent_surveys = []
                 
@@ -299,27 +367,24 @@ class AIReportAnalyzer:
                     "name": getattr(user, 'name', 'Неизвестно'),
                     "points": getattr(user, 'points', 0),
                     "level": getattr(user, 'level', 1),
-                    "total_challenges": len(challenges),
-                    "completed_challenges": len(completed_challenges),
-                    "completion_rate": (len(completed_challenges) / len(challenges) * 100) if challenges else 0,
+                    "total_challenges": total_challenges,
+                    "completed_challenges": completed_count,
+                    "completion_rate": (completed_count / total_challenges * 100) if total_challenges else 0,
                     "recent_surveys": len(recent_surveys),
                     "avg_energy": avg_energy,
                     "metrics_results": metrics_data
                 }
                 
                 # Формируем данные метрик для анализа
-                metrics_info = ""
-                if user_data['metrics_results']:
-                    metrics_info = "\nРЕЗУЛЬТАТЫ МЕТРИК ПРОФЕССИОНАЛЬНОГО РАЗВИТИЯ:\n"
-                    for metric_key, metric_result in user_data['metrics_results'].items():
-                        if isinstance(metric_result, dict):
-                            score = metric_result.get('score', 0)
-                            interpretation = metric_result.get('interpretation', 'Нет данных')
-                            metrics_info += f"- {metric_result.get('name', metric_key)}: {score} - {interpretation}\n"
-                        else:
-                            metrics_info += f"- {metric_key}: {metric_result}\n"
-
-                prompt = f"""
+                prompt_builder = PromptBuilder("member_report").add_list(
+                    "metrics_info",
+                    user_data['metrics_results'].items(),
+                    self._format_metric,
+                    max_item_chars=300,
+                    empty="Метрики профессионального развития не пройдены"
+                )
+
+                prompt = prompt_builder.render(f"""
                 Ты персональный тренер. Проанализируй данные игрока и результаты метрик профессионального развития.
 
                 ДАННЫЕ ИГРОКА {user_data['name']}:
@@ -328,7 +393,10 @@ class AIReportAnalyzer:
                 - Всего челленджей: {user_data['total_challenges']}
                 - Выполнено: {user_data['completed_challenges']}
                 - Процент выполнения: {user_data['completion_rate']:.1f}%
-                - Средняя энергия: {user_data['avg_energy']:.1f}{metrics_info}
+                - Средняя энергия: {user_data['avg_energy']:.1f}
+
+                РЕЗУЛЬТАТЫ МЕТРИК ПРОФЕССИОНАЛЬНОГО РАЗВИТИЯ:
+                {prompt_builder.slot('metrics_info')}
 
                 ДАЙ АНАЛИЗ ВКЛЮЧАЮЩИЙ:
                 1. Краткую характеристику игрока с учетом метрик
@@ -346,7 +414,7 @@ class AIReportAnalyzer:
                     "metrics_based_recommendations": ["рекомендация по метрике 1", "рекомендация по метрике 2"],
                     "motivational_note": "Мотивационное сообщение для игрока"
                 }}
-                """
+                """)
                 
                 # Fallback анализ по умолчанию
                 user_analysis = {
@@ -360,7 +428,8 @@ class AIReportAnalyzer:
                 
                 try:
                     # Используем get_json_response вместо answer_user_question
-                    ai_response = await self.ai_service.get_json_response(prompt)
+                    with ai_request_context(AIPriority.REPORT, org_id=org_id):
+                        ai_response = await self.ai_service.get_json_response(prompt, schema=self.MEMBER_SCHEMA)
                     if isinstance(ai_response, dict) and "error" not in ai_response:
                         user_analysis = ai_response
                 except Exception as e:
@@ -382,14 +451,16 @@ class AIReportAnalyzer:
             
             try:
                 # Генерируем общий анализ команды
-                team_prompt = f"""
+                # Итоги по выполненным челленджам уже посчитаны для каждого игрока
+                total_completed = sum(report["user_data"]["completed_challenges"] for report in member_reports)
+                team_prompt = PromptBuilder("team_report").render(f"""
                 Ты главный тренер. Проанализируй команду на основе данных игроков.
                 
                 ОБЩАЯ СТАТИСТИКА:
                 - Всего игроков: {len(users)}
                 - Средний уровень: {sum(getattr(u, 'level', 1) for u in users) / len(users):.1f}
                 - Средние очки: {sum(getattr(u, 'points', 0) for u in users) / len(users):.1f}
-                - Общее количество выполненных челленджей: {sum(len([c for c in session.query(Challenge).filter(Challenge.user_id == u.id).all() if hasattr(c, 'status') and c.status == "COMPLETED"]) for u in users)}
+                - Общее количество выполненных челленджей: {total_completed}
                 
                 ДАЙ ОБЩИЕ РЕКОМЕНДАЦИИ ДЛЯ КОМАНДЫ:
                 1. Общая оценка состояния команды
@@ -403,9 +474,10 @@ class AIReportAnalyzer:
                     "motivation_strategies": ["стратегия 1", "стратегия 2"],
                     "coach_notes": "Заметки для тренера"
                 }}
-                """
+                """)
                 
-                ai_response = await self.ai_service.get_json_response(team_prompt)
+                with ai_request_context(AIPriority.REPORT, org_id=org_id):
+                    ai_response = await self.ai_service.get_json_response(team_prompt, schema=self.TEAM_SCHEMA)
                 if isinstance(ai_response, dict) and "error" not in ai_response:
                     team_analysis.update(ai_response)  # Обновляем fallback значения
             except Exception as e:
@@ -738,7 +810,8 @@ class AIReportAnalyzer:
         """
 
         try:
-            ai_response = await self.ai_service.get_json_response(prompt)
+            with ai_request_context(AIPriority.REPORT):
+                ai_response = await self.ai_service.get_json_response(prompt)
             if isinstance(ai_response, dict) and "error" not in ai_response:
                 return ai_response
             else:
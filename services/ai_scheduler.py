@@ -0,0 +1,222 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from config import load_config
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class AIPriority(IntEnum):
+    """Приоритеты запросов к модели (меньше - важнее)"""
+    INTERACTIVE = 0  # Чат с пользователем: вопросы AI-помощнику
+    SCORING = 1  # Оценка и анализ опросов
+    REPORT = 2  # Отчеты тренеров и администраторов
+    BACKGROUND = 3  # Фоновая генерация: челленджи, мотивационные фразы
+
+
+# Контекст текущего запроса: приоритет задает сервис, пользователя - мидлварь
+_priority_var: ContextVar[Optional[AIPriority]] = ContextVar("ai_priority", default=None)
+_user_var: ContextVar[Optional[int]] = ContextVar("ai_user_id", default=None)
+_org_var: ContextVar[Optional[int]] = ContextVar("ai_org_id", default=None)
+
+
+@contextmanager
+def ai_request_context(priority: Optional[AIPriority] = None, user_id: Optional[int] = None,
+                       org_id: Optional[int] = None):
+    """Задать приоритет, пользователя и/или организацию для AI-запросов внутри блока"""
+    tokens = []
+    if priority is not None:
+        tokens.append((_priority_var, _priority_var.set(priority)))
+    if user_id is not None:
+        tokens.append((_user_var, _user_var.set(user_id)))
+    if org_id is not None:
+        tokens.append((_org_var, _org_var.set(org_id)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def set_ai_user(user_id: Optional[int]):
+    """Запомнить пользователя, от имени которого идут AI-запросы (до конца задачи)"""
+    _user_var.set(user_id)
+
+
+def current_ai_user() -> Optional[int]:
+    return _user_var.get()
+
+
+def current_ai_org() -> Optional[int]:
+    return _org_var.get()
+
+
+class AIScheduler:
+    """Очередь запросов к AI API с общим лимитом одновременных вызовов
+
+    - Одновременно к модели уходит не больше max_concurrency запросов,
+      остальные ждут в очереди, а не получают 429 все вместе;
+    - ожидающие обслуживаются по приоритету: чат важнее оценки опросов,
+      оценка - отчетов, отчеты - фоновой генерации;
+    - внутри приоритета пользователи чередуются (справедливая очередь),
+      поэтому тренер с отчетом на всю команду не занимает все слоты;
+    - для каждого приоритета считаются глубина очереди и время ожидания.
+    """
+
+    def __init__(self, max_concurrency: int = None):
+        self.max_concurrency = max_concurrency or load_config().ai_max_concurrency
+        self._in_flight = 0
+        self._waiters: List[Tuple[int, float, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._virtual_time: Dict[AIPriority, float] = {priority: 0.0 for priority in AIPriority}
+        self._last_finish: Dict[Tuple[AIPriority, Any], float] = {}
+        self.stats = {
+            priority.name: {
+                "completed": 0,
+                "failed": 0,
+                "avg_wait": None,
+                "max_wait": 0.0,
+                "last_wait": None,
+            }
+            for priority in AIPriority
+        }
+
+    async def run(self, factory: Callable[[], Awaitable[T]],
+                  priority: Optional[AIPriority] = None,
+                  user_id: Optional[int] = None) -> T:
+        """Выполнить запрос к модели, когда до него дойдет очередь
+
+        Args:
+            factory: Функция, создающая корутину запроса (вызывается после ожидания)
+            priority: Приоритет; по умолчанию берется из ai_request_context
+            user_id: Пользователь; по умолчанию берется из контекста
+        """
+        async with self.slot(priority, user_id):
+            return await factory()
+
+    @asynccontextmanager
+    async def slot(self, priority: Optional[AIPriority] = None,
+                   user_id: Optional[int] = None) -> AsyncIterator[None]:
+        """Занять слот на все время блока (потоковый ответ держит его до конца)"""
+        if priority is None:
+            priority = _priority_var.get()
+        if priority is None:
+            # Запрос без явного приоритета пришел из обработчика пользователя
+            priority = AIPriority.INTERACTIVE
+        if user_id is None:
+            user_id = _user_var.get()
+
+        queued_at = time.monotonic()
+        await self._acquire(AIPriority(priority), user_id)
+        self._record_wait(AIPriority(priority), time.monotonic() - queued_at)
+
+        stats = self.stats[AIPriority(priority).name]
+        try:
+            yield
+            stats["completed"] += 1
+        except Exception:
+            stats["failed"] += 1
+            raise
+        finally:
+            self._release()
+
+    async def _acquire(self, priority: AIPriority, user_id: Optional[int]):
+        tag = self._assign_finish_tag(priority, user_id)
+
+        if self._in_flight < self.max_concurrency and not self._has_waiters():
+            self._in_flight += 1
+            self._virtual_time[priority] = max(self._virtual_time[priority], tag)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, tag, next(self._sequence), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Слот уже выдан, но задача отменена - отдаем его следующему
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        self._in_flight -= 1
+        while self._waiters:
+            priority, tag, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                # Ожидавший запрос отменен
+                continue
+            self._in_flight += 1
+            self._virtual_time[priority] = max(self._virtual_time[priority], tag)
+            future.set_result(None)
+            break
+        self._forget_idle_users()
+
+    def _has_waiters(self) -> bool:
+        return any(not future.done() for *_, future in self._waiters)
+
+    def _assign_finish_tag(self, priority: AIPriority, user_id: Optional[int]) -> float:
+        # Запросы без пользователя (фоновые задачи) делят один поток
+        flow = (priority, user_id)
+        start = max(self._virtual_time[priority], self._last_finish.get(flow, 0.0))
+        self._last_finish[flow] = start + 1.0
+        return start + 1.0
+
+    def _forget_idle_users(self):
+        if len(self._last_finish) < 10000:
+            return
+        self._last_finish = {
+            flow: finish
+            for flow, finish in self._last_finish.items()
+            if finish > self._virtual_time[flow[0]]
+        }
+
+    def _record_wait(self, priority: AIPriority, wait: float):
+        stats = self.stats[priority.name]
+        stats["last_wait"] = wait
+        stats["max_wait"] = max(stats["max_wait"], wait)
+        if stats["avg_wait"] is None:
+            stats["avg_wait"] = wait
+        else:
+            # Скользящее среднее, чтобы недавние запросы весили больше
+            stats["avg_wait"] = stats["avg_wait"] * 0.8 + wait * 0.2
+        if wait > 10:
+            logger.warning(f"🐢 AI-запрос ({priority.name}) ждал в очереди {wait:.1f} с")
+
+    def queue_depth(self) -> Dict[str, int]:
+        """Сколько запросов ждет в очереди по каждому приоритету"""
+        depth = {priority.name: 0 for priority in AIPriority}
+        for priority, _, _, future in self._waiters:
+            if not future.done():
+                depth[AIPriority(priority).name] += 1
+        return depth
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Состояние очереди: запросы в работе, глубина и ожидание по приоритетам"""
+        depth = self.queue_depth()
+        return {
+            "in_flight": self._in_flight,
+            "max_concurrency": self.max_concurrency,
+            "priorities": {
+                name: {**stats, "queued": depth[name]}
+                for name, stats in self.stats.items()
+            },
+        }
+
+
+ai_scheduler: Optional[AIScheduler] = None
+
+def get_ai_scheduler() -> AIScheduler:
+    """Общий планировщик AI-запросов (создается при первом обращении)"""
+    global ai_scheduler
+    if ai_scheduler is None:
+        ai_scheduler = AIScheduler()
+    return ai_scheduler
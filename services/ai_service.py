@@ -3,19 +3,33 @@ import openai
 import json
 import logging
 import asyncio
-from typing import Dict, List, Optional, Any
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
 from functools import lru_cache
 import hashlib
 
 from database import User, Challenge, Survey, Organization, get_session
 from config import load_config
+from services.ai_guard import AIUnavailableError
+from services.ai_scheduler import AIPriority, ai_request_context
+from services.json_output import parse_json_response
+from services.motivation_pool import motivation_pool
+from services.prompt_builder import PromptBuilder
+from utils.motivation import MotivationSystem
 
 logger = logging.getLogger(__name__)
 
 class AIService:
     """Фасад для AI сервисов"""
 
+    # Запросы к модели, которые выполняются прямо сейчас (ключ -> задача).
+    # Общие для всех экземпляров: обработчики и планировщики создают свои AIService
+    _in_flight: Dict[str, asyncio.Task] = {}
+    single_flight_stats = {"calls": 0, "coalesced": 0}
+
+    # Обязательные поля персонального челленджа в ответе модели
+    CHALLENGE_SCHEMA = {"text": str, "points": object, "difficulty": str, "estimated_time": str}
+
     def __init__(self):
         self.client = None  # Добавляем инициализацию client
         self.is_active = False
@@ -57,13 +71,13 @@ class AIService:
         
         return await self.hf_service.answer_question(question, context)
     
-    async def get_json_response(self, prompt: str) -> Dict:
-        """Получение JSON ответа"""
+    async def get_json_response(self, prompt: str, schema: Any = None) -> Dict:
+        """Получение JSON ответа (schema - ожидаемая структура, см. validate_json)"""
         if not self.is_active or not self.hf_service:
             return {"error": "AI сервис недоступен"}
 
         try:
-            return await self.hf_service.get_json_response(prompt)
+            return await self.hf_service.get_json_response(prompt, schema=schema)
         except Exception as e:
             logger.error(f"Ошибка в get_json_response: {e}")
             return {"error": f"Ошибка AI сервиса: {str(e)[:100]}"}
@@ -71,18 +85,60 @@ class AIService:
 
     
     async def get_motivation_phrase(self, user_id: int = None, context: Dict = None) -> str:
-        """Получение мотивационной фразы"""
-        if not self.is_active or not self.hf_service:
-            return "Каждый шаг имеет значение. Начни свой путь к успеху сегодня! 🚀"
+        """Получение мотивационной фразы
         
-        situation = context.get("situation", "general") if context else "general"
-        prompt = f"Создай короткую мотивационную фразу для ситуации: {situation}. Фраза должна быть на русском с 1-2 эмодзи."
+        Фраза берется из пула, который заранее пополняет фоновая задача,
+        поэтому пользователь не ждет модель. Если пул пуст, отдается фраза
+        из статического списка MotivationSystem.
+        """
+        context = context or {}
+        phrase = await motivation_pool.take(context.get("situation"))
+        if phrase:
+            return phrase
+        
+        return await MotivationSystem.get_motivation(
+            context.get("user_level", 1), context.get("direction", "growth")
+        )
+    
+    async def generate_motivation_phrases(self, situation: str, count: int) -> List[str]:
+        """Сгенерировать несколько мотивационных фраз одним запросом (для пула)"""
+        if not self.is_active or not self.hf_service or self.hf_service.quota_exceeded:
+            return []
+        
+        prompt = (
+            f"Создай {count} разных коротких мотивационных фраз для ситуации: {situation}. "
+            f"Каждая фраза на русском языке, до 150 символов, с 1-2 эмодзи. "
+            f'Верни JSON: {{"phrases": ["фраза 1", "фраза 2"]}}'
+        )
         
         try:
-            return await self.hf_service.generate_response(prompt, 
-                system_prompt="Ты мастер мотивационных речей.")
-        except:
-            return "Ты делаешь отличную работу! Продолжай двигаться вперед! 🔥"
+            with ai_request_context(AIPriority.BACKGROUND):
+                response = await self.hf_service.create_completion(
+                    model=self._get_model("motivation"),
+                    messages=[
+                        {"role": "system", "content": "Ты мастер мотивационных речей."},
+                        {"role": "user", "content": prompt}
+                    ],
+                    temperature=0.9,
+                    max_tokens=150 + count * 60,
+                    response_format={"type": "json_object"}
+                )
+            result, problem = parse_json_response(response.choices[0].message.content, {"phrases": [object]})
+            if problem:
+                logger.warning(f"Модель вернула некорректный список фраз: {problem}")
+                return []
+            phrases = result["phrases"]
+        except AIUnavailableError as e:
+            logger.info(f"AI недоступен ({e.reason}), пул мотивационных фраз не пополнен")
+            return []
+        except Exception as e:
+            logger.error(f"Ошибка генерации мотивационных фраз: {e}")
+            return []
+        
+        return [
+            phrase.strip() for phrase in phrases
+            if isinstance(phrase, str) and phrase.strip() and len(phrase) <= 300
+        ][:count]
     
     def _get_fallback_challenge(self, direction: str, level: int) -> Dict:
         """Fallback челлендж"""
@@ -120,10 +176,35 @@ class AIService:
     
     def _generate_cache_key(self, task_type: str, params: Dict) -> str:
         """Генерация ключа кэша на основе параметров запроса"""
-        params_str = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        params_str = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
         hash_input = f"{task_type}:{params_str}"
         return hashlib.md5(hash_input.encode()).hexdigest()
     
+    async def _single_flight(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Выполнить запрос один раз для всех одновременных одинаковых вызовов
+        
+        Первый вызов с ключом запускает запрос, остальные ждут его и
+        получают тот же результат (или ту же ошибку). Отмена одного из
+        ожидающих не отменяет запрос для остальных.
+        """
+        self.single_flight_stats["calls"] += 1
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done, key=key: self._forget_flight(key, done))
+        else:
+            self.single_flight_stats["coalesced"] += 1
+            logger.debug(f"AI-запрос {key[:8]} уже выполняется, ждем его результат")
+        return await asyncio.shield(task)
+    
+    def _forget_flight(self, key: str, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Ошибку получают ожидающие; если их не осталось, не пишем "exception never retrieved"
+        if not task.cancelled():
+            task.exception()
+    
     def _get_from_cache(self, key: str, ttl: int = 3600) -> Optional[Any]:
         """Получение данных из кэша"""
         if not self.use_cache or key not in self._cache:
@@ -232,7 +313,15 @@ class AIService:
             "Ты тренер по развитию навыков. Создай полезный и выполнимый челлендж."
         )
         
-        user_prompt = f"""
+        # Предыдущие успехи - короткий список, а не вся история челленджей
+        prompt_builder = PromptBuilder("challenge").add_list(
+            "previous_successes",
+            user_data.get('previous_successes', []),
+            lambda success: f"  • {success.get('challenge', '')} ({success.get('completed_at', 'N/A')})",
+            limit=3,
+            max_item_chars=200
+        )
+        user_prompt = prompt_builder.render(f"""
         Создай персонализированный челлендж для пользователя.
         
         Информация о пользователе:
@@ -240,7 +329,8 @@ class AIService:
         - Уровень: {user_data.get('level', 1)} из 10
         - Очки: {user_data.get('points', 0)}
         - Последние показатели: {json.dumps(user_data.get('last_metrics', {}), ensure_ascii=False)}
-        - Предыдущие успехи: {json.dumps(user_data.get('previous_successes', []), ensure_ascii=False)}
+        - Предыдущие успехи:
+        {prompt_builder.slot('previous_successes')}
         
         Челендж должен быть:
         1. Соответствовать направлению "{direction}"
@@ -262,61 +352,77 @@ class AIService:
             "success_tips": ["Совет 1", "Совет 2", "Совет 3"],
             "related_skills": ["навык 1", "навык 2"]  // Какие навыки развивает
         }}
-        """
+        """)
         
-        max_retries = 2
-        for retry in range(max_retries + 1):
-            # Проверяем квоту перед каждой попыткой
-            if hasattr(self, 'hf_service') and self.hf_service and hasattr(self.hf_service, 'quota_exceeded') and self.hf_service.quota_exceeded:
-                logger.warning("Квота AI превышена во время генерации челленджа")
-                break
-
-            try:
-                model = self._get_model("challenge_generation", retry)
-
-                response = self.client.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    temperature=0.7,
-                    max_tokens=800,
-                    response_format={"type": "json_object"}
-                )
-
-                result = json.loads(response.choices[0].message.content)
-
-                # Валидация результата
-                required_fields = ["text", "points", "difficulty", "estimated_time"]
-                if all(field in result for field in required_fields):
-                    # Добавляем метаданные
-                    result["ai_model"] = model
-                    result["generated_at"] = datetime.now().isoformat()
-                    result["direction"] = direction
-
-                    # Сохраняем в кэш
-                    if self.use_cache and cache_key:
-                        self._set_to_cache(cache_key, result, ttl=1800)
-
-                    logger.info(f"Челлендж сгенерирован через модель {model}")
-                    return result
-                else:
-                    logger.warning(f"Модель вернула неполный ответ: {result}")
-                    # Пробуем другую модель
-                    continue
-
-            except Exception as e:
-                logger.error(f"Попытка {retry + 1} не удалась для модели {model}: {e}")
-                # Проверяем на 402 ошибку и устанавливаем флаг
-                if "402" in str(e) or "quota" in str(e).lower():
-                    if hasattr(self, 'hf_service') and self.hf_service:
-                        self.hf_service.quota_exceeded = True
-                        logger.warning("Установлен флаг quota_exceeded из-за 402 ошибки")
+        async def generate() -> Optional[Dict[str, Any]]:
+            max_retries = 2
+            for retry in range(max_retries + 1):
+                # Проверяем квоту перед каждой попыткой
+                if hasattr(self, 'hf_service') and self.hf_service and hasattr(self.hf_service, 'quota_exceeded') and self.hf_service.quota_exceeded:
+                    logger.warning("Квота AI превышена во время генерации челленджа")
                     break
-                if retry == max_retries:
-                    logger.error("Все попытки генерации челленджа провалились")
+
+                try:
+                    model = self._get_model("challenge_generation", retry)
+
+                    response = await self.hf_service.create_completion(
+                        model=model,
+                        messages=[
+                            {"role": "system", "content": system_prompt},
+                            {"role": "user", "content": user_prompt}
+                        ],
+                        temperature=0.7,
+                        max_tokens=800,
+                        response_format={"type": "json_object"}
+                    )
+
+                    result, problem = parse_json_response(
+                        response.choices[0].message.content, self.CHALLENGE_SCHEMA
+                    )
+
+                    # Валидация результата
+                    if problem is None:
+                        # Добавляем метаданные
+                        result["ai_model"] = model
+                        result["generated_at"] = datetime.now().isoformat()
+                        result["direction"] = direction
+
+                        # Сохраняем в кэш
+                        if self.use_cache and cache_key:
+                            self._set_to_cache(cache_key, result, ttl=1800)
+
+                        logger.info(f"Челлендж сгенерирован через модель {model}")
+                        return result
+                    else:
+                        logger.warning(f"Модель вернула неполный ответ: {problem}")
+                        # Пробуем другую модель
+                        continue
+
+                except AIUnavailableError as e:
+                    # Breaker открыт или бюджет исчерпан - другие модели тоже не помогут
+                    logger.info(f"AI недоступен ({e.reason}), отдаю fallback челлендж")
                     break
+                except Exception as e:
+                    logger.error(f"Попытка {retry + 1} не удалась для модели {model}: {e}")
+                    # 402 уже открыл breaker в HuggingFaceService.create_completion
+                    if "402" in str(e) or "quota" in str(e).lower():
+                        break
+                    if retry == max_retries:
+                        logger.error("Все попытки генерации челленджа провалились")
+                        break
+            return None
+
+        # Одинаковые запросы (двойное нажатие, повтор после таймаута) ждут один вызов модели
+        result = await self._single_flight(
+            cache_key or self._generate_cache_key("challenge_generation", {
+                "user_id": user_id,
+                "direction": direction,
+                "level": user_data.get('level', 1)
+            }),
+            generate
+        )
+        if result:
+            return result
 
         # Fallback если все попытки провалились
         return self._get_fallback_challenge(direction, user_data.get('level', 1))
@@ -329,47 +435,34 @@ class AIService:
         if not self.is_active or not self.client:
             return "🤖 AI сервис временно недоступен. Попробуйте позже!"
 
-        # Проверяем флаг превышения квоты
-        if hasattr(self, 'hf_service') and self.hf_service and hasattr(self.hf_service, 'quota_exceeded') and self.hf_service.quota_exceeded:
-            logger.warning("Квота AI превышена, возвращаем fallback ответ")
-            return "🤖 Квота AI запросов исчерпана. Попробуйте позже или обратитесь к администратору."
-
         try:
-            # Системный промпт
-            system_prompt = """Ты помощник в боте для развития команд и личного роста.
-            Отвечай дружелюбно, профессионально и мотивирующе на русском языке.
-            Используй эмодзи для выразительности. Будь конкретным и полезным."""
-
-            # Формируем контекст
-            context_str = ""
-            if context:
-                if context.get("user_name"):
-                    context_str += f"Пользователь: {context['user_name']}\n"
-                if context.get("user_level"):
-                    context_str += f"Уровень: {context['user_level']}\n"
-
-            user_prompt = f"""{context_str}
-            Вопрос пользователя: {question}
-
-            Дай полезный и мотивирующий ответ."""
+            system_prompt, user_prompt = self._question_prompts(question, context)
 
             logger.info(f"🤖 AI запрос: {question[:100]}...")
 
-            response = self.client.chat.completions.create(
-                model="deepseek-ai/DeepSeek-V3.2",  # Основная модель
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.7,
-                max_tokens=500
-            )
+            async def ask() -> str:
+                response = await self.hf_service.create_completion(
+                    model="deepseek-ai/DeepSeek-V3.2",  # Основная модель
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_prompt}
+                    ],
+                    temperature=0.7,
+                    max_tokens=500
+                )
+                return response.choices[0].message.content
 
-            answer = response.choices[0].message.content
+            # Один и тот же промпт (например, оценка одинаковых ответов опроса) - один вызов модели
+            answer = await self._single_flight(
+                self._generate_cache_key("ai_response", {"prompt": user_prompt}), ask
+            )
             logger.info(f"✅ AI ответ получен ({len(answer)} символов)")
 
             return answer
 
+        except AIUnavailableError as e:
+            logger.info(f"AI недоступен ({e.reason}), отдаю fallback ответ")
+            return e.user_message
         except openai.APIConnectionError as e:
             logger.error(f"❌ Ошибка подключения к Hugging Face Router: {e}")
             return "🤖 Не удалось подключиться к AI. Проверьте интернет-соединение."
@@ -380,12 +473,79 @@ class AIService:
             logger.error(f"❌ Неизвестная ошибка AI: {e}")
             return "🤖 Произошла ошибка. Попробуйте задать вопрос позже."
 
+    async def stream_ai_response(self, question: str, context: Optional[Dict] = None) -> AsyncIterator[str]:
+        """
+        Потоковый вариант get_ai_response: отдает ответ по частям по мере генерации.
+        Если AI недоступен или запрос не удался до первого токена, отдает
+        fallback сообщение тем же текстом, что и get_ai_response.
+        """
+        if not self.is_active or not self.client:
+            yield "🤖 AI сервис временно недоступен. Попробуйте позже!"
+            return
+
+        system_prompt, user_prompt = self._question_prompts(question, context)
+        logger.info(f"🤖 AI запрос (поток): {question[:100]}...")
+
+        received = 0
+        try:
+            async for delta in self.hf_service.stream_completion(
+                model="deepseek-ai/DeepSeek-V3.2",
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=0.7,
+                max_tokens=500
+            ):
+                received += len(delta)
+                yield delta
+            logger.info(f"✅ AI ответ получен потоком ({received} символов)")
+            return
+        except AIUnavailableError as e:
+            logger.info(f"AI недоступен ({e.reason}), отдаю fallback ответ")
+            fallback = e.user_message
+        except openai.APIConnectionError as e:
+            logger.error(f"❌ Ошибка подключения к Hugging Face Router: {e}")
+            fallback = "🤖 Не удалось подключиться к AI. Проверьте интернет-соединение."
+        except openai.RateLimitError as e:
+            logger.error(f"❌ Лимит запросов: {e}")
+            fallback = "🤖 Слишком много запросов. Попробуйте через минуту."
+        except Exception as e:
+            logger.error(f"❌ Неизвестная ошибка AI: {e}")
+            fallback = "🤖 Произошла ошибка. Попробуйте задать вопрос позже."
+
+        if received:
+            # Часть ответа уже показана - не заменяем ее сообщением об ошибке
+            yield "\n\n⚠️ Ответ прерван."
+        else:
+            yield fallback
+
+    def _question_prompts(self, question: str, context: Optional[Dict] = None) -> Tuple[str, str]:
+        """Системный и пользовательский промпты для вопроса AI-помощнику"""
+        system_prompt = """Ты помощник в боте для развития команд и личного роста.
+            Отвечай дружелюбно, профессионально и мотивирующе на русском языке.
+            Используй эмодзи для выразительности. Будь конкретным и полезным."""
+
+        # Формируем контекст
+        context_str = ""
+        if context:
+            if context.get("user_name"):
+                context_str += f"Пользователь: {context['user_name']}\n"
+            if context.get("user_level"):
+                context_str += f"Уровень: {context['user_level']}\n"
+
+        user_prompt = f"""{context_str}
+            Вопрос пользователя: {question}
+
+            Дай полезный и мотивирующий ответ."""
+        return system_prompt, user_prompt
+
     async def analyze_user_progress(self, user_id: int) -> Dict[str, Any]:
         """
         Детальный анализ прогресса пользователя - исправленная версия
         """
-        # Проверка доступности
-        if not self.is_active:
+        # Проверка доступности: при открытом breaker сразу отдаем fallback
+        if not self.is_active or (self.hf_service and self.hf_service.quota_exceeded):
             return self._get_fallback_analysis(user_id)
 
         session = get_session()
@@ -470,7 +630,7 @@ class AIService:
             try:
                 model = self._get_model("analysis", retry)
 
-                response = self.client.chat.completions.create(
+                response = await self.hf_service.create_completion(
                     model=model,
                     messages=[
                         {"role": "system", "content": "Ты аналитик данных и мотивационный коуч."},
@@ -481,12 +641,18 @@ class AIService:
                     response_format={"type": "json_object"}
                 )
 
-                analysis = json.loads(response.choices[0].message.content)
+                analysis, problem = parse_json_response(response.choices[0].message.content)
+                if problem:
+                    logger.warning(f"Попытка {retry + 1} анализа вернула некорректный JSON: {problem}")
+                    continue
                 analysis["generated_at"] = datetime.now().isoformat()
                 analysis["model_used"] = model
 
                 return analysis
 
+            except AIUnavailableError as e:
+                logger.info(f"AI недоступен ({e.reason}), отдаю fallback анализ")
+                break
             except Exception as e:
                 logger.error(f"Попытка {retry + 1} анализа не удалась: {e}")
 
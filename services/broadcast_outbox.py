@@ -0,0 +1,385 @@
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from sqlalchemy import func, insert, literal, or_, and_, select
+
+from database import get_session, UserRole
+from database.models import BroadcastJob, BroadcastRecipient, Organization, User
+from services.fanout import fan_out
+from services.media_delivery import UploadOnceMedia, media_for, save_file_id
+from services.message_dispatcher import Priority, get_message_dispatcher
+from services.recipient_health import reachable_filter
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastOutbox:
+    """Очередь рассылок администраторов с состоянием по каждому получателю
+
+    Обработчик только записывает рассылку и ее получателей в базу и сразу
+    отвечает администратору. Фоновая задача забирает получателей пачками
+    (FOR UPDATE SKIP LOCKED), отправляет и отмечает результат. После
+    перезапуска отправка продолжается с тех, кто еще не получил сообщение.
+    """
+
+    batch_size = 200  # Получателей за одну выборку (отправляются параллельно)
+    claim_lease = timedelta(minutes=10)  # Когда зависший "sending" забирается снова
+
+    def create_job(self, org_id: int, created_by: int, text: str,
+                   report_chat_id: Optional[int] = None,
+                   attachment_type: Optional[str] = None,
+                   attachment_file_id: Optional[str] = None,
+                   attachment_path: Optional[str] = None) -> Tuple[int, int]:
+        """Создать рассылку и список получателей
+
+        Вложение задается file_id (например, фото от администратора) или
+        путем к файлу на диске; файл загружается один раз на всю рассылку.
+
+        Returns:
+            (id рассылки, число получателей)
+        """
+        session = get_session()
+        try:
+            job = BroadcastJob(
+                org_id=org_id,
+                created_by=created_by,
+                text=text,
+                status="pending",
+                report_chat_id=report_chat_id,
+                attachment_type=attachment_type,
+                attachment_file_id=attachment_file_id,
+                attachment_path=attachment_path
+            )
+            session.add(job)
+            session.flush()
+
+            # Получатели одним INSERT ... SELECT
+            recipients = select(
+                literal(job.id),
+                User.user_id,
+                User.chat_id,
+                literal("pending")
+            ).where(
+                User.org_id == org_id,
+                User.chat_id.isnot(None),
+                reachable_filter(),
+                User.role.in_([UserRole.MEMBER.value, UserRole.TRAINER.value])
+            )
+            result = session.execute(
+                insert(BroadcastRecipient).from_select(
+                    ["job_id", "user_id", "chat_id", "status"], recipients
+                )
+            )
+
+            job.total = result.rowcount
+            if job.total == 0:
+                job.status = "completed"
+                job.finished_at = datetime.utcnow()
+
+            session.commit()
+            logger.info(f"📨 Рассылка {job.id} поставлена в очередь: {job.total} получателей")
+            return job.id, job.total
+
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def get_progress(self, job_id: int) -> Optional[Dict]:
+        """Прогресс рассылки по статусам получателей"""
+        session = get_session()
+        try:
+            job = session.query(BroadcastJob).filter(BroadcastJob.id == job_id).first()
+            if not job:
+                return None
+
+            counts = dict(
+                session.query(BroadcastRecipient.status, func.count(BroadcastRecipient.id)).filter(
+                    BroadcastRecipient.job_id == job_id
+                ).group_by(BroadcastRecipient.status).all()
+            )
+
+            return {
+                "job_id": job.id,
+                "org_id": job.org_id,
+                "created_by": job.created_by,
+                "status": job.status,
+                "total": job.total,
+                "sent": counts.get("sent", 0),
+                "failed": counts.get("failed", 0),
+                "pending": counts.get("pending", 0) + counts.get("sending", 0),
+                "created_at": job.created_at,
+                "started_at": job.started_at,
+                "finished_at": job.finished_at,
+            }
+        finally:
+            session.close()
+
+    async def drain(self, bot: Bot):
+        """Отправить все незавершенные рассылки (запускается JobScheduler)"""
+        for job_id in self._get_active_job_ids():
+            try:
+                await self._drain_job(bot, job_id)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки рассылки {job_id}: {e}", exc_info=True)
+
+    def _get_active_job_ids(self) -> List[int]:
+        session = get_session()
+        try:
+            return [
+                job_id for (job_id,) in session.query(BroadcastJob.id).filter(
+                    BroadcastJob.status.in_(["pending", "sending"])
+                ).order_by(BroadcastJob.created_at).all()
+            ]
+        finally:
+            session.close()
+
+    async def _drain_job(self, bot: Bot, job_id: int):
+        self._mark_job_started(job_id)
+        dispatcher = get_message_dispatcher(bot)
+        text, org_id, media = self._get_job_content(job_id)
+        saved_file_id = media.file_id if media else None
+
+        async def send(recipient: Tuple[int, int]):
+            if media:
+                return await media.send(dispatcher, recipient[1], text, priority=Priority.BULK, org_id=org_id)
+            return await dispatcher.send_message(
+                chat_id=recipient[1],
+                text=text,
+                priority=Priority.BULK,
+                org_id=org_id
+            )
+
+        while True:
+            batch = self._claim_recipients(job_id)
+            if not batch:
+                break
+
+            results = await fan_out(batch, send)
+
+            # После первой загрузки сохраняем file_id: повтор после перезапуска
+            # тоже не будет загружать файл заново
+            if media and media.file_id and media.file_id != saved_file_id:
+                save_file_id(BroadcastJob, job_id, media.file_id)
+                saved_file_id = media.file_id
+            
+            sent_ids = []
+            failed = {}
+            for result in results:
+                recipient_id, chat_id = result.item
+                if result.ok:
+                    sent_ids.append(recipient_id)
+                else:
+                    failed[recipient_id] = getattr(result.error, "reason", None) or str(result.error)[:255]
+                    logger.warning(f"Не удалось отправить рассылку {job_id} в чат {chat_id}: {result.error}")
+
+            self._mark_recipients(sent_ids, failed)
+
+        if self._finish_job_if_done(job_id):
+            await self._send_report(bot, job_id)
+
+    def _mark_job_started(self, job_id: int):
+        session = get_session()
+        try:
+            session.query(BroadcastJob).filter(
+                BroadcastJob.id == job_id,
+                BroadcastJob.status == "pending"
+            ).update({
+                "status": "sending",
+                "started_at": datetime.utcnow()
+            }, synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+    def _get_job_content(self, job_id: int) -> Tuple[str, int, Optional[UploadOnceMedia]]:
+        """Текст, организация и вложение рассылки"""
+        session = get_session()
+        try:
+            job = session.query(BroadcastJob).filter(BroadcastJob.id == job_id).one()
+            return job.text, job.org_id, media_for(job)
+        finally:
+            session.close()
+
+    def _claim_recipients(self, job_id: int) -> List[Tuple[int, int]]:
+        """Забрать пачку получателей, которым рассылка еще не отправлена"""
+        session = get_session()
+        try:
+            now = datetime.utcnow()
+
+            rows = session.query(BroadcastRecipient.id, BroadcastRecipient.chat_id).filter(
+                BroadcastRecipient.job_id == job_id,
+                or_(
+                    BroadcastRecipient.status == "pending",
+                    and_(
+                        BroadcastRecipient.status == "sending",
+                        BroadcastRecipient.claimed_at < now - self.claim_lease
+                    )
+                )
+            ).order_by(
+                BroadcastRecipient.id
+            ).limit(
+                self.batch_size
+            ).with_for_update(skip_locked=True).all()
+
+            if not rows:
+                session.rollback()
+                return []
+
+            session.query(BroadcastRecipient).filter(
+                BroadcastRecipient.id.in_([row.id for row in rows])
+            ).update({
+                "status": "sending",
+                "claimed_at": now
+            }, synchronize_session=False)
+
+            session.commit()
+            return [(row.id, row.chat_id) for row in rows]
+
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Ошибка выборки получателей рассылки {job_id}: {e}", exc_info=True)
+            return []
+        finally:
+            session.close()
+
+    def _mark_recipients(self, sent_ids: List[int], failed: Dict[int, str]):
+        session = get_session()
+        try:
+            now = datetime.utcnow()
+            if sent_ids:
+                session.query(BroadcastRecipient).filter(
+                    BroadcastRecipient.id.in_(sent_ids)
+                ).update({"status": "sent", "updated_at": now}, synchronize_session=False)
+
+            for recipient_id, error in failed.items():
+                session.query(BroadcastRecipient).filter(
+                    BroadcastRecipient.id == recipient_id
+                ).update({"status": "failed", "error": error, "updated_at": now}, synchronize_session=False)
+
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Ошибка сохранения статусов рассылки: {e}", exc_info=True)
+        finally:
+            session.close()
+
+    def _finish_job_if_done(self, job_id: int) -> bool:
+        """Закрыть рассылку, если не осталось неотправленных получателей"""
+        session = get_session()
+        try:
+            remaining = session.query(BroadcastRecipient.id).filter(
+                BroadcastRecipient.job_id == job_id,
+                BroadcastRecipient.status.in_(["pending", "sending"])
+            ).first()
+            if remaining:
+                return False
+
+            finished = session.query(BroadcastJob).filter(
+                BroadcastJob.id == job_id,
+                BroadcastJob.status != "completed"
+            ).update({
+                "status": "completed",
+                "finished_at": datetime.utcnow()
+            }, synchronize_session=False)
+            session.commit()
+            return finished > 0
+        finally:
+            session.close()
+
+    def get_failed_recipients(self, job_id: int, limit: int = 5) -> List[str]:
+        """Имена получателей, которым не удалось отправить рассылку"""
+        session = get_session()
+        try:
+            rows = session.query(User.name, BroadcastRecipient.user_id).outerjoin(
+                User, User.user_id == BroadcastRecipient.user_id
+            ).filter(
+                BroadcastRecipient.job_id == job_id,
+                BroadcastRecipient.status == "failed"
+            ).order_by(BroadcastRecipient.id).limit(limit).all()
+            return [f"{name or 'Без имени'} (ID: {user_id})" for name, user_id in rows]
+        finally:
+            session.close()
+
+    def format_report(self, progress: Dict, org_name: str, admin_name: str,
+                      failed_users: List[str]) -> str:
+        """Текст отчета о рассылке для администратора"""
+        total = progress["total"]
+        sent = progress["sent"]
+        failed = progress["failed"]
+        finished_at = progress["finished_at"] or datetime.utcnow()
+
+        report_text = (
+            f"✅ *Рассылка завершена!*\n\n"
+            f"🏢 *Организация:* {org_name}\n"
+            f"👤 *Отправил:* {admin_name}\n"
+            f"📅 *Время отправки:* {finished_at.strftime('%d.%m.%Y %H:%M')} UTC\n\n"
+            f"📊 *Статистика:*\n"
+            f"• Всего получателей: {total}\n"
+            f"• Успешно отправлено: {sent}\n"
+            f"• Не удалось отправить: {failed}\n"
+            f"• Успешность: {(sent / total * 100 if total > 0 else 0):.1f}%\n\n"
+        )
+
+        if failed > 0:
+            report_text += f"❌ *Не отправлено ({failed}):*\n"
+            for i, user in enumerate(failed_users[:5], 1):  # Показываем только первые 5
+                report_text += f"{i}. {user}\n"
+            if failed > 5:
+                report_text += f"... и еще {failed - 5} пользователей\n"
+
+        return report_text
+
+    async def _send_report(self, bot: Bot, job_id: int):
+        """Отправить администратору итог рассылки"""
+        progress = self.get_progress(job_id)
+        if not progress:
+            return
+
+        session = get_session()
+        try:
+            job = session.query(BroadcastJob).filter(BroadcastJob.id == job_id).first()
+            org = session.query(Organization).filter(Organization.id == job.org_id).first()
+            admin = session.query(User).filter(User.user_id == job.created_by).first()
+            report_chat_id = job.report_chat_id
+            org_name = org.name if org else "Организация"
+            admin_name = admin.name if admin and admin.name else "Администратор"
+        finally:
+            session.close()
+
+        logger.info(
+            f"Рассылка отправлена: организация={org_name} ({progress['org_id']}), "
+            f"отправитель={progress['created_by']}, "
+            f"получателей={progress['total']}, "
+            f"успешно={progress['sent']}, "
+            f"неудачно={progress['failed']}"
+        )
+
+        if not report_chat_id:
+            return
+
+        report_text = self.format_report(
+            progress, org_name, admin_name, self.get_failed_recipients(job_id)
+        )
+        after_send_kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📨 Создать новую рассылку", callback_data="admin_send_broadcast")],
+            [InlineKeyboardButton(text="◀️ Назад в меню", callback_data="back_to_admin_panel")]
+        ])
+
+        try:
+            await get_message_dispatcher(bot).send_message(
+                chat_id=report_chat_id,
+                text=report_text,
+                priority=Priority.INTERACTIVE,
+                parse_mode="Markdown",
+                reply_markup=after_send_kb
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось отправить отчет о рассылке {job_id}: {e}")
+
+
+broadcast_outbox = BroadcastOutbox()
@@ -1,119 +1,208 @@
 import asyncio
 import logging
 from datetime import datetime, time, timedelta
-from typing import List
+from typing import List, Tuple
 
 from aiogram import Bot
+from config import load_config
 from database import get_session, User, Challenge, ChallengeStatus
+from services.message_dispatcher import Priority, get_message_dispatcher
 from sqlalchemy import and_, or_
 
 logger = logging.getLogger(__name__)
 
 class ChallengeScheduler:
-    """Сервис для отправки запланированных челленджей"""
+    """Сервис для отправки запланированных челленджей
+
+    Запланированные челленджи работают как очередь: воркер забирает
+    наступившие записи через SELECT ... FOR UPDATE SKIP LOCKED, переводит
+    их в статус SENDING, рассылает с ограниченной параллельностью и пачкой
+    отмечает результат. Несколько воркеров (или реплик) разбирают очередь
+    параллельно и не отправляют один челлендж дважды.
+    """
+    
+    batch_size = 200  # Сколько челленджей забирает воркер за раз
+    send_concurrency = 10  # Одновременных отправок в одном воркере
+    claim_lease = timedelta(minutes=10)  # Через сколько зависший SENDING забирается снова
     
-    def __init__(self, bot: Bot):
+    def __init__(self, bot: Bot, workers: int = None):
         self.bot = bot
-        self.is_running = False
+        config = load_config()
+        self.workers = workers or config.challenge_queue_workers
+        # Челленджи, опоздавшие больше чем на это окно, не отправляем
+        self.catchup_window = timedelta(minutes=max(config.schedule_catchup_minutes, 1))
     
-    async def start(self):
-        """Запуск планировщика"""
-        if self.is_running:
-            logger.warning("Планировщик уже запущен")
-            return
+    async def tick(self):
+        """Одна проверка очереди (запускается JobScheduler раз в минуту)"""
+        self._skip_expired_challenges()
+        await asyncio.gather(*(
+            self._check_and_send_challenges(worker_id)
+            for worker_id in range(self.workers)
+        ))
+    
+    async def _check_and_send_challenges(self, worker_id: int = 0):
+        """Разобрать очередь наступивших челленджей"""
+        total_sent = 0
+        while True:
+            batch, failed_ids = self._claim_due_challenges()
+            
+            if failed_ids:
+                self._mark_challenges(failed_ids, ChallengeStatus.FAILED.value)
+            
+            if not batch:
+                break
+            
+            logger.info(f"Воркер {worker_id}: взято {len(batch)} челленджей для отправки")
+            
+            semaphore = asyncio.Semaphore(self.send_concurrency)
+            
+            async def send_one(challenge: Challenge, chat_id: int) -> bool:
+                async with semaphore:
+                    try:
+                        await self._send_challenge(challenge, chat_id)
+                        return True
+                    except Exception as e:
+                        logger.error(f"Ошибка отправки челленджа {challenge.id}: {e}")
+                        return False
+            
+            results = await asyncio.gather(
+                *(send_one(challenge, chat_id) for challenge, chat_id in batch)
+            )
             
-        self.is_running = True
-        logger.info("✅ Планировщик челленджей запущен")
+            sent_ids = [challenge.id for (challenge, _), ok in zip(batch, results) if ok]
+            failed_ids = [challenge.id for (challenge, _), ok in zip(batch, results) if not ok]
+            
+            self._mark_challenges(sent_ids, ChallengeStatus.PENDING.value, sent_at=datetime.utcnow())
+            self._mark_challenges(failed_ids, ChallengeStatus.FAILED.value)
+            total_sent += len(sent_ids)
+            
+            # Неполная пачка - очередь разобрана
+            if len(batch) < self.batch_size:
+                break
         
-        # Запускаем в фоновой задаче
-        asyncio.create_task(self._run_scheduler())
-    
-    async def stop(self):
-        """Остановка планировщика"""
-        self.is_running = False
-        logger.info("⏹️ Планировщик челленджей остановлен")
+        if total_sent:
+            logger.info(f"✅ Воркер {worker_id}: успешно отправлено {total_sent} челленджей")
     
-    async def _run_scheduler(self):
-        """Основной цикл планировщика"""
-        while self.is_running:
-            try:
-                await self._check_and_send_challenges()
-            except Exception as e:
-                logger.error(f"Ошибка в планировщике: {e}", exc_info=True)
-            
-            # Проверяем каждую минуту
-            await asyncio.sleep(60)
-    
-    async def _check_and_send_challenges(self):
-        """Проверка и отправка запланированных челленджей"""
+    def _skip_expired_challenges(self):
+        """Пометить челленджи, опоздавшие больше окна догоняющей отправки
+
+        Сюда же попадают зависшие в SENDING после падения воркера, если
+        их время вышло из окна и повторно забрать их уже нельзя.
+        """
         session = get_session()
         try:
-            now = datetime.now()
-            current_minute = now.replace(second=0, microsecond=0)
+            # scheduled_for хранится в UTC
+            now = datetime.utcnow()
+            catchup_from = now - self.catchup_window
             
-            logger.debug(f"Проверка запланированных челленджей в {now.strftime('%H:%M:%S')}")
+            skipped = session.query(Challenge).filter(
+                or_(
+                    Challenge.status == ChallengeStatus.SCHEDULED.value,
+                    and_(
+                        Challenge.status == ChallengeStatus.SENDING.value,
+                        Challenge.claimed_at < now - self.claim_lease
+                    )
+                ),
+                Challenge.scheduled_for < catchup_from,
+                Challenge.sent_at.is_(None)
+            ).update({"status": ChallengeStatus.FAILED.value}, synchronize_session=False)
+            session.commit()
+            
+            if skipped:
+                logger.warning(f"⏭️ Пропущено {skipped} челленджей: время отправки давно прошло")
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Ошибка пропуска просроченных челленджей: {e}", exc_info=True)
+        finally:
+            session.close()
+    
+    def _claim_due_challenges(self) -> Tuple[List[Tuple[Challenge, int]], List[int]]:
+        """Забрать пачку наступивших челленджей
+
+        Возвращает пары (челлендж, chat_id) и id челленджей, получателю
+        которых нельзя отправить сообщение. Заблокированные другим воркером
+        строки пропускаются. Зависшие в SENDING дольше claim_lease забираются
+        повторно, чтобы падение воркера не теряло челленджи.
+        """
+        session = get_session()
+        try:
+            now = datetime.utcnow()
+            catchup_from = now - self.catchup_window
             
-            # Находим челленджи, которые нужно отправить
-            challenges = session.query(Challenge).filter(
+            rows = session.query(Challenge, User.chat_id, User.unreachable_at).outerjoin(
+                User, User.user_id == Challenge.user_id
+            ).filter(
                 Challenge.scheduled_for.isnot(None),
-                Challenge.status == ChallengeStatus.SCHEDULED.value,
-                Challenge.scheduled_for <= current_minute + timedelta(minutes=1),
-                Challenge.scheduled_for >= current_minute,
-                Challenge.sent_at.is_(None)
-            ).all()
-            
-            if not challenges:
-                logger.debug("Нет челленджей для отправки")
-                return
-            
-            logger.info(f"Найдено {len(challenges)} челленджей для отправки")
-            
-            sent_count = 0
-            for challenge in challenges:
-                try:
-                    # Получаем пользователя
-                    user = session.query(User).filter(
-                        User.user_id == challenge.user_id,
-                        User.chat_id.isnot(None)
-                    ).first()
-                    
-                    if not user:
-                        logger.warning(f"Пользователь {challenge.user_id} не найден")
-                        challenge.status = ChallengeStatus.FAILED.value
-                        session.add(challenge)
-                        continue
-                    
-                    if not user.chat_id:
-                        logger.warning(f"У пользователя {user.user_id} нет chat_id")
-                        challenge.status = ChallengeStatus.FAILED.value
-                        session.add(challenge)
-                        continue
-                    
-                    # Отправляем челлендж
-                    await self._send_challenge(challenge, user.chat_id)
-                    
-                    # Обновляем статус
-                    challenge.sent_at = now
-                    challenge.status = ChallengeStatus.PENDING.value
-                    session.add(challenge)
-                    sent_count += 1
-                    
-                    logger.info(f"✅ Челлендж отправлен пользователю {user.user_id}")
-                    
-                    # Небольшая задержка между отправками
-                    await asyncio.sleep(0.1)
-                    
-                except Exception as e:
-                    logger.error(f"Ошибка отправки челленджа {challenge.id}: {e}")
-                    challenge.status = ChallengeStatus.FAILED.value
-                    session.add(challenge)
+                Challenge.scheduled_for <= now,
+                Challenge.scheduled_for >= catchup_from,
+                Challenge.sent_at.is_(None),
+                or_(
+                    Challenge.status == ChallengeStatus.SCHEDULED.value,
+                    and_(
+                        Challenge.status == ChallengeStatus.SENDING.value,
+                        Challenge.claimed_at < now - self.claim_lease
+                    )
+                )
+            ).order_by(
+                Challenge.scheduled_for
+            ).limit(
+                self.batch_size
+            ).with_for_update(skip_locked=True, of=Challenge).all()
+            
+            if not rows:
+                session.rollback()
+                return [], []
+            
+            batch = []
+            failed_ids = []
+            for challenge, chat_id, unreachable_at in rows:
+                if not chat_id:
+                    logger.warning(f"У пользователя {challenge.user_id} нет chat_id")
+                    failed_ids.append(challenge.id)
+                elif unreachable_at:
+                    # Не тратим запрос на чат, который уже отвечал ошибкой
+                    failed_ids.append(challenge.id)
+                else:
+                    batch.append((challenge, chat_id))
             
+            if batch:
+                session.query(Challenge).filter(
+                    Challenge.id.in_([challenge.id for challenge, _ in batch])
+                ).update({
+                    "status": ChallengeStatus.SENDING.value,
+                    "claimed_at": now
+                }, synchronize_session=False)
+            
+            # Отвязываем объекты, чтобы данные для сообщения остались после commit
+            session.expunge_all()
             session.commit()
-            logger.info(f"✅ Успешно отправлено {sent_count} челленджей")
+            return batch, failed_ids
             
         except Exception as e:
-            logger.error(f"Ошибка проверки челленджей: {e}", exc_info=True)
             session.rollback()
+            logger.error(f"Ошибка выборки челленджей: {e}", exc_info=True)
+            return [], []
+        finally:
+            session.close()
+    
+    def _mark_challenges(self, challenge_ids: List[int], status: str, sent_at: datetime = None):
+        """Пачкой обновить статус обработанных челленджей"""
+        if not challenge_ids:
+            return
+        
+        session = get_session()
+        try:
+            values = {"status": status}
+            if sent_at:
+                values["sent_at"] = sent_at
+            
+            session.query(Challenge).filter(
+                Challenge.id.in_(challenge_ids)
+            ).update(values, synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Ошибка обновления статуса челленджей: {e}", exc_info=True)
         finally:
             session.close()
     
@@ -160,9 +249,10 @@ class ChallengeScheduler:
             
             message_text += "\nДля выполнения зайдите в меню ➡️ 📈 *Активность*"
             
-            await self.bot.send_message(
+            await get_message_dispatcher(self.bot).send_message(
                 chat_id=chat_id,
                 text=message_text,
+                priority=Priority.SCHEDULED,
                 parse_mode="Markdown"
             )
             
@@ -1,6 +1,6 @@
 import json
 import logging
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
 from typing import Dict, List, Optional, Any
 
 from sqlalchemy import and_, or_
@@ -8,6 +8,9 @@ from database import get_session, PendingChallenge
 
 logger = logging.getLogger(__name__)
 
+# Набор челленджей на день, подготовленный заранее для всей организации
+PRECOMPUTED_STATUS = "PRECOMPUTED"
+
 
 class ChallengeStorageService:
     """Сервис для работы с временным хранилищем челленджей"""
@@ -66,6 +69,97 @@ class ChallengeStorageService:
         finally:
             session.close()
     
+    async def save_precomputed(
+        self,
+        org_id: int,
+        challenges: List[Dict[str, Any]],
+        team_analysis: Optional[Dict[str, Any]],
+        valid_for: date,
+        expires_at: datetime
+    ) -> int:
+        """
+        Сохранить заранее подготовленный набор челленджей организации
+        (предыдущий набор организации заменяется)
+        """
+        session = get_session()
+        try:
+            session.query(PendingChallenge).filter(
+                PendingChallenge.org_id == org_id,
+                PendingChallenge.status == PRECOMPUTED_STATUS
+            ).delete(synchronize_session=False)
+            
+            record = PendingChallenge(
+                org_id=org_id,
+                challenges=challenges,
+                team_analysis=team_analysis,
+                valid_for=valid_for,
+                expires_at=expires_at,
+                status=PRECOMPUTED_STATUS
+            )
+            session.add(record)
+            session.commit()
+            
+            logger.info(
+                f"Подготовлены челленджи для org_id={org_id} на {valid_for}, "
+                f"count={len(challenges)}"
+            )
+            return record.id
+            
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Ошибка сохранения подготовленных челленджей: {e}")
+            raise
+        finally:
+            session.close()
+    
+    async def get_precomputed(self, org_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Действующий подготовленный набор челленджей организации
+        """
+        session = get_session()
+        try:
+            record = session.query(PendingChallenge).filter(
+                PendingChallenge.org_id == org_id,
+                PendingChallenge.status == PRECOMPUTED_STATUS,
+                PendingChallenge.expires_at > datetime.now(timezone.utc)
+            ).order_by(PendingChallenge.created_at.desc()).first()
+            
+            if not record:
+                return None
+            
+            return {
+                "id": record.id,
+                "org_id": record.org_id,
+                "challenges": record.challenges,
+                "team_analysis": record.team_analysis,
+                "valid_for": record.valid_for,
+                "created_at": record.created_at
+            }
+            
+        except Exception as e:
+            logger.error(f"Ошибка получения подготовленных челленджей: {e}")
+            return None
+        finally:
+            session.close()
+    
+    async def get_precomputed_dates(self) -> Dict[int, date]:
+        """
+        На какую дату у каждой организации есть действующий подготовленный набор
+        """
+        session = get_session()
+        try:
+            rows = session.query(PendingChallenge.org_id, PendingChallenge.valid_for).filter(
+                PendingChallenge.status == PRECOMPUTED_STATUS,
+                PendingChallenge.expires_at > datetime.now(timezone.utc)
+            ).all()
+            return {org_id: valid_for for org_id, valid_for in rows}
+            
+        except Exception as e:
+            logger.error(f"Ошибка получения подготовленных челленджей: {e}")
+            return {}
+        finally:
+            session.close()
+    
     async def get_challenges(
         self,
         user_id: int,
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import random
+from typing import Any, Dict, Optional
+
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramEntityTooLarge, TelegramForbiddenError,
+    TelegramMigrateToChat, TelegramNetworkError, TelegramNotFound,
+    TelegramRetryAfter, TelegramServerError, TelegramUnauthorizedError
+)
+
+from database import get_session
+from database.models import DeadLetter
+
+logger = logging.getLogger(__name__)
+
+# Причины неудачной доставки
+REASON_RETRY_AFTER = "retry_after"  # Flood wait, Telegram просит подождать
+REASON_NETWORK = "network"  # Сеть/таймаут, можно повторить
+REASON_SERVER = "server_error"  # 5xx Telegram, можно повторить
+REASON_BLOCKED = "bot_blocked"  # Пользователь заблокировал бота
+REASON_DEACTIVATED = "user_deactivated"  # Аккаунт удален
+REASON_CHAT_NOT_FOUND = "chat_not_found"  # Чат не существует или недоступен
+REASON_CHAT_MIGRATED = "chat_migrated"  # Группа стала супергруппой с новым chat_id
+REASON_BAD_REQUEST = "bad_request"  # Ошибка в самом запросе (текст, разметка)
+REASON_UNAUTHORIZED = "unauthorized"  # Неверный токен бота
+REASON_UNKNOWN = "unknown"
+
+# Причины, по которым получатель недоступен, а не сломан запрос
+RECIPIENT_GONE_REASONS = {REASON_BLOCKED, REASON_DEACTIVATED, REASON_CHAT_NOT_FOUND}
+
+MAX_ATTEMPTS = 4  # Попыток для временных ошибок сети и сервера
+MAX_RETRY_AFTER = 5  # Сколько раз подряд выполняем flood wait для одного сообщения
+
+
+class DeliveryError(Exception):
+    """Неудачная отправка сообщения с классифицированной причиной"""
+
+    def __init__(self, reason: str, permanent: bool, message: str,
+                 retry_after: Optional[float] = None, original: Exception = None,
+                 migrate_to_chat_id: Optional[int] = None):
+        super().__init__(message)
+        self.reason = reason
+        self.permanent = permanent
+        self.retry_after = retry_after
+        self.original = original
+        self.migrate_to_chat_id = migrate_to_chat_id
+
+    @property
+    def recipient_gone(self) -> bool:
+        return self.reason in RECIPIENT_GONE_REASONS
+
+
+def classify_error(error: Exception) -> DeliveryError:
+    """Разобрать исключение aiogram по типу, а не по тексту"""
+    if isinstance(error, DeliveryError):
+        return error
+
+    message = str(error)
+    lowered = message.lower()
+
+    if isinstance(error, TelegramRetryAfter):
+        return DeliveryError(REASON_RETRY_AFTER, False, message,
+                             retry_after=float(error.retry_after), original=error)
+    # TelegramEntityTooLarge наследуется от TelegramNetworkError, но повтор не поможет
+    if isinstance(error, TelegramEntityTooLarge):
+        return DeliveryError(REASON_BAD_REQUEST, True, message, original=error)
+    if isinstance(error, (TelegramNetworkError, asyncio.TimeoutError)):
+        return DeliveryError(REASON_NETWORK, False, message, original=error)
+    if isinstance(error, TelegramServerError):
+        return DeliveryError(REASON_SERVER, False, message, original=error)
+    if isinstance(error, TelegramForbiddenError):
+        reason = REASON_DEACTIVATED if "deactivated" in lowered else REASON_BLOCKED
+        return DeliveryError(reason, True, message, original=error)
+    if isinstance(error, TelegramUnauthorizedError):
+        return DeliveryError(REASON_UNAUTHORIZED, True, message, original=error)
+    if isinstance(error, TelegramMigrateToChat):
+        # Чат жив, но в прежний chat_id отправлять бесполезно: повтор - только по новому
+        return DeliveryError(REASON_CHAT_MIGRATED, True, message, original=error,
+                             migrate_to_chat_id=error.migrate_to_chat_id)
+    if isinstance(error, TelegramNotFound):
+        return DeliveryError(REASON_CHAT_NOT_FOUND, True, message, original=error)
+    if isinstance(error, TelegramBadRequest):
+        if "chat not found" in lowered or "user not found" in lowered:
+            return DeliveryError(REASON_CHAT_NOT_FOUND, True, message, original=error)
+        if "deactivated" in lowered:
+            return DeliveryError(REASON_DEACTIVATED, True, message, original=error)
+        return DeliveryError(REASON_BAD_REQUEST, True, message, original=error)
+
+    return DeliveryError(REASON_UNKNOWN, True, message, original=error)
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+    """Экспоненциальная задержка с полным джиттером"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def _serialize_payload(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    payload = {}
+    for key, value in kwargs.items():
+        if isinstance(value, (str, int, float, bool)) or value is None:
+            payload[key] = value
+        else:
+            payload[key] = repr(value)[:500]
+    return payload
+
+
+def record_dead_letter(chat_id: int, method: str, kwargs: Dict[str, Any],
+                       error: DeliveryError, attempts: int):
+    """Сохранить окончательно не доставленное сообщение"""
+    session = get_session()
+    try:
+        session.add(DeadLetter(
+            chat_id=chat_id,
+            method=method,
+            payload=_serialize_payload(kwargs),
+            reason=error.reason,
+            error_message=str(error)[:1000],
+            attempts=attempts
+        ))
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"❌ Не удалось записать недоставленное сообщение для {chat_id}: {e}")
+    finally:
+        session.close()
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Iterable, List, Optional
+
+from config import load_config
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class FanOutResult:
+    """Результат отправки одному получателю"""
+    item: Any
+    ok: bool
+    result: Any = None
+    error: Optional[Exception] = None
+
+
+async def fan_out(
+    items: Iterable[Any],
+    send: Callable[[Any], Awaitable[Any]],
+    concurrency: Optional[int] = None,
+    on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None
+) -> List[FanOutResult]:
+    """Отправить всем получателям параллельно с ограничением одновременных задач
+
+    Темп отправки задает MessageDispatcher, а fan_out только держит в его
+    очереди достаточно запросов, чтобы идти на пределе лимита Telegram,
+    а не ждать ответа на каждое сообщение по очереди.
+
+    Args:
+        items: Получатели (или любые элементы рассылки)
+        send: Корутина отправки одному получателю
+        concurrency: Максимум одновременных отправок
+        on_progress: Вызывается как on_progress(done, total) после каждой отправки
+
+    Returns:
+        Результаты в порядке items (для пакетной записи логов)
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    semaphore = asyncio.Semaphore(concurrency or load_config().fanout_concurrency)
+    done = 0
+
+    async def run(item: Any) -> FanOutResult:
+        nonlocal done
+        async with semaphore:
+            try:
+                result = FanOutResult(item, True, await send(item))
+            except Exception as e:
+                result = FanOutResult(item, False, error=e)
+
+        done += 1
+        if on_progress:
+            try:
+                await on_progress(done, len(items))
+            except Exception as e:
+                logger.debug(f"Ошибка обновления прогресса рассылки: {e}")
+        return result
+
+    return await asyncio.gather(*(run(item) for item in items))
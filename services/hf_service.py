@@ -1,20 +1,66 @@
 import openai
+import httpx
+import asyncio
 import logging
-from typing import Dict, Any, Optional
+import time
+from typing import AsyncIterator, Dict, Any, Optional
 from config import load_config
-import json
-import re
+from services.ai_guard import (
+    REASON_BUDGET, REASON_CIRCUIT_OPEN, REASON_QUOTA, AIUnavailableError,
+    get_ai_breaker, get_ai_budget, resolve_org_id
+)
+from services.ai_scheduler import current_ai_org, current_ai_user, get_ai_scheduler
+from services.json_output import json_stats, parse_json_response
 
 logger = logging.getLogger(__name__)
 
+JSON_SYSTEM_PROMPT = (
+    "Ты всегда возвращаешь ТОЛЬКО JSON без дополнительного текста. "
+    "Твой ответ должен быть валидным JSON объектом. "
+    "Не используй комментарии, не добавляй лишний текст."
+)
+
+# Один асинхронный клиент на процесс: все экземпляры сервиса делят
+# пул соединений, а не открывают каждый свой
+_shared_client: Optional[openai.AsyncOpenAI] = None
+
+def get_ai_client(api_key: str) -> openai.AsyncOpenAI:
+    """Общий AsyncOpenAI клиент с пулом keep-alive соединений"""
+    global _shared_client
+    if _shared_client is None or _shared_client.is_closed():
+        config = load_config()
+        max_connections = config.ai_max_connections
+        _shared_client = openai.AsyncOpenAI(
+            api_key=api_key,
+            base_url=config.ai_base_url,
+            timeout=30.0,
+            http_client=openai.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections
+                )
+            )
+        )
+    return _shared_client
+
+async def close_ai_client():
+    """Закрыть общий клиент и его соединения (при остановке бота)"""
+    global _shared_client
+    if _shared_client is not None:
+        await _shared_client.close()
+        _shared_client = None
+        logger.info("🔌 Соединения с AI API закрыты")
+
 class HuggingFaceService:
     """Сервис для работы с моделями через Hugging Face Inference API"""
 
+    # Поддерживает ли бэкенд response_format=json_object (сбрасывается при первом отказе)
+    json_mode_supported = True
+
     def __init__(self):
         self.config = load_config()
         self.is_active = True
         self.client = None
-        self.quota_exceeded = False  # Флаг превышения квоты
 
         try:
             if not self.config.huggingface_api_key:
@@ -22,19 +68,162 @@ class HuggingFaceService:
                 self.is_active = False
                 return
 
-            # Используем OpenAI-совместимый клиент с Hugging Face эндпоинтом
-            self.client = openai.OpenAI(
-                api_key=self.config.huggingface_api_key,
-                base_url="https://router.huggingface.co/v1",  # Hugging Face Router
-                timeout=30.0
-            )
+            # Асинхронный OpenAI-совместимый клиент с Hugging Face эндпоинтом:
+            # ожидание ответа модели не блокирует event loop бота
+            self.client = get_ai_client(self.config.huggingface_api_key)
 
-            logger.info("✅ Hugging Face сервис инициализирован")
+            logger.info(f"✅ Hugging Face сервис инициализирован ({self.config.ai_base_url})")
 
         except Exception as e:
             logger.error(f"❌ Ошибка инициализации Hugging Face: {e}")
             self.is_active = False
     
+    @property
+    def quota_exceeded(self) -> bool:
+        """AI сейчас недоступен: breaker открыт или общий бюджет исчерпан"""
+        return get_ai_breaker().is_open or get_ai_budget().global_exhausted()
+
+    @quota_exceeded.setter
+    def quota_exceeded(self, value: bool):
+        # Ручная отметка исчерпанной квоты открывает breaker на время квоты
+        breaker = get_ai_breaker()
+        if value:
+            breaker.trip(breaker.quota_open_seconds, REASON_QUOTA)
+        else:
+            breaker.reset()
+
+    @property
+    def unavailable_message(self) -> Optional[str]:
+        """Почему AI сейчас недоступен - текст для пользователя (None, если доступен)"""
+        breaker = get_ai_breaker()
+        if breaker.is_open:
+            return AIUnavailableError(breaker.reason or REASON_CIRCUIT_OPEN).user_message
+        if get_ai_budget().global_exhausted():
+            return AIUnavailableError(REASON_BUDGET).user_message
+        return None
+
+    async def create_completion(self, **kwargs):
+        """Запрос к модели через breaker, бюджет и общую очередь AI-запросов
+
+        Если breaker открыт или бюджет исчерпан, сразу бросает
+        AIUnavailableError, и вызывающий код отдает fallback без ожидания
+        таймаута.
+        """
+        breaker, budget, org_id, probe = await self._admit()
+
+        async def call():
+            # Breaker мог открыться, пока запрос ждал в очереди
+            if not breaker.can_start(probe):
+                raise AIUnavailableError(breaker.reason or REASON_CIRCUIT_OPEN)
+            started = time.monotonic()
+            try:
+                response = await self.client.chat.completions.create(**kwargs)
+            except openai.APIStatusError as e:
+                self._record_status_error(e, time.monotonic() - started)
+                budget.record(org_id, 0)
+                raise
+            except Exception:
+                # Сеть, таймауты и прочие сбои (в том числе разбор ответа)
+                breaker.record_failure(time.monotonic() - started)
+                raise
+
+            breaker.record_success(time.monotonic() - started)
+            usage = getattr(response, "usage", None)
+            budget.record(org_id, getattr(usage, "total_tokens", 0) or 0)
+            return response
+
+        try:
+            return await get_ai_scheduler().run(call)
+        except asyncio.CancelledError:
+            breaker.record_cancelled(probe)
+            raise
+
+    async def stream_completion(self, **kwargs) -> AsyncIterator[str]:
+        """Потоковый запрос к модели: отдает текст по частям по мере генерации
+
+        Проходит те же breaker, бюджет и очередь, что и create_completion;
+        слот очереди занят, пока поток не закончится. Медленным считается
+        ответ, первый токен которого пришел позже порога.
+        """
+        breaker, budget, org_id, probe = await self._admit()
+
+        try:
+            async with get_ai_scheduler().slot():
+                if not breaker.can_start(probe):
+                    raise AIUnavailableError(breaker.reason or REASON_CIRCUIT_OPEN)
+                started = time.monotonic()
+                first_token_after = None
+                tokens = 0
+                stream = None
+                try:
+                    stream = await self.client.chat.completions.create(stream=True, **kwargs)
+                    async for chunk in stream:
+                        usage = getattr(chunk, "usage", None)
+                        if usage:
+                            tokens = getattr(usage, "total_tokens", 0) or 0
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            if first_token_after is None:
+                                first_token_after = time.monotonic() - started
+                            yield delta
+                except openai.APIStatusError as e:
+                    self._record_status_error(e, time.monotonic() - started)
+                    budget.record(org_id, 0)
+                    raise
+                except Exception:
+                    breaker.record_failure(time.monotonic() - started)
+                    raise
+                finally:
+                    if stream is not None:
+                        await stream.close()
+
+                breaker.record_success(
+                    first_token_after if first_token_after is not None else time.monotonic() - started
+                )
+                budget.record(org_id, tokens)
+        except (asyncio.CancelledError, GeneratorExit):
+            # Пользователь не дождался ответа или получатель остановил поток
+            breaker.record_cancelled(probe)
+            raise
+
+    async def _admit(self):
+        """Проверить бюджет и breaker перед запросом: (breaker, budget, org_id, probe)
+
+        probe - токен пробного запроса, если этот запрос проверяет half_open breaker.
+        """
+        breaker = get_ai_breaker()
+        budget = get_ai_budget()
+
+        org_id = current_ai_org()
+        if org_id is None and current_ai_user() is not None:
+            org_id = await asyncio.to_thread(resolve_org_id, current_ai_user())
+
+        budget.check(org_id)
+        allowed, probe = breaker.allow_request()
+        if not allowed:
+            raise AIUnavailableError(breaker.reason or REASON_CIRCUIT_OPEN)
+        return breaker, budget, org_id, probe
+
+    def _record_status_error(self, error: openai.APIStatusError, latency: float):
+        breaker = get_ai_breaker()
+        if error.status_code == 402:
+            logger.warning("Квота Hugging Face API исчерпана (402), AI отключен на время квоты")
+            breaker.trip(breaker.quota_open_seconds, REASON_QUOTA)
+        elif error.status_code == 429:
+            retry_after = error.response.headers.get("retry-after") if error.response else None
+            try:
+                seconds = float(retry_after) if retry_after else None
+            except ValueError:
+                seconds = None
+            breaker.trip(seconds, REASON_CIRCUIT_OPEN)
+        elif error.status_code >= 500:
+            breaker.record_failure(latency)
+        else:
+            # Ошибка в самом запросе: бэкенд отвечает, это не повод открывать breaker
+            breaker.record_success(latency)
+
     async def generate_response(self, prompt: str, system_prompt: str = None,
                             model: str = "deepseek-ai/DeepSeek-V3.2",
                             max_tokens: int = 500,
@@ -43,18 +232,13 @@ class HuggingFaceService:
         if not self.is_active or not self.client:
             return "AI сервис временно недоступен"
 
-        # Проверяем флаг превышения квоты
-        if self.quota_exceeded:
-            logger.warning("Квота AI превышена, возвращаем fallback ответ")
-            return "🤖 Квота AI запросов исчерпана. Попробуйте позже или обратитесь к администратору."
-
         try:
             messages = []
             if system_prompt:
                 messages.append({"role": "system", "content": system_prompt})
             messages.append({"role": "user", "content": prompt})
 
-            response = self.client.chat.completions.create(
+            response = await self.create_completion(
                 model=model,
                 messages=messages,
                 max_tokens=max_tokens,
@@ -64,6 +248,13 @@ class HuggingFaceService:
 
             return response.choices[0].message.content
 
+        except AIUnavailableError as e:
+            logger.info(f"AI недоступен ({e.reason}), возвращаем fallback ответ")
+            return e.user_message
+        except openai.APITimeoutError as e:
+            # Проверяется до APIError: таймаут - его подкласс
+            logger.error(f"Таймаут запроса к Hugging Face: {e}")
+            return "Превышено время ожидания ответа от AI. Попробуйте позже."
         except openai.APIError as e:
             if hasattr(e, 'status_code') and e.status_code == 402:
                 logger.warning("Квота Hugging Face API исчерпана (402 Payment Required)")
@@ -74,157 +265,86 @@ class HuggingFaceService:
             else:
                 logger.error(f"API ошибка Hugging Face: {e}")
                 return f"Ошибка API: {str(e)[:100]}"
-        except openai.Timeout as e:
-            logger.error(f"Таймаут запроса к Hugging Face: {e}")
-            return "Превышено время ожидания ответа от AI. Попробуйте позже."
         except Exception as e:
             logger.error(f"Ошибка генерации: {e}")
             return f"Ошибка генерации: {str(e)[:100]}"
     
-    async def get_json_response(self, prompt: str, max_retries: int = 1) -> Dict:
-        """Получение JSON ответа с улучшенной обработкой ошибок"""
+    async def get_json_response(self, prompt: str, max_retries: int = 1, schema: Any = None,
+                                system_prompt: str = None) -> Dict:
+        """Получение JSON ответа
+
+        Запрос идет с response_format=json_object, если бэкенд его
+        поддерживает. Ответ разбирается extract_json (первый сбалансированный
+        объект из текста, с починкой типичных ошибок) и проверяется по schema
+        (см. validate_json). Повторный запрос - не больше max_retries - делается
+        только если разобрать или проверить ответ не удалось, и сообщает
+        модели, что было не так.
+        """
         if not self.is_active:
             return {"error": "AI сервис недоступен"}
 
-        # Проверяем флаг превышения квоты
-        if self.quota_exceeded:
-            logger.warning("Квота уже превышена, пропускаем JSON запрос")
-            return {"error": "Квота AI запросов исчерпана"}
-
-        # Формируем промпт с требованием JSON
-        json_prompt = f"""{prompt}
-
-    ВАЖНО: Твой ответ должен быть ТОЛЬКО в формате JSON.
-    НЕ добавляй никакого текста кроме JSON.
-    НЕ используй markdown, НЕ оборачивай в ```.
-    Просто верни чистый JSON объект.
-
-    Пример правильного ответа:
-    {{"challenges": [{{"time": "morning", "title": "Название", "description": "Описание"}}]}}
-    """
+        messages = [
+            {"role": "system", "content": "\n\n".join(filter(None, [system_prompt, JSON_SYSTEM_PROMPT]))},
+            {"role": "user", "content": f"{prompt}\n\nОтвет - только JSON-объект, без markdown и пояснений."}
+        ]
+        json_stats["requests"] += 1
+        content = ""
 
-        for attempt in range(max_retries):
+        for attempt in range(max_retries + 1):
             try:
-                response = await self.generate_response(
-                    json_prompt,
-                    system_prompt="""Ты всегда возвращаешь ТОЛЬКО JSON без дополнительного текста.
-                    Твой ответ должен быть валидным JSON объектом.
-                    Не используй комментарии, не добавляй лишний текст.""",
-                    model="deepseek-ai/DeepSeek-V3.2",
-                    max_tokens=1000,
-                    temperature=0.3
-                )
-
-                logger.info(f"🔍 Получен сырой ответ (попытка {attempt + 1}): {response}")
-
-                if not response or response.strip() == "":
-                    logger.warning(f"Пустой ответ от AI (попытка {attempt + 1})")
-                    continue
-
-                cleaned_response = self._clean_json_response(response)
-                logger.info(f"🔍 Очищенный ответ: {cleaned_response}")
+                content = await self._complete_json(messages)
+            except AIUnavailableError as e:
+                logger.info(f"AI недоступен ({e.reason}), JSON запрос не выполнен")
+                return {"error": e.user_message}
+            except openai.APIStatusError as e:
+                # 402 и 429 уже учтены breaker'ом в create_completion
+                if e.status_code == 402:
+                    return {"error": "Квота AI запросов исчерпана"}
+                logger.error(f"API ошибка JSON запроса: {e}")
+                return {"error": f"Ошибка API: {str(e)[:100]}"}
+            except Exception as e:
+                logger.error(f"Ошибка JSON запроса: {e}")
+                return {"error": str(e)[:200]}
 
-                result = json.loads(cleaned_response)
-                logger.info(f"✅ Успешно распарсен JSON")
+            result, problem = parse_json_response(content, schema)
+            if problem is None:
                 return result
 
-            except json.JSONDecodeError as e:
-                logger.warning(f"Попытка {attempt + 1}: Невалидный JSON: {str(e)[:100]}")
-                logger.debug(f"Сырой ответ: {response[:500]}")
-
-                if attempt < max_retries - 1:
-                    try:
-                        fixed_json = self._fix_json(response)
-                        result = json.loads(fixed_json)
-                        logger.info(f"✅ JSON исправлен и распарсен")
-                        return result
-                    except:
-                        continue
-                else:
-                    return {"error": "AI вернул невалидный JSON формат", "raw_response": response[:500]}
+            logger.warning(f"Попытка {attempt + 1}: ответ не прошел проверку JSON ({problem})")
+            logger.debug(f"Сырой ответ: {content[:500]}")
+            if attempt < max_retries:
+                json_stats["retries"] += 1
+                messages = messages[:2] + [
+                    {"role": "assistant", "content": content[:2000]},
+                    {"role": "user", "content": f"Ответ не подошел: {problem}. Верни исправленный JSON-объект целиком."}
+                ]
 
-            except Exception as e:
-                logger.error(f"Попытка {attempt + 1} не удалась: {e}")
-                # Проверяем, является ли ошибка связанной с квотой
-                error_str = str(e).lower()
-                if "402" in error_str or "payment required" in error_str or "quota" in error_str:
-                    logger.warning("Квота исчерпана - прекращаем попытки")
-                    self.quota_exceeded = True  # Устанавливаем флаг
-                    return {"error": "Квота AI запросов исчерпана"}
-                if attempt < max_retries - 1:
-                    continue
-                else:
-                    return {"error": str(e)}
+        json_stats["failed"] += 1
+        return {"error": "AI вернул невалидный JSON формат", "raw_response": content[:500]}
 
-        return {"error": "Не удалось получить ответ от AI"}
+    async def _complete_json(self, messages: list) -> str:
+        """Текст ответа модели, по возможности в режиме JSON"""
+        kwargs = {
+            "model": "deepseek-ai/DeepSeek-V3.2",
+            "messages": messages,
+            "max_tokens": 1000,
+            "temperature": 0.3,
+            "timeout": 15.0,
+        }
 
-    def _clean_json_response(self, response: str) -> str:
-        """Очистка JSON ответа от лишнего текста"""
-        response = response.strip()
-        
-        # Удаляем markdown обертки
-        if response.startswith('```json'):
-            response = response[7:-3]
-        elif response.startswith('```'):
-            response = response[3:-3]
-        
-        # Удаляем текст до первого {
-        brace_pos = response.find('{')
-        if brace_pos > 0:
-            response = response[brace_pos:]
-        
-        # Удаляем текст после последнего }
-        last_brace = response.rfind('}')
-        if last_brace >= 0 and last_brace < len(response) - 1:
-            response = response[:last_brace + 1]
-        
-        # Удаляем комментарии (// или /* */)
-        response = re.sub(r'//.*$', '', response, flags=re.MULTILINE)
-        response = re.sub(r'/\*.*?\*/', '', response, flags=re.DOTALL)
-        
-        return response.strip()
+        if HuggingFaceService.json_mode_supported and self.config.ai_json_mode:
+            try:
+                response = await self.create_completion(response_format={"type": "json_object"}, **kwargs)
+                return response.choices[0].message.content or ""
+            except openai.BadRequestError as e:
+                if "response_format" not in str(e):
+                    raise
+                # Бэкенд не знает response_format - дальше разбираем JSON из текста
+                HuggingFaceService.json_mode_supported = False
+                logger.warning("⚠️ Бэкенд не поддерживает response_format=json_object, JSON извлекается из текста")
 
-    def _fix_json(self, response: str) -> str:
-        """Исправление распространенных ошибок в JSON"""
-        try:
-            # Заменяем одинарные кавычки на двойные (но не внутри текста)
-            lines = []
-            in_string = False
-            for line in response.split('\n'):
-                new_line = ''
-                for char in line:
-                    if char == '"':
-                        in_string = not in_string
-                        new_line += char
-                    elif char == "'" and not in_string:
-                        new_line += '"'
-                    else:
-                        new_line += char
-                lines.append(new_line)
-            response = '\n'.join(lines)
-            
-            # Исправляем незакрытые строки
-            response = re.sub(r'(?<!\\)"(?=[^"]*$)', '"', response)
-            
-            # Удаляем лишние запятые
-            response = re.sub(r',\s*}', '}', response)
-            response = re.sub(r',\s*]', ']', response)
-            
-            # Исправляем незакрытые скобки
-            open_braces = response.count('{')
-            close_braces = response.count('}')
-            if open_braces > close_braces:
-                response += '}' * (open_braces - close_braces)
-            
-            open_brackets = response.count('[')
-            close_brackets = response.count(']')
-            if open_brackets > close_brackets:
-                response += ']' * (open_brackets - close_brackets)
-            
-            return response
-        except Exception as e:
-            logger.error(f"Ошибка исправления JSON: {e}")
-            raise
+        response = await self.create_completion(**kwargs)
+        return response.choices[0].message.content or ""
     
     async def answer_question(self, question: str, context: Dict = None) -> str:
         """Ответ на вопрос пользователя"""
@@ -267,4 +387,4 @@ class HuggingFaceService:
     "success_tips": ["Совет 1", "Совет 2"]
 }}"""
         
-        return await self.get_json_response(prompt, system_prompt)
\ No newline at end of file
+        return await self.get_json_response(prompt, system_prompt=system_prompt)
\ No newline at end of file
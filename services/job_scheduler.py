@@ -0,0 +1,311 @@
+import logging
+import time as time_module
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from aiogram import Bot
+from apscheduler.events import (
+    EVENT_JOB_EXECUTED, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED, JobExecutionEvent
+)
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+
+import database.database as db
+
+logger = logging.getLogger(__name__)
+
+# Все фоновые задачи бота. Ключ - постоянный id задачи в хранилище,
+# handler - метод JobScheduler, который ее выполняет
+JOB_DEFINITIONS = {
+    "timezone_messages": {
+        "name": "Сообщения по расписанию",
+        "trigger": lambda: IntervalTrigger(seconds=60),
+        "misfire_grace_time": 300,
+        "handler": "_run_timezone_messages",
+    },
+    "scheduled_challenges": {
+        "name": "Запланированные челленджи",
+        "trigger": lambda: IntervalTrigger(seconds=60),
+        "misfire_grace_time": 120,
+        "handler": "_run_scheduled_challenges",
+    },
+    "daily_reminders": {
+        "name": "Напоминания о челленджах",
+        "trigger": lambda: CronTrigger(minute=0, timezone="UTC"),
+        "misfire_grace_time": 900,
+        "handler": "_run_daily_reminders",
+    },
+    "broadcast_outbox": {
+        "name": "Очередь рассылок",
+        "trigger": lambda: IntervalTrigger(seconds=10),
+        "misfire_grace_time": 60,
+        "handler": "_run_broadcast_outbox",
+    },
+    "cleanup_pending_challenges": {
+        "name": "Очистка устаревших челленджей",
+        "trigger": lambda: IntervalTrigger(hours=6),
+        "misfire_grace_time": 3600,
+        "handler": "_run_cleanup_pending_challenges",
+    },
+    "motivation_pool": {
+        "name": "Пополнение мотивационных фраз",
+        "trigger": lambda: IntervalTrigger(minutes=30),
+        "misfire_grace_time": 1800,
+        "handler": "_run_motivation_pool",
+    },
+    "challenge_precompute": {
+        "name": "Подготовка челленджей команд на день",
+        "trigger": lambda: CronTrigger(minute=15, timezone="UTC"),
+        "misfire_grace_time": 3600,
+        "handler": "_run_challenge_precompute",
+    },
+}
+
+
+async def run_job(job_id: str):
+    """Точка входа задачи из хранилища APScheduler
+
+    В хранилище сохраняется только ссылка на эту функцию и id задачи,
+    поэтому задачи переживают перезапуск, а бот и сервисы берутся из
+    текущего процесса.
+    """
+    if job_scheduler is None:
+        logger.warning(f"⚠️ Задача {job_id} пропущена: планировщик не инициализирован")
+        return
+    await job_scheduler.execute(job_id)
+
+
+class JobScheduler:
+    """Единый планировщик фоновых задач с постоянным хранилищем
+
+    Задачи хранятся в таблице apscheduler_jobs, поэтому время следующего
+    запуска сохраняется между перезапусками, а пропущенные запуски
+    обрабатываются по misfire_grace_time. Для каждой задачи собирается
+    статистика: число запусков и ошибок, длительность и задержка старта.
+    """
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.scheduler: Optional[AsyncIOScheduler] = None
+        self.stats: Dict[str, Dict] = {
+            job_id: self._empty_stats(definition["name"])
+            for job_id, definition in JOB_DEFINITIONS.items()
+        }
+        self._started_at: Dict[str, datetime] = {}
+        self._message_scheduler = None
+        self._challenge_scheduler = None
+        self._challenge_planner = None
+
+    @staticmethod
+    def _empty_stats(name: str) -> Dict:
+        return {
+            "name": name,
+            "runs": 0,
+            "failures": 0,
+            "missed": 0,
+            "overlaps": 0,
+            "last_run_at": None,
+            "last_duration": None,
+            "avg_duration": None,
+            "max_duration": None,
+            "last_lag": None,
+            "max_lag": None,
+            "last_error": None,
+        }
+
+    @property
+    def running(self) -> bool:
+        return self.scheduler is not None and self.scheduler.running
+
+    def start(self):
+        """Запустить планировщик и синхронизировать задачи с хранилищем"""
+        if self.running:
+            logger.warning("Планировщик задач уже запущен")
+            return
+
+        if db.engine is None:
+            db.init_engine()
+
+        self.scheduler = AsyncIOScheduler(
+            timezone="UTC",
+            jobstores={
+                "default": SQLAlchemyJobStore(engine=db.engine, tablename="apscheduler_jobs")
+            },
+            job_defaults={
+                "coalesce": True,  # Несколько пропущенных запусков выполняем один раз
+                "max_instances": 1,  # Запуски одной задачи не перекрываются
+            }
+        )
+        self.scheduler.add_listener(
+            self._on_job_event,
+            EVENT_JOB_EXECUTED | EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES
+        )
+        self.scheduler.start()
+        self._sync_jobs()
+
+        logger.info(f"✅ Планировщик задач запущен ({len(JOB_DEFINITIONS)} задач)")
+
+    def shutdown(self):
+        """Остановить планировщик (задачи остаются в хранилище)
+
+        Растянутые отправки сообщений тоже отменяются: после потери
+        лидерства их досылает новый лидер.
+        """
+        if self._message_scheduler is not None:
+            self._message_scheduler.shutdown()
+        if self.running:
+            self.scheduler.shutdown(wait=False)
+            logger.info("🛑 Планировщик задач остановлен")
+        self.scheduler = None
+
+    def _sync_jobs(self):
+        """Привести задачи в хранилище к JOB_DEFINITIONS
+
+        Задача с тем же расписанием остается как есть, чтобы сохранилось
+        время следующего запуска; измененная пересоздается; задачи, которых
+        больше нет в JOB_DEFINITIONS, удаляются.
+        """
+        for job_id, definition in JOB_DEFINITIONS.items():
+            trigger = definition["trigger"]()
+            existing = self.scheduler.get_job(job_id)
+
+            if existing and str(existing.trigger) == str(trigger):
+                self.scheduler.modify_job(
+                    job_id,
+                    name=definition["name"],
+                    misfire_grace_time=definition["misfire_grace_time"]
+                )
+                continue
+
+            self.scheduler.add_job(
+                run_job,
+                trigger,
+                args=[job_id],
+                id=job_id,
+                name=definition["name"],
+                misfire_grace_time=definition["misfire_grace_time"],
+                replace_existing=True
+            )
+            logger.info(f"➕ Задача {job_id} зарегистрирована: {trigger}")
+
+        for job in self.scheduler.get_jobs():
+            if job.id not in JOB_DEFINITIONS:
+                self.scheduler.remove_job(job.id)
+                logger.info(f"➖ Удалена устаревшая задача {job.id}")
+
+    async def execute(self, job_id: str):
+        """Выполнить задачу и учесть ее в статистике"""
+        definition = JOB_DEFINITIONS.get(job_id)
+        if not definition:
+            logger.warning(f"⚠️ Неизвестная задача {job_id}")
+            return
+
+        stats = self.stats[job_id]
+        self._started_at[job_id] = datetime.now(timezone.utc)
+        started = time_module.monotonic()
+
+        try:
+            await getattr(self, definition["handler"])()
+        except Exception as e:
+            stats["failures"] += 1
+            stats["last_error"] = str(e)[:200]
+            logger.error(f"❌ Ошибка задачи {job_id}: {e}", exc_info=True)
+        finally:
+            duration = time_module.monotonic() - started
+            stats["runs"] += 1
+            stats["last_run_at"] = self._started_at[job_id]
+            stats["last_duration"] = duration
+            stats["max_duration"] = max(stats["max_duration"] or 0, duration)
+            if stats["avg_duration"] is None:
+                stats["avg_duration"] = duration
+            else:
+                # Скользящее среднее, чтобы недавние запуски весили больше
+                stats["avg_duration"] = stats["avg_duration"] * 0.8 + duration * 0.2
+
+    def _on_job_event(self, event: JobExecutionEvent):
+        stats = self.stats.get(event.job_id)
+        if stats is None:
+            return
+
+        if event.code == EVENT_JOB_MISSED:
+            stats["missed"] += 1
+            logger.warning(f"⏭️ Задача {event.job_id} пропущена: запуск {event.scheduled_run_time} вне misfire_grace_time")
+        elif event.code == EVENT_JOB_MAX_INSTANCES:
+            stats["overlaps"] += 1
+            # Для долгих задач (рассылки) это штатная ситуация
+            logger.debug(f"Задача {event.job_id} еще выполняется, новый запуск пропущен")
+        elif event.code == EVENT_JOB_EXECUTED:
+            started_at = self._started_at.get(event.job_id)
+            if started_at and event.scheduled_run_time:
+                lag = max((started_at - event.scheduled_run_time).total_seconds(), 0.0)
+                stats["last_lag"] = lag
+                stats["max_lag"] = max(stats["max_lag"] or 0, lag)
+
+    def run_soon(self, job_id: str):
+        """Запустить задачу вне расписания, не дожидаясь интервала"""
+        if self.running and self.scheduler.get_job(job_id):
+            self.scheduler.modify_job(job_id, next_run_time=datetime.now(timezone.utc))
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """Статистика по всем задачам с временем следующего запуска"""
+        result = {}
+        for job_id, stats in self.stats.items():
+            job = self.scheduler.get_job(job_id) if self.running else None
+            result[job_id] = {
+                **stats,
+                "next_run_at": job.next_run_time if job else None,
+            }
+        return result
+
+    # Обработчики задач
+
+    async def _run_timezone_messages(self):
+        if self._message_scheduler is None:
+            from services.timezone_scheduler import TimezoneMessageScheduler
+            self._message_scheduler = TimezoneMessageScheduler(self.bot)
+        await self._message_scheduler.tick()
+
+    async def _run_scheduled_challenges(self):
+        if self._challenge_scheduler is None:
+            from services.challenge_sheduler import ChallengeScheduler
+            self._challenge_scheduler = ChallengeScheduler(self.bot)
+        await self._challenge_scheduler.tick()
+
+    async def _run_daily_reminders(self):
+        from services.reminder import SimpleReminderService
+        await SimpleReminderService(self.bot).send_daily_reminders()
+
+    async def _run_broadcast_outbox(self):
+        from services.broadcast_outbox import broadcast_outbox
+        await broadcast_outbox.drain(self.bot)
+
+    async def _run_cleanup_pending_challenges(self):
+        from services.challenge_storage import challenge_storage
+
+        cleaned = await challenge_storage.cleanup_expired()
+        if cleaned > 0:
+            logger.info(f"Очищено {cleaned} просроченных записей")
+
+        stats = await challenge_storage.get_statistics()
+        logger.debug(f"Статистика хранилища: {stats}")
+
+    async def _run_motivation_pool(self):
+        from services.motivation_pool import motivation_pool
+        await motivation_pool.refill()
+
+    async def _run_challenge_precompute(self):
+        if self._challenge_planner is None:
+            from services.ai_challenge_planer import AIChallengePlanner
+            self._challenge_planner = AIChallengePlanner()
+        await self._challenge_planner.precompute_due_orgs()
+
+
+job_scheduler: Optional[JobScheduler] = None
+
+def init_job_scheduler(bot: Bot) -> JobScheduler:
+    """Инициализировать JobScheduler"""
+    global job_scheduler
+    job_scheduler = JobScheduler(bot)
+    return job_scheduler
@@ -0,0 +1,228 @@
+import ast
+import json
+import logging
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Сколько первых "{" в тексте пробуем как начало JSON-объекта
+_MAX_CANDIDATES = 3
+_CLOSERS = {"{": "}", "[": "]"}
+_FENCE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.DOTALL | re.IGNORECASE)
+
+# Исходы разбора JSON-ответов модели с момента запуска:
+# native - ответ целиком валидный JSON, extracted - объект найден в тексте,
+# repaired - объект пришлось чинить, parse/schema_failures - попытка не удалась
+json_stats = {
+    "requests": 0,
+    "attempts": 0,
+    "native": 0,
+    "extracted": 0,
+    "repaired": 0,
+    "parse_failures": 0,
+    "schema_failures": 0,
+    "retries": 0,
+    "failed": 0,
+}
+
+
+def get_json_stats() -> Dict[str, Any]:
+    """Статистика разбора JSON-ответов и доля неудачных попыток"""
+    failures = json_stats["parse_failures"] + json_stats["schema_failures"]
+    attempts = json_stats["attempts"]
+    return {**json_stats, "failure_rate": failures / attempts if attempts else 0.0}
+
+
+def extract_json(text: Optional[str]) -> Tuple[Optional[Any], str]:
+    """Первый JSON-объект из ответа модели и способ, которым он получен
+
+    Сначала текст разбирается целиком, затем внутри ```-блока, затем с
+    каждой из первых "{" берется сбалансированный фрагмент (с учетом строк
+    и экранирования). Фрагмент без пары чинится: убираются комментарии и
+    хвостовые запятые, закрываются оборванные строка и скобки, одинарные
+    кавычки разбираются как литерал Python.
+
+    Returns:
+        (объект или None, "native" | "extracted" | "repaired" | "failed")
+    """
+    text = (text or "").strip()
+    if not text:
+        return None, "failed"
+
+    try:
+        return json.loads(text), "native"
+    except ValueError:
+        pass
+
+    fenced = _FENCE.search(text)
+    sources = [fenced.group(1), text] if fenced else [text]
+    decoder = json.JSONDecoder()
+
+    for source in sources:
+        start = source.find("{")
+        for _ in range(_MAX_CANDIDATES):
+            if start < 0:
+                break
+            try:
+                value, _ = decoder.raw_decode(source, start)
+                return value, "extracted"
+            except ValueError:
+                pass
+
+            fragment, complete = _balanced_fragment(source, start)
+            value = _parse_repaired(fragment)
+            if value is not None:
+                return value, "repaired"
+            if complete:
+                start = source.find("{", start + len(fragment))
+            else:
+                # Объект оборван: дальше в тексте только его вложенные части
+                break
+
+    return None, "failed"
+
+
+def _balanced_fragment(text: str, start: int) -> Tuple[str, bool]:
+    """Фрагмент от start до парной скобки; оборванный - дополняется закрывающими"""
+    stack: List[str] = []
+    in_string = False
+    escaped = False
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+
+        if char == '"':
+            in_string = True
+        elif char in _CLOSERS:
+            stack.append(_CLOSERS[char])
+        elif char in ("}", "]"):
+            if stack and stack[-1] == char:
+                stack.pop()
+            if not stack:
+                return text[start:index + 1], True
+
+    tail = ('"' if in_string else "") + "".join(reversed(stack))
+    return text[start:] + tail, False
+
+
+def _strip_outside_strings(fragment: str) -> str:
+    """Убрать комментарии и хвостовые запятые вне строк"""
+    result = []
+    in_string = False
+    escaped = False
+    index = 0
+    while index < len(fragment):
+        char = fragment[index]
+        if in_string:
+            result.append(char)
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            index += 1
+            continue
+
+        if char == '"':
+            in_string = True
+        elif fragment.startswith("//", index):
+            end = fragment.find("\n", index)
+            index = end if end >= 0 else len(fragment)
+            continue
+        elif fragment.startswith("/*", index):
+            end = fragment.find("*/", index + 2)
+            index = end + 2 if end >= 0 else len(fragment)
+            continue
+        elif char == ",":
+            rest = fragment[index + 1:].lstrip()
+            if not rest or rest[0] in "}]":
+                index += 1
+                continue
+        result.append(char)
+        index += 1
+    return "".join(result)
+
+
+def _parse_repaired(fragment: str) -> Optional[Any]:
+    cleaned = _strip_outside_strings(fragment)
+    try:
+        return json.loads(cleaned)
+    except ValueError:
+        pass
+    try:
+        # {'key': 'value'}, True/None - модель ответила литералом Python
+        value = ast.literal_eval(cleaned)
+        return value if isinstance(value, (dict, list)) else None
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+
+
+def validate_json(value: Any, schema: Any, path: str = "ответ") -> List[str]:
+    """Проверить значение по простой схеме, вернуть список ошибок
+
+    Схема:
+        - тип или кортеж типов (object - любое значение);
+        - словарь {ключ: схема} - объект с обязательными ключами
+          (ключ с "?" на конце необязателен);
+        - список [схема] - список, каждый элемент которого подходит под схему.
+    """
+    if isinstance(schema, dict):
+        if not isinstance(value, dict):
+            return [f"{path}: ожидался объект"]
+        errors = []
+        for key, item_schema in schema.items():
+            optional = key.endswith("?")
+            key = key.rstrip("?")
+            if key not in value:
+                if not optional:
+                    errors.append(f"{path}: нет поля \"{key}\"")
+                continue
+            errors.extend(validate_json(value[key], item_schema, f"{path}.{key}"))
+        return errors
+
+    if isinstance(schema, list):
+        if not isinstance(value, list):
+            return [f"{path}: ожидался список"]
+        errors = []
+        for index, item in enumerate(value):
+            errors.extend(validate_json(item, schema[0], f"{path}[{index}]"))
+        return errors
+
+    types = schema if isinstance(schema, tuple) else (schema,)
+    if object in types:
+        return []
+    if isinstance(value, bool) and bool not in types:
+        return [f"{path}: неверный тип"]
+    if float in types and isinstance(value, int):
+        return []
+    if not isinstance(value, types):
+        return [f"{path}: неверный тип"]
+    return []
+
+
+def parse_json_response(text: Optional[str], schema: Any = None) -> Tuple[Optional[Dict], Optional[str]]:
+    """Разобрать ответ модели: (объект, None) или (None, описание проблемы для повторного запроса)"""
+    json_stats["attempts"] += 1
+    value, method = extract_json(text)
+    if not isinstance(value, dict):
+        json_stats["parse_failures"] += 1
+        return None, "ответ не содержит JSON-объекта"
+
+    json_stats[method] += 1
+    if method == "repaired":
+        logger.info("🔧 JSON-ответ модели исправлен при разборе")
+
+    errors = validate_json(value, schema) if schema is not None else []
+    if errors:
+        json_stats["schema_failures"] += 1
+        return None, "; ".join(errors[:5])
+    return value, None
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy import text
+
+import database.database as db
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderElection:
+    """Выбор реплики-лидера через advisory lock в PostgreSQL
+
+    Лидер держит сессионный pg_advisory_lock на отдельном соединении.
+    Пока соединение живо, блокировка принадлежит ему; если процесс падает
+    или соединение рвется, PostgreSQL снимает блокировку сам, и ее
+    забирает следующая реплика.
+    """
+
+    def __init__(self, lock_id: int, heartbeat_interval: float = 15.0,
+                 retry_interval: float = 30.0):
+        """
+        Args:
+            lock_id: Ключ advisory lock (одинаковый для всех реплик)
+            heartbeat_interval: Как часто лидер проверяет, что блокировка за ним
+            retry_interval: Как часто остальные реплики пытаются стать лидером
+        """
+        self.lock_id = lock_id
+        self.heartbeat_interval = heartbeat_interval
+        self.retry_interval = retry_interval
+        self.is_leader = False
+        self._connection = None
+        self._stop_event = asyncio.Event()
+
+    async def run(
+        self,
+        on_elected: Callable[[], Awaitable[None]],
+        on_demoted: Callable[[], Awaitable[None]]
+    ):
+        """Основной цикл: захват блокировки, heartbeat и передача лидерства"""
+        logger.info(f"🗳️ Выбор лидера запущен (lock_id={self.lock_id})")
+
+        while not self._stop_event.is_set():
+            if not self.is_leader:
+                acquired = await asyncio.to_thread(self._try_acquire)
+                if acquired:
+                    self.is_leader = True
+                    logger.info("👑 Эта реплика стала лидером, запускаю фоновые задачи")
+                    await self._safe_call(on_elected)
+                    interval = self.heartbeat_interval
+                else:
+                    logger.debug("Лидер уже выбран, жду следующей попытки")
+                    interval = self.retry_interval
+            else:
+                alive = await asyncio.to_thread(self._heartbeat)
+                if not alive:
+                    logger.warning("💔 Блокировка лидера потеряна, останавливаю фоновые задачи")
+                    self.is_leader = False
+                    await asyncio.to_thread(self._close_connection)
+                    await self._safe_call(on_demoted)
+                    interval = self.retry_interval
+                else:
+                    interval = self.heartbeat_interval
+
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+
+        if self.is_leader:
+            self.is_leader = False
+            await self._safe_call(on_demoted)
+        await asyncio.to_thread(self._release)
+        logger.info("⏹️ Выбор лидера остановлен")
+
+    def stop(self):
+        """Остановить цикл и отдать лидерство"""
+        self._stop_event.set()
+
+    async def _safe_call(self, callback: Callable[[], Awaitable[None]]):
+        try:
+            await callback()
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработчика смены лидера: {e}", exc_info=True)
+
+    def _is_postgres(self) -> bool:
+        if db.engine is None:
+            db.init_engine()
+        return db.engine.dialect.name == "postgresql"
+
+    def _try_acquire(self) -> bool:
+        """Попытаться захватить блокировку без ожидания"""
+        try:
+            if not self._is_postgres():
+                # Advisory lock есть только в PostgreSQL: без него считаем,
+                # что реплика одна и она же лидер
+                logger.warning("⚠️ БД не PostgreSQL, выбор лидера отключен")
+                return True
+
+            if self._connection is None:
+                self._connection = db.engine.connect()
+
+            acquired = self._connection.execute(
+                text("SELECT pg_try_advisory_lock(:lock_id)"),
+                {"lock_id": self.lock_id}
+            ).scalar()
+            self._connection.commit()
+
+            if not acquired:
+                self._close_connection()
+            return bool(acquired)
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка захвата блокировки лидера: {e}")
+            self._close_connection()
+            return False
+
+    def _heartbeat(self) -> bool:
+        """Проверить, что соединение живо и блокировка все еще наша"""
+        if self._connection is None:
+            # Не PostgreSQL - лидерство не может быть потеряно
+            return not self._is_postgres()
+
+        try:
+            held = self._connection.execute(
+                text(
+                    "SELECT EXISTS ("
+                    " SELECT 1 FROM pg_locks"
+                    " WHERE locktype = 'advisory' AND granted"
+                    " AND pid = pg_backend_pid()"
+                    " AND ((classid::bigint << 32) | objid::bigint) = :lock_id"
+                    ")"
+                ),
+                {"lock_id": self.lock_id}
+            ).scalar()
+            self._connection.commit()
+            return bool(held)
+        except Exception as e:
+            logger.error(f"❌ Heartbeat лидера не прошел: {e}")
+            return False
+
+    def _release(self):
+        """Явно снять блокировку и закрыть соединение"""
+        if self._connection is None:
+            return
+        try:
+            self._connection.execute(
+                text("SELECT pg_advisory_unlock(:lock_id)"),
+                {"lock_id": self.lock_id}
+            )
+            self._connection.commit()
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось снять блокировку лидера: {e}")
+        self._close_connection()
+
+    def _close_connection(self):
+        if self._connection is None:
+            return
+        try:
+            # Сессионная блокировка живет, пока живет соединение, поэтому
+            # соединение не возвращаем в пул, а закрываем насовсем
+            self._connection.invalidate()
+            self._connection.close()
+        except Exception:
+            pass
+        finally:
+            self._connection = None
+
+
+leader_election: Optional[LeaderElection] = None
+
+def init_leader_election(lock_id: int, heartbeat_interval: float = 15.0,
+                         retry_interval: float = 30.0) -> LeaderElection:
+    """Инициализировать LeaderElection"""
+    global leader_election
+    leader_election = LeaderElection(lock_id, heartbeat_interval, retry_interval)
+    return leader_election
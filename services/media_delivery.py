@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+from typing import Optional, Union
+
+from aiogram.types import FSInputFile, InputFile, Message
+
+from database import get_session
+from services.message_dispatcher import MessageDispatcher, Priority
+
+logger = logging.getLogger(__name__)
+
+# Типы вложений рассылок и расписаний
+MEDIA_PHOTO = "photo"
+MEDIA_DOCUMENT = "document"
+
+MEDIA_METHODS = {
+    MEDIA_PHOTO: "send_photo",
+    MEDIA_DOCUMENT: "send_document",
+}
+
+MEDIA_NAMES = {
+    MEDIA_PHOTO: "фото",
+    MEDIA_DOCUMENT: "документ",
+}
+
+CAPTION_LIMIT = 1024  # Telegram ограничивает подпись к медиа 1024 символами
+
+
+def extract_file_id(message: Message, media_type: str) -> Optional[str]:
+    """file_id вложения из отправленного (или полученного) сообщения"""
+    if media_type == MEDIA_PHOTO and message.photo:
+        # Самый большой размер - последний
+        return message.photo[-1].file_id
+    if media_type == MEDIA_DOCUMENT and message.document:
+        return message.document.file_id
+    return None
+
+
+def attachment_from_message(message: Message):
+    """Вложение из сообщения администратора: (тип, file_id) или (None, None)"""
+    if message.photo:
+        return MEDIA_PHOTO, message.photo[-1].file_id
+    if message.document:
+        return MEDIA_DOCUMENT, message.document.file_id
+    return None, None
+
+
+def save_file_id(model, object_id: int, file_id: str):
+    """Запомнить file_id у рассылки/расписания, чтобы больше не загружать файл"""
+    session = get_session()
+    try:
+        session.query(model).filter(model.id == object_id).update(
+            {"attachment_file_id": file_id}, synchronize_session=False
+        )
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"❌ Не удалось сохранить file_id вложения: {e}")
+    finally:
+        session.close()
+
+
+def media_for(obj) -> Optional["UploadOnceMedia"]:
+    """Вложение рассылки или расписания (None, если его нет)"""
+    if not obj.attachment_type or not (obj.attachment_file_id or obj.attachment_path):
+        return None
+    return UploadOnceMedia(
+        obj.attachment_type,
+        file_id=obj.attachment_file_id,
+        source=obj.attachment_path
+    )
+
+
+class UploadOnceMedia:
+    """Вложение, которое загружается в Telegram один раз на всю рассылку
+
+    Первый получатель получает файл загрузкой (FSInputFile/BufferedInputFile),
+    из ответа берется file_id, и всем остальным отправляется уже он - без
+    повторной передачи байтов. Пока идет первая загрузка, параллельные
+    отправки fan_out ждут ее, а если она не удалась (получатель недоступен),
+    загрузку повторяет следующий получатель.
+    """
+
+    def __init__(self, media_type: str, file_id: Optional[str] = None,
+                 source: Optional[Union[InputFile, str]] = None):
+        """
+        Args:
+            media_type: MEDIA_PHOTO или MEDIA_DOCUMENT
+            file_id: Уже известный file_id (загрузка не понадобится)
+            source: Файл для первой загрузки: InputFile или путь на диске
+        """
+        if media_type not in MEDIA_METHODS:
+            raise ValueError(f"Неизвестный тип вложения: {media_type}")
+        if file_id is None and source is None:
+            raise ValueError("Нужен file_id или файл для загрузки")
+
+        self.media_type = media_type
+        self.file_id = file_id
+        self.source = FSInputFile(source) if isinstance(source, str) else source
+        self.uploads = 0  # Сколько раз файл реально передавался
+        self.bytes_uploaded = 0
+        self._upload_lock = asyncio.Lock()
+
+    @property
+    def method(self) -> str:
+        return MEDIA_METHODS[self.media_type]
+
+    async def send(self, dispatcher: MessageDispatcher, chat_id: int, caption: str = "",
+                   priority: Priority = Priority.BULK, org_id: Optional[int] = None, **kwargs):
+        """Отправить вложение (и текст) одному получателю"""
+        # Длинный текст не помещается в подпись - отправляем его отдельно
+        fits = len(caption or "") <= CAPTION_LIMIT
+        media_kwargs = dict(kwargs) if fits else {}
+        if caption and fits:
+            media_kwargs["caption"] = caption
+
+        result = await self._send_media(dispatcher, chat_id, priority, org_id, media_kwargs)
+
+        if caption and not fits:
+            result = await dispatcher.send_message(
+                chat_id, caption, priority=priority, org_id=org_id, **kwargs
+            )
+        return result
+
+    async def _send_media(self, dispatcher: MessageDispatcher, chat_id: int,
+                          priority: Priority, org_id: Optional[int], kwargs: dict):
+        if self.file_id is None:
+            async with self._upload_lock:
+                if self.file_id is None:
+                    return await self._upload(dispatcher, chat_id, priority, org_id, kwargs)
+
+        return await dispatcher.call(
+            self.method, chat_id, priority, org_id=org_id,
+            **{self.media_type: self.file_id}, **kwargs
+        )
+
+    async def _upload(self, dispatcher: MessageDispatcher, chat_id: int,
+                      priority: Priority, org_id: Optional[int], kwargs: dict):
+        self.uploads += 1
+        self.bytes_uploaded += self._source_size()
+
+        message = await dispatcher.call(
+            self.method, chat_id, priority, org_id=org_id,
+            **{self.media_type: self.source}, **kwargs
+        )
+
+        self.file_id = extract_file_id(message, self.media_type)
+        if self.file_id:
+            logger.info("📎 Вложение загружено один раз, file_id сохранен для остальных получателей")
+        else:
+            logger.warning("⚠️ Не удалось получить file_id вложения, следующая отправка загрузит файл снова")
+        return message
+
+    def _source_size(self) -> int:
+        path = getattr(self.source, "path", None)
+        if path:
+            try:
+                return os.path.getsize(path)
+            except OSError:
+                return 0
+        data = getattr(self.source, "data", None)
+        return len(data) if data is not None else 0
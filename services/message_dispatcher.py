@@ -0,0 +1,327 @@
+import asyncio
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram import Bot
+
+from config import load_config
+from services.recipient_health import mark_unreachable, migrate_chat
+from services.delivery import (
+    MAX_ATTEMPTS, MAX_RETRY_AFTER, DeliveryError, backoff_delay,
+    classify_error, record_dead_letter
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """Полосы приоритета исходящих сообщений (меньше - важнее)"""
+    INTERACTIVE = 0  # Ответы пользователю, который ждет прямо сейчас
+    SCHEDULED = 1  # Сообщения по расписанию, челленджи, напоминания
+    BULK = 2  # Массовые рассылки администраторов
+
+
+@dataclass
+class OutgoingMessage:
+    """Запрос к Bot API в очереди диспетчера"""
+    method: str
+    chat_id: int
+    kwargs: Dict[str, Any]
+    priority: Priority
+    future: asyncio.Future = field(repr=False)
+    org_id: Optional[int] = None
+    weight: float = 1.0
+    finish_tag: float = 0.0
+    attempts: int = 0
+    retry_after_waits: int = 0
+    migrated: bool = False
+
+
+class TokenBucket:
+    """Глобальный лимит запросов в секунду с небольшим запасом на всплеск"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float):
+        """Остановить все отправки (flood wait распространяется на весь бот)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class MessageDispatcher:
+    """Единая очередь исходящих сообщений бота
+
+    Все рассылки и фоновые отправки идут через один диспетчер, чтобы вместе
+    не превышать глобальный лимит Telegram (~30 сообщений в секунду):
+    - глобальный token bucket ограничивает общий темп;
+    - между сообщениями в один чат выдерживается минимальный интервал;
+    - очередь с приоритетами пропускает интерактивные ответы вперед
+      сообщений по расписанию, а их - вперед массовых рассылок;
+    - внутри одного приоритета организации обслуживаются по взвешенной
+      справедливой очереди, поэтому маленькая команда не ждет, пока
+      большой клуб получит все свои сообщения;
+    - на TelegramRetryAfter вся очередь ждет указанное время, сетевые
+      ошибки повторяются с задержкой, а окончательно не доставленные
+      сообщения попадают в dead_letters и отдаются отправителю как
+      DeliveryError с причиной.
+    """
+
+    max_in_flight = 20  # Одновременных запросов к Bot API
+
+    def __init__(self, bot: Bot, rate_per_second: float = None, per_chat_interval: float = None):
+        config = load_config()
+        self.bot = bot
+        self.per_chat_interval = (
+            per_chat_interval if per_chat_interval is not None else config.telegram_per_chat_interval
+        )
+        rate = rate_per_second or config.telegram_rate_per_second
+        self.bucket = TokenBucket(rate=rate, capacity=rate)
+
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._sequence = itertools.count()
+        # Взвешенная справедливая очередь: виртуальное время каждой полосы
+        # и последний finish tag каждой организации в ней
+        self._virtual_time: Dict[Priority, float] = {priority: 0.0 for priority in Priority}
+        self._last_finish: Dict[Tuple[Priority, Any], float] = {}
+        self._chat_ready_at: Dict[int, float] = {}
+        self._in_flight: Optional[asyncio.Semaphore] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.stats = {
+            priority.name: {"sent": 0, "failed": 0, "retried": 0}
+            for priority in Priority
+        }
+
+    @property
+    def running(self) -> bool:
+        return self._worker is not None and not self._worker.done()
+
+    def start(self):
+        """Запустить обработку очереди"""
+        if self.running:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        self._worker = asyncio.create_task(self._run())
+        logger.info(
+            f"✅ Диспетчер сообщений запущен ({self.bucket.rate:.0f} msg/s, "
+            f"интервал в чат {self.per_chat_interval:.1f} с)"
+        )
+
+    async def stop(self):
+        """Остановить обработку очереди"""
+        if self._worker:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+        logger.info("⏹️ Диспетчер сообщений остановлен")
+
+    def queue_size(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    async def send_message(self, chat_id: int, text: str,
+                           priority: Priority = Priority.SCHEDULED,
+                           org_id: Optional[int] = None, weight: float = 1.0, **kwargs):
+        """Поставить сообщение в очередь и дождаться отправки"""
+        return await self.call(
+            "send_message", chat_id, priority, org_id=org_id, weight=weight, text=text, **kwargs
+        )
+
+    async def call(self, method: str, chat_id: int,
+                   priority: Priority = Priority.SCHEDULED,
+                   org_id: Optional[int] = None, weight: float = 1.0, **kwargs):
+        """Выполнить метод Bot API (send_message, send_photo, ...) через очередь
+
+        Args:
+            org_id: Организация-получатель; внутри приоритета организации
+                делят пропускную способность поровну (с учетом weight)
+            weight: Доля организации относительно остальных (по умолчанию 1)
+
+        Возвращает результат метода или пробрасывает исключение aiogram.
+        """
+        if not self.running:
+            self.start()
+
+        future = asyncio.get_running_loop().create_future()
+        request = OutgoingMessage(
+            method, chat_id, kwargs, Priority(priority), future,
+            org_id=org_id, weight=max(weight, 0.01)
+        )
+        request.finish_tag = self._assign_finish_tag(request)
+        self._queue.put_nowait(self._queue_item(request))
+        return await future
+
+    def _assign_finish_tag(self, request: OutgoingMessage) -> float:
+        """Finish tag сообщения в справедливой очереди (start-time fair queueing)
+
+        Каждая организация продвигается по виртуальному времени со скоростью
+        1/weight на сообщение, поэтому тысяча сообщений одного клуба
+        перемежается с сообщениями других организаций, а не идет перед ними.
+        Сообщения без org_id считаются отдельным потоком на каждый чат.
+        """
+        flow = (request.priority, request.org_id if request.org_id is not None else ("chat", request.chat_id))
+        start = max(self._virtual_time[request.priority], self._last_finish.get(flow, 0.0))
+        finish = start + 1.0 / request.weight
+        self._last_finish[flow] = finish
+        return finish
+
+    def _queue_item(self, request: OutgoingMessage) -> Tuple:
+        return (request.priority, request.finish_tag, next(self._sequence), request)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            item = await self._queue.get()
+            request = item[-1]
+
+            # Отправитель уже не ждет ответа (задача отменена)
+            if request.future.done():
+                continue
+
+            # Чат еще "остывает" - возвращаем запрос в очередь позже,
+            # не задерживая сообщения в другие чаты
+            now = time.monotonic()
+            ready_at = self._chat_ready_at.get(request.chat_id, 0)
+            if ready_at > now:
+                loop.call_later(ready_at - now, self._queue.put_nowait, item)
+                continue
+
+            await self.bucket.acquire()
+            await self._in_flight.acquire()
+
+            self._virtual_time[request.priority] = max(
+                self._virtual_time[request.priority], request.finish_tag
+            )
+            self._chat_ready_at[request.chat_id] = time.monotonic() + self.per_chat_interval
+            asyncio.create_task(self._execute(request))
+
+            self._forget_cold_chats()
+            self._forget_idle_flows()
+
+    def _requeue(self, request: OutgoingMessage, delay: float = 0):
+        # Повтор сохраняет свой finish tag и не теряет место в очереди
+        item = self._queue_item(request)
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, item)
+        else:
+            self._queue.put_nowait(item)
+
+    async def _execute(self, request: OutgoingMessage):
+        request.attempts += 1
+        try:
+            method = getattr(self.bot, request.method)
+            result = await method(chat_id=request.chat_id, **request.kwargs)
+            self.stats[request.priority.name]["sent"] += 1
+            if not request.future.done():
+                request.future.set_result(result)
+        except Exception as e:
+            error = classify_error(e)
+            self._in_flight.release()
+            await self._handle_failure(request, error)
+            return
+        self._in_flight.release()
+
+    async def _handle_failure(self, request: OutgoingMessage, error: DeliveryError):
+        stats = self.stats[request.priority.name]
+
+        if error.retry_after is not None and request.retry_after_waits < MAX_RETRY_AFTER:
+            # Flood wait: Telegram ограничил весь бот, а не только этот чат
+            request.retry_after_waits += 1
+            request.attempts -= 1
+            stats["retried"] += 1
+            self.bucket.pause(error.retry_after)
+            logger.warning(f"⏳ Flood wait {error.retry_after:.0f} с, отправки приостановлены")
+            self._requeue(request)
+            return
+
+        if error.migrate_to_chat_id and not request.migrated:
+            # Группа стала супергруппой: один повтор в новый чат
+            request.migrated = True
+            stats["retried"] += 1
+            await asyncio.to_thread(migrate_chat, request.chat_id, error.migrate_to_chat_id)
+            request.chat_id = error.migrate_to_chat_id
+            self._requeue(request)
+            return
+
+        if not error.permanent and error.retry_after is None and request.attempts < MAX_ATTEMPTS:
+            delay = backoff_delay(request.attempts)
+            stats["retried"] += 1
+            logger.info(
+                f"🔁 Повтор отправки в чат {request.chat_id} через {delay:.1f} с "
+                f"(попытка {request.attempts + 1}/{MAX_ATTEMPTS}, {error.reason})"
+            )
+            self._requeue(request, delay)
+            return
+
+        stats["failed"] += 1
+        await asyncio.to_thread(
+            record_dead_letter, request.chat_id, request.method,
+            request.kwargs, error, request.attempts
+        )
+        if error.recipient_gone:
+            # Больше не тратим запросы на этот чат, пока пользователь не напишет сам
+            await asyncio.to_thread(mark_unreachable, request.chat_id, error.reason)
+        if not request.future.done():
+            request.future.set_exception(error)
+
+    def _forget_idle_flows(self):
+        # Организация, чьи сообщения все отправлены, начнет с текущего
+        # виртуального времени, поэтому ее прошлый tag можно забыть
+        if len(self._last_finish) < 10000:
+            return
+        self._last_finish = {
+            flow: finish
+            for flow, finish in self._last_finish.items()
+            if finish > self._virtual_time[flow[0]]
+        }
+
+    def _forget_cold_chats(self):
+        # Не держим в памяти чаты, интервал которых давно прошел
+        if len(self._chat_ready_at) < 10000:
+            return
+        now = time.monotonic()
+        self._chat_ready_at = {
+            chat_id: ready_at
+            for chat_id, ready_at in self._chat_ready_at.items()
+            if ready_at > now
+        }
+
+
+message_dispatcher: Optional[MessageDispatcher] = None
+
+def init_message_dispatcher(bot: Bot) -> MessageDispatcher:
+    """Инициализировать MessageDispatcher"""
+    global message_dispatcher
+    message_dispatcher = MessageDispatcher(bot)
+    return message_dispatcher
+
+def get_message_dispatcher(bot: Bot) -> MessageDispatcher:
+    """Общий диспетчер (создается при первом обращении)"""
+    if message_dispatcher is None:
+        init_message_dispatcher(bot)
+    return message_dispatcher
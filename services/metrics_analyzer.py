@@ -1,8 +1,12 @@
+import asyncio
 import logging
+import re
 from typing import Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
 from database import get_session, User, Survey
 from services.ai_service import AIService
+from services.ai_scheduler import AIPriority, ai_request_context
+from services.prompt_builder import PromptBuilder
 import json
 
 logger = logging.getLogger(__name__)
@@ -314,9 +318,14 @@ class ProffKonstaltingMetrics:
         """Получить все определения метрик"""
         return self.metrics_definitions
 
+    def get_ai_survey_metrics(self) -> List[str]:
+        """Метрики полного AI-опроса по порядку (проффценности считаются автоматически)"""
+        return [metric_key for metric_key in self.metrics_definitions if metric_key != "professional_values"]
 
 
-    async def generate_ai_questions_based_on_answers(self, user_context: Dict) -> Dict[str, List[str]]:
+
+    async def generate_ai_questions_based_on_answers(self, user_context: Dict,
+                                                     metric_keys: Optional[List[str]] = None) -> Dict[str, List[str]]:
         """
         Генерация AI-вопросов на основе структурированного контекста пользователя для глубокого анализа каждой метрики
 
@@ -339,6 +348,7 @@ class ProffKonstaltingMetrics:
             },
             'has_history': bool
         }
+        metric_keys: для каких метрик генерировать вопросы (по умолчанию для всех)
 
         Возвращает словарь с дополнительными вопросами по каждой метрике для более точной оценки
         """
@@ -366,35 +376,44 @@ class ProffKonstaltingMetrics:
             for metric_key, metric_def in self.metrics_definitions.items():
                 if metric_key == "professional_values":
                     continue
+                if metric_keys is not None and metric_key not in metric_keys:
+                    continue
                 ai_questions[metric_key] = self.survey_questions.get(metric_key, [])[:4]
             return ai_questions
 
         # Создаем общий контекст из всех ответов пользователя
-        all_answers_text = ""
+        all_answers = []
         for metric_key, answers in answers_by_metric.items():
-            if answers:
-                metric_name = self.metrics_definitions.get(metric_key, {}).get('name', metric_key)
-                all_answers_text += f"\nМЕТРИКА: {metric_name}\n"
-                for answer_data in answers[-3:]:  # Берем последние 3 ответа по каждой метрике
-                    all_answers_text += f"Вопрос: {answer_data['question']}\nОтвет: {answer_data['answer']}\n"
+            metric_name = self.metrics_definitions.get(metric_key, {}).get('name', metric_key)
+            for answer_data in answers[-3:]:  # Берем последние 3 ответа по каждой метрике
+                all_answers.append((metric_key, metric_name, answer_data))
 
         # Генерируем персонализированные вопросы для каждой метрики
-        for metric_key, metric_def in self.metrics_definitions.items():
-            if metric_key == "professional_values":
-                continue  # Пропускаем, так как рассчитывается автоматически на основе взаимодействий
-
+        async def generate(metric_key: str, metric_def: Dict) -> List[str]:
             # Проверяем, есть ли предыдущие ответы по этой метрике
             metric_answers = answers_by_metric.get(metric_key, [])
             has_metric_history = len(metric_answers) > 0
 
+            # Ответы по этой метрике важнее общего контекста: при нехватке
+            # бюджета сокращается контекст из других метрик
+            prompt_builder = PromptBuilder("survey_questions")
+            prompt_builder.add_list(
+                "metric_answers", metric_answers[-2:],  # Последние 2 ответа
+                self._format_answer, priority=2, max_item_chars=600
+            )
+            prompt_builder.add_list(
+                "all_answers",
+                [(metric_name, answer_data) for key, metric_name, answer_data in all_answers if key != metric_key],
+                lambda item: f"[{item[0]}] {self._format_answer(item[1])}",
+                priority=1,
+                max_item_chars=400,
+                summarize=lambda rest: f"… и еще {len(rest)} ответов по другим метрикам"
+            )
+
             # Создаем персонализированный промпт
             if has_metric_history:
                 # Используем историю ответов по этой метрике
-                metric_answers_text = ""
-                for answer_data in metric_answers[-2:]:  # Последние 2 ответа
-                    metric_answers_text += f"Вопрос: {answer_data['question']}\nОтвет: {answer_data['answer']}\n"
-
-                prompt = f"""
+                prompt = prompt_builder.render(f"""
                 ПРОФИЛЬ ПОЛЬЗОВАТЕЛЯ:
                 Имя: {user_name}
                 Направление: {direction}
@@ -407,10 +426,10 @@ class ProffKonstaltingMetrics:
                 ШКАЛА ОЦЕНКИ: {', '.join([f"{k}: {v}" for k, v in metric_def['labels'].items()])}
 
                 ПРЕДЫДУЩИЕ ОТВЕТЫ ПОЛЬЗОВАТЕЛЯ ПО ЭТОЙ МЕТРИКЕ:
-                {metric_answers_text}
+                {prompt_builder.slot('metric_answers')}
 
                 ОБЩИЙ КОНТЕКСТ ИЗ ДРУГИХ МЕТРИК:
-                {all_answers_text}
+                {prompt_builder.slot('all_answers')}
 
                 Сгенерируй дополнительные вопросы, которые помогут более точно определить уровень пользователя по шкале этой метрики.
                 Учитывай профиль пользователя (направление, должность, уровень) и адаптируй вопросы под его контекст.
@@ -421,10 +440,10 @@ class ProffKonstaltingMetrics:
                 - Для командного влияния: "Расскажите о случае, когда вы помогли команде преодолеть кризис"
 
                 ВЕРНИ ТОЛЬКО СПИСОК ВОПРОСОВ, по одному на строку, без нумерации и дополнительных комментариев.
-                """
+                """)
             else:
                 # Нет истории по этой метрике, используем общий контекст
-                prompt = f"""
+                prompt = prompt_builder.render(f"""
                 ПРОФИЛЬ ПОЛЬЗОВАТЕЛЯ:
                 Имя: {user_name}
                 Направление: {direction}
@@ -438,18 +457,19 @@ class ProffKonstaltingMetrics:
                 ШКАЛА ОЦЕНКИ: {', '.join([f"{k}: {v}" for k, v in metric_def['labels'].items()])}
 
                 ОБЩИЙ КОНТЕКСТ ИЗ ДРУГИХ МЕТРИК:
-                {all_answers_text}
+                {prompt_builder.slot('all_answers')}
 
                 Сгенерируй вопросы, которые помогут определить уровень пользователя по шкале этой метрики.
                 Учитывай профиль пользователя и адаптируй вопросы под его контекст (направление, должность, уровень).
                 Вопросы должны быть конкретными и поведенческими.
 
                 ВЕРНИ ТОЛЬКО СПИСОК ВОПРОСОВ, по одному на строку, без нумерации и дополнительных комментариев.
-                """
+                """)
 
             try:
                 # Используем правильный метод из AIService
-                response = await self.ai_service.get_ai_response(prompt)
+                with ai_request_context(AIPriority.SCORING):
+                    response = await self.ai_service.get_ai_response(prompt)
                 logger.info(f"AI response for {metric_key}: {response[:200]}...")
 
                 # Разбираем ответ в список вопросов
@@ -466,40 +486,136 @@ class ProffKonstaltingMetrics:
                     logger.warning(f"Не удалось распарсить вопросы для {metric_key}, используем fallback")
                     questions = self.survey_questions.get(metric_key, [])[:4]
 
-                ai_questions[metric_key] = questions[:4]  # Ограничиваем до 4 вопросов
                 logger.info(f"Сгенерировано {len(questions)} вопросов для метрики {metric_key}")
+                return questions[:4]  # Ограничиваем до 4 вопросов
 
             except Exception as e:
                 logger.error(f"Ошибка генерации AI-вопросов для метрики {metric_key}: {e}")
                 # Fallback к предопределенным вопросам
-                ai_questions[metric_key] = self.survey_questions.get(metric_key, [])[:4]
-
+                return self.survey_questions.get(metric_key, [])[:4]
+
+        # Вопросы по метрикам генерируются параллельно; общий лимит
+        # одновременных запросов к модели соблюдает AIScheduler
+        selected = [
+            metric_key for metric_key in self.metrics_definitions
+            if metric_key != "professional_values"  # Рассчитывается автоматически на основе взаимодействий
+            and (metric_keys is None or metric_key in metric_keys)
+        ]
+        results = await asyncio.gather(*[
+            generate(metric_key, self.metrics_definitions[metric_key]) for metric_key in selected
+        ])
+        ai_questions.update(zip(selected, results))
         return ai_questions
 
-    async def score_answers_with_ai(self, user_answers: List[Dict], ai_questions: Dict[str, List[str]]) -> Dict[str, int]:
+    async def score_answers_with_ai(self, user_answers: List[Dict], ai_questions: Dict[str, List[str]],
+                                    batched: bool = True) -> Dict[str, int]:
         """
         Оценка всех ответов пользователя (начальных и дополнительных) с помощью AI для определения баллов по метрикам
 
         user_answers: все ответы пользователя (начальные + дополнительные) в формате:
         [{"question": "вопрос", "answer": "ответ пользователя", "timestamp": "..."}, ...]
         ai_questions: сгенерированные AI дополнительные вопросы по метрикам
+        batched: оценить все метрики одним JSON-запросом; метрики, балл по которым
+        не прошел проверку, дооцениваются отдельными запросами параллельно
 
         Возвращает словарь с баллами по каждой метрике (только баллы сохраняются в БД, ответы не сохраняются)
         """
+        metrics = {
+            metric_key: questions for metric_key, questions in ai_questions.items()
+            if metric_key in self.metrics_definitions
+        }
+        if not metrics:
+            return {}
+
         scores = {}
+        if batched and len(metrics) > 1:
+            scores = await self._score_metrics_batch(metrics, user_answers)
+
+        failed = [metric_key for metric_key in metrics if metric_key not in scores]
+        if failed:
+            if batched and len(metrics) > 1:
+                logger.warning(f"Пакетная оценка не дала балл по {len(failed)} метрикам, оцениваем их отдельно")
+            results = await asyncio.gather(*[
+                self._score_metric(metric_key, metrics[metric_key], user_answers)
+                for metric_key in failed
+            ])
+            for metric_key, score in zip(failed, results):
+                scores[metric_key] = score if score is not None else 1  # Значение по умолчанию
+
+        # Порядок метрик как в ai_questions
+        return {metric_key: scores[metric_key] for metric_key in metrics}
+
+    @staticmethod
+    def _format_answer(answer_data: Dict) -> str:
+        return f"Вопрос: {answer_data['question']}\nОтвет: {answer_data['answer']}"
+
+    def _answers_prompt(self, user_answers: List[Dict]) -> PromptBuilder:
+        """Промпт оценки с ответами пользователя в пределах бюджета (длинные ответы обрезаются)"""
+        return PromptBuilder("survey_scoring").add_list(
+            "answers", user_answers, self._format_answer,
+            max_item_chars=800,
+            summarize=lambda rest: f"… еще {len(rest)} ответов не поместились в запрос"
+        )
+
+    async def _score_metrics_batch(self, metrics: Dict[str, List[str]], user_answers: List[Dict]) -> Dict[str, int]:
+        """Оценить все метрики одним запросом; возвращает только прошедшие проверку баллы"""
+        metrics_text = ""
+        for metric_key, questions in metrics.items():
+            metric_def = self.metrics_definitions[metric_key]
+            metrics_text += f"""
+            МЕТРИКА "{metric_key}": {metric_def['name']}
+            ШКАЛА ОЦЕНКИ:
+            {chr(10).join([f"{k} балл: {v}" for k, v in metric_def['labels'].items()])}
+            СГЕНЕРИРОВАННЫЕ ВОПРОСЫ ДЛЯ ОЦЕНКИ:
+            {chr(10).join([f"- {q}" for q in questions])}
+            """
 
-        answers_text = "\n".join([f"Вопрос: {qa['question']}\nОтвет: {qa['answer']}" for qa in user_answers])
+        prompt_builder = self._answers_prompt(user_answers)
+        prompt = prompt_builder.render(f"""
+            Оцени ответы пользователя по каждой из метрик на основе предоставленных шкал.
+            {metrics_text}
+            ОТВЕТЫ ПОЛЬЗОВАТЕЛЯ:
+            {prompt_builder.slot('answers')}
 
-        for metric_key, questions in ai_questions.items():
-            if metric_key not in self.metrics_definitions:
-                continue
+            НА ОСНОВАНИИ ВСЕХ ОТВЕТОВ ПОЛЬЗОВАТЕЛЯ и сгенерированных вопросов определи наиболее подходящий балл по шкале каждой метрики.
+            Будь максимально объективен.
 
-            metric_def = self.metrics_definitions[metric_key]
+            ВЕРНИ ТОЛЬКО JSON, где ключ - идентификатор метрики в кавычках, значение - целый балл по ее шкале:
+            {{"scores": {{{", ".join(f'"{metric_key}": балл' for metric_key in metrics)}}}}}
+            """)
 
-            # Создаем контекст для AI с вопросами и шкалой
-            questions_text = "\n".join([f"- {q}" for q in questions])
+        try:
+            with ai_request_context(AIPriority.SCORING):
+                response = await self.ai_service.get_json_response(prompt)
+        except Exception as e:
+            logger.error(f"Ошибка пакетной оценки метрик: {e}")
+            return {}
+
+        if not isinstance(response, dict) or "error" in response:
+            logger.warning(f"Пакетная оценка метрик не удалась: {response.get('error') if isinstance(response, dict) else response}")
+            return {}
+
+        raw_scores = response.get("scores", response)
+        if not isinstance(raw_scores, dict):
+            return {}
+
+        scores = {}
+        for metric_key in metrics:
+            score = self._validate_score(metric_key, raw_scores.get(metric_key))
+            if score is not None:
+                scores[metric_key] = score
+        logger.info(f"Пакетная оценка: {len(scores)}/{len(metrics)} метрик одним запросом")
+        return scores
+
+    async def _score_metric(self, metric_key: str, questions: List[str], user_answers: List[Dict]) -> Optional[int]:
+        """Оценить одну метрику отдельным запросом (None, если балл не получен)"""
+        metric_def = self.metrics_definitions[metric_key]
+
+        # Создаем контекст для AI с вопросами и шкалой
+        questions_text = "\n".join([f"- {q}" for q in questions])
 
-            prompt = f"""
+        prompt_builder = self._answers_prompt(user_answers)
+        prompt = prompt_builder.render(f"""
             Оцени ответы пользователя по метрике "{metric_def['name']}" на основе предоставленной шкалы.
 
             ШКАЛА ОЦЕНКИ:
@@ -509,37 +625,45 @@ class ProffKonstaltingMetrics:
             {questions_text}
 
             ОТВЕТЫ ПОЛЬЗОВАТЕЛЯ:
-            {answers_text}
+            {prompt_builder.slot('answers')}
 
             НА ОСНОВАНИИ ВСЕХ ОТВЕТОВ ПОЛЬЗОВАТЕЛЯ и сгенерированных вопросов определи наиболее подходящий балл по шкале.
             Будь максимально объективен и обосновывай оценку конкретными примерами из ответов.
 
             ВЕРНИ ТОЛЬКО ЦИФРУ БАЛЛА (от {min(metric_def['scale'])} до {max(metric_def['scale'])}), без дополнительных комментариев.
-            """
+            """)
 
-            try:
+        try:
+            with ai_request_context(AIPriority.SCORING):
                 response = await self.ai_service.get_ai_response(prompt)
-                logger.info(f"AI scoring response for {metric_key}: {response[:100]}...")
-
-                # Извлекаем число из ответа
-                import re
-                score_match = re.search(r'\b(\d+)\b', response.strip())
-                if score_match:
-                    score = int(score_match.group(1))
-                    # Проверяем, что балл в допустимом диапазоне
-                    if score in metric_def['scale']:
-                        scores[metric_key] = score
-                    else:
-                        logger.warning(f"Балл {score} не в допустимом диапазоне для {metric_key}, используем 1")
-                        scores[metric_key] = 1  # Значение по умолчанию
-                else:
-                    logger.warning(f"Не удалось извлечь балл из ответа AI для {metric_key}")
-                    scores[metric_key] = 1  # Значение по умолчанию
-            except Exception as e:
-                logger.error(f"Ошибка оценки метрики {metric_key}: {e}")
-                scores[metric_key] = 1  # Значение по умолчанию
-
-        return scores
+            logger.info(f"AI scoring response for {metric_key}: {response[:100]}...")
+        except Exception as e:
+            logger.error(f"Ошибка оценки метрики {metric_key}: {e}")
+            return None
+
+        # Извлекаем число из ответа
+        score_match = re.search(r'\b(\d+)\b', response.strip())
+        if not score_match:
+            logger.warning(f"Не удалось извлечь балл из ответа AI для {metric_key}")
+            return None
+
+        score = self._validate_score(metric_key, score_match.group(1))
+        if score is None:
+            logger.warning(f"Балл {score_match.group(1)} не в допустимом диапазоне для {metric_key}, используем 1")
+            return 1
+        return score
+
+    def _validate_score(self, metric_key: str, value) -> Optional[int]:
+        """Балл из ответа модели, если он целый и есть в шкале метрики"""
+        if isinstance(value, bool):
+            return None
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        try:
+            score = int(str(value).strip())
+        except (TypeError, ValueError):
+            return None
+        return score if score in self.metrics_definitions[metric_key]['scale'] else None
 
     async def generate_comprehensive_ai_analysis(self, user_context: Dict) -> str:
         """Генерация комплексного AI-анализа на основе метрик пользователя"""
@@ -603,7 +727,8 @@ class ProffKonstaltingMetrics:
         """
 
         try:
-            analysis = await self.ai_service.get_ai_response(prompt)
+            with ai_request_context(AIPriority.SCORING):
+                analysis = await self.ai_service.get_ai_response(prompt)
             # Убираем лишние символы форматирования
             analysis = analysis.replace('**', '').replace('__', '').replace('```', '')
             return analysis
@@ -655,7 +780,8 @@ class ProffKonstaltingMetrics:
         """
 
         try:
-            analysis = await self.ai_service.get_ai_response(prompt)
+            with ai_request_context(AIPriority.SCORING):
+                analysis = await self.ai_service.get_ai_response(prompt)
             return analysis
         except Exception as e:
             logger.error(f"Ошибка генерации AI-анализа: {e}")
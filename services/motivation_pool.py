@@ -0,0 +1,140 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from sqlalchemy import func
+
+from config import load_config
+from database import get_session
+from database.models import MotivationPhrase
+
+logger = logging.getLogger(__name__)
+
+# Ситуации, для которых держим фразы, и как описать их модели
+SITUATIONS = {
+    "general": "общая поддержка без повода",
+    "on_demand": "пользователь сам попросил мотивацию",
+    "after_survey": "пользователь только что прошел опрос о самочувствии",
+    "challenge_completed": "пользователь только что выполнил челлендж",
+}
+DEFAULT_SITUATION = "general"
+
+
+class MotivationPool:
+    """Пул заранее сгенерированных мотивационных фраз
+
+    Фразы взаимозаменяемы, поэтому кнопка "мотивация", завершение опроса
+    и челленджа берут готовую фразу из БД, а не ждут модель. Реже всего
+    выданные фразы идут первыми; фраза, выданная max_uses раз, считается
+    изношенной. Фоновая задача motivation_pool пополняет ситуации, где
+    свежих фраз меньше min_size, и удаляет изношенные.
+    """
+
+    def __init__(self, size: int = None, min_size: int = None, max_uses: int = None):
+        config = load_config()
+        self.size = size or config.motivation_pool_size
+        self.min_size = min_size or config.motivation_pool_min
+        self.max_uses = max_uses or config.motivation_phrase_max_uses
+        self.stats = {"served": 0, "misses": 0, "generated": 0}
+        self._ai_service = None
+
+    @staticmethod
+    def normalize_situation(situation: Optional[str]) -> str:
+        return situation if situation in SITUATIONS else DEFAULT_SITUATION
+
+    async def take(self, situation: Optional[str]) -> Optional[str]:
+        """Фраза для ситуации из пула (None, если пул пуст)"""
+        phrase = await asyncio.to_thread(self._take, self.normalize_situation(situation))
+        if phrase is None:
+            self.stats["misses"] += 1
+            self.request_refill()
+        else:
+            self.stats["served"] += 1
+        return phrase
+
+    def _take(self, situation: str) -> Optional[str]:
+        session = get_session()
+        try:
+            phrase = session.query(MotivationPhrase).filter(
+                MotivationPhrase.situation == situation
+            ).order_by(
+                MotivationPhrase.used_count, func.random()
+            ).first()
+            if phrase is None:
+                return None
+
+            session.query(MotivationPhrase).filter(MotivationPhrase.id == phrase.id).update(
+                {"used_count": MotivationPhrase.used_count + 1}, synchronize_session=False
+            )
+            session.commit()
+            return phrase.text
+        except Exception as e:
+            session.rollback()
+            logger.error(f"❌ Ошибка чтения пула мотивационных фраз: {e}")
+            return None
+        finally:
+            session.close()
+
+    def request_refill(self):
+        """Попросить фоновую задачу пополнить пул, не дожидаясь интервала"""
+        from services.job_scheduler import job_scheduler
+        if job_scheduler is not None:
+            job_scheduler.run_soon("motivation_pool")
+
+    async def refill(self):
+        """Пополнить ситуации, где свежих фраз мало (фоновая задача)"""
+        fresh = await asyncio.to_thread(self._fresh_counts)
+
+        for situation, description in SITUATIONS.items():
+            missing = self.size - fresh.get(situation, 0)
+            if fresh.get(situation, 0) >= self.min_size or missing <= 0:
+                continue
+
+            phrases = await self._get_ai_service().generate_motivation_phrases(description, missing)
+            if not phrases:
+                # Модель недоступна - изношенные фразы остаются в ходу
+                logger.warning(f"⚠️ Не удалось пополнить мотивационные фразы ({situation})")
+                continue
+
+            await asyncio.to_thread(self._replace_worn, situation, phrases)
+            self.stats["generated"] += len(phrases)
+            logger.info(f"💫 Пул мотивационных фраз пополнен: {situation} +{len(phrases)}")
+
+    def _fresh_counts(self) -> Dict[str, int]:
+        session = get_session()
+        try:
+            rows = session.query(
+                MotivationPhrase.situation, func.count(MotivationPhrase.id)
+            ).filter(
+                MotivationPhrase.used_count < self.max_uses
+            ).group_by(MotivationPhrase.situation).all()
+            return dict(rows)
+        finally:
+            session.close()
+
+    def _replace_worn(self, situation: str, phrases: List[str]):
+        session = get_session()
+        try:
+            session.query(MotivationPhrase).filter(
+                MotivationPhrase.situation == situation,
+                MotivationPhrase.used_count >= self.max_uses
+            ).delete(synchronize_session=False)
+            session.bulk_insert_mappings(MotivationPhrase, [
+                {"situation": situation, "text": text, "used_count": 0}
+                for text in phrases
+            ])
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"❌ Ошибка сохранения мотивационных фраз: {e}")
+        finally:
+            session.close()
+
+    def _get_ai_service(self):
+        if self._ai_service is None:
+            from services.ai_service import AIService
+            self._ai_service = AIService()
+        return self._ai_service
+
+
+motivation_pool = MotivationPool()
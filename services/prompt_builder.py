@@ -0,0 +1,197 @@
+import logging
+import math
+import secrets
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from config import load_config
+
+logger = logging.getLogger(__name__)
+
+# Русский текст в BPE-токенизаторах - примерно 3 символа на токен
+CHARS_PER_TOKEN = 3.0
+
+# Бюджет входного промпта в токенах по задачам (умножается на AI_PROMPT_BUDGET_SCALE)
+PROMPT_BUDGETS = {
+    "challenge": 1200,
+    "daily_report": 1500,
+    "member_report": 1200,
+    "team_report": 600,
+    "survey_questions": 1800,
+    "survey_scoring": 6000,
+}
+DEFAULT_PROMPT_BUDGET = 2000
+
+# Запас под строку-итог, которой заменяются отброшенные элементы
+_SUMMARY_RESERVE = 30
+
+# Маркеры разделов содержат случайный токен процесса: текст пользователя,
+# уже подставленный в шаблон, не может случайно или намеренно их повторить
+_SLOT_TOKEN = secrets.token_hex(8)
+
+# Размеры промптов по задачам с момента запуска
+_prompt_stats: Dict[str, Dict[str, Any]] = {}
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Оценка числа токенов без токенизатора (с запасом для кириллицы)"""
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def clip_text(text: Optional[str], max_chars: int) -> str:
+    """Обрезать текст до max_chars символов по границе слова"""
+    text = (text or "").strip()
+    if len(text) <= max_chars:
+        return text
+    clipped = text[:max_chars].rsplit(" ", 1)[0]
+    return f"{clipped or text[:max_chars]}…"
+
+
+def get_prompt_budget(task: str) -> int:
+    """Бюджет промпта задачи в токенах"""
+    scale = load_config().ai_prompt_budget_scale
+    return int(PROMPT_BUDGETS.get(task, DEFAULT_PROMPT_BUDGET) * scale)
+
+
+def get_prompt_stats() -> Dict[str, Dict[str, Any]]:
+    """Размеры промптов по задачам: количество, средний и максимальный размер, сокращения"""
+    return {task: dict(stats) for task, stats in _prompt_stats.items()}
+
+
+def record_prompt(task: str, tokens: int, budget: int, truncated: List[str]):
+    stats = _prompt_stats.setdefault(task, {
+        "count": 0, "avg_tokens": 0.0, "max_tokens": 0, "truncated": 0, "budget": budget
+    })
+    stats["count"] += 1
+    stats["avg_tokens"] += (tokens - stats["avg_tokens"]) / stats["count"]
+    stats["max_tokens"] = max(stats["max_tokens"], tokens)
+    stats["budget"] = budget
+    if truncated:
+        stats["truncated"] += 1
+        logger.info(
+            f"✂️ Промпт {task} сокращен до бюджета: ~{tokens}/{budget} токенов, "
+            f"разделы: {', '.join(truncated)}"
+        )
+    else:
+        logger.debug(f"Промпт {task}: ~{tokens}/{budget} токенов")
+
+
+class _Section:
+    """Раздел контекста: элементы по убыванию важности и итог по отброшенным"""
+
+    def __init__(self, name: str, items: List[Any], lines: List[str], priority: int,
+                 min_items: int, limit: Optional[int],
+                 summarize: Optional[Callable[[List[Any]], str]], empty: str):
+        self.name = name
+        self.items = items
+        self.lines = lines
+        self.priority = priority
+        self.min_items = min_items
+        self.limit = limit
+        self.summarize = summarize
+        self.empty = empty
+
+    def fit(self, available: int):
+        """Текст раздела в пределах available токенов и признак сокращения"""
+        kept: List[str] = []
+        used = 0
+        for index, line in enumerate(self.lines):
+            if self.limit is not None and index >= self.limit:
+                break
+            cost = estimate_tokens(line) + 1
+            reserve = _SUMMARY_RESERVE if index < len(self.lines) - 1 else 0
+            if index >= self.min_items and used + cost + reserve > available:
+                break
+            kept.append(line)
+            used += cost
+
+        dropped = self.items[len(kept):]
+        if dropped:
+            summary = self.summarize(dropped) if self.summarize else f"… и еще {len(dropped)}"
+            if summary:
+                kept.append(summary)
+        return ("\n".join(kept) if kept else self.empty), bool(dropped)
+
+
+class PromptBuilder:
+    """Сборка промпта в пределах бюджета токенов задачи
+
+    Шаблон - обычная строка (обычно f-строка), в которой место раздела
+    отмечено маркером slot(name). Шаблон не разбирается как синтаксис
+    подстановки, поэтому данные пользователя в нем (имена, ответы) остаются
+    как есть. Постоянная часть шаблона (инструкции, формат
+    ответа) остается целиком, а разделы заполняются в порядке приоритета,
+    пока хватает бюджета: элементы раздела идут по убыванию важности,
+    а не поместившиеся заменяются строкой-итогом ("… и еще 12 игроков").
+    Размер каждого собранного промпта записывается в статистику задачи.
+    """
+
+    def __init__(self, task: str, budget: Optional[int] = None):
+        self.task = task
+        self.budget = budget or get_prompt_budget(task)
+        self._sections: List[_Section] = []
+
+    def add_text(self, name: str, text: Optional[str], priority: int = 0,
+                 min_lines: int = 0, empty: str = "нет данных") -> "PromptBuilder":
+        """Раздел из текста; при нехватке бюджета отбрасываются последние строки"""
+        lines = (text or "").strip("\n").splitlines()
+        return self._add(_Section(
+            name, lines, lines, priority, min_lines, None,
+            lambda dropped: f"… (сокращено, еще строк: {len(dropped)})", empty
+        ))
+
+    def add_list(self, name: str, items: Iterable[Any], format_item: Callable[[Any], str],
+                 priority: int = 0, limit: Optional[int] = None, min_items: int = 0,
+                 summarize: Optional[Callable[[List[Any]], str]] = None,
+                 max_item_chars: Optional[int] = None, empty: str = "нет") -> "PromptBuilder":
+        """Раздел-список
+
+        Args:
+            items: Элементы по убыванию важности
+            format_item: Строка (или несколько строк) для одного элемента
+            limit: Сколько элементов показывать максимум
+            min_items: Сколько первых элементов оставлять даже сверх бюджета
+            summarize: Итог по не поместившимся элементам (средние, количество)
+            max_item_chars: Обрезать слишком длинные элементы
+        """
+        items = list(items)
+        lines = []
+        for item in items:
+            line = format_item(item)
+            if max_item_chars:
+                line = clip_text(line, max_item_chars)
+            lines.append(line)
+        return self._add(_Section(name, items, lines, priority, min_items, limit, summarize, empty))
+
+    def _add(self, section: _Section) -> "PromptBuilder":
+        self._sections.append(section)
+        return self
+
+    @staticmethod
+    def slot(name: str) -> str:
+        """Маркер места раздела name в шаблоне"""
+        return f"<<{_SLOT_TOKEN}:{name}>>"
+
+    def render(self, template: str) -> str:
+        """Подставить разделы в шаблон в пределах бюджета"""
+        sections = [section for section in self._sections if self.slot(section.name) in template]
+        fixed = template
+        for section in sections:
+            fixed = fixed.replace(self.slot(section.name), "")
+        available = self.budget - estimate_tokens(fixed)
+
+        fitted: Dict[str, str] = {}
+        truncated: List[str] = []
+        for section in sorted(sections, key=lambda s: -s.priority):
+            text, cut = section.fit(max(available, 0))
+            available -= estimate_tokens(text)
+            fitted[section.name] = text
+            if cut:
+                truncated.append(section.name)
+
+        prompt = template
+        for name, text in fitted.items():
+            prompt = prompt.replace(self.slot(name), text)
+        record_prompt(self.task, estimate_tokens(prompt), self.budget, truncated)
+        return prompt
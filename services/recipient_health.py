@@ -0,0 +1,99 @@
+import logging
+import time
+from datetime import datetime
+from typing import Dict
+
+from database import get_session, User
+
+logger = logging.getLogger(__name__)
+
+# Как долго не перепроверяем пользователя, который недавно писал боту
+_PROBE_TTL_SECONDS = 300
+_recently_probed: Dict[int, float] = {}
+
+
+def reachable_filter():
+    """Условие для выборок получателей: пропускаем недоступные чаты"""
+    return User.unreachable_at.is_(None)
+
+
+def mark_unreachable(chat_id: int, reason: str) -> int:
+    """Пометить пользователей чата как недоступных (бот заблокирован, аккаунт удален...)"""
+    session = get_session()
+    try:
+        updated = session.query(User).filter(
+            User.chat_id == chat_id,
+            User.unreachable_at.is_(None)
+        ).update({
+            "unreachable_at": datetime.utcnow(),
+            "unreachable_reason": reason
+        }, synchronize_session=False)
+        session.commit()
+
+        if updated:
+            logger.info(f"🚫 Чат {chat_id} помечен недоступным: {reason}")
+        return updated
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Ошибка отметки недоступного чата {chat_id}: {e}")
+        return 0
+    finally:
+        session.close()
+
+
+def migrate_chat(old_chat_id: int, new_chat_id: int) -> int:
+    """Перенести получателей на новый chat_id (группа стала супергруппой)"""
+    session = get_session()
+    try:
+        updated = session.query(User).filter(
+            User.chat_id == old_chat_id
+        ).update({"chat_id": new_chat_id}, synchronize_session=False)
+        session.commit()
+
+        if updated:
+            logger.info(f"🔀 Чат {old_chat_id} переехал в {new_chat_id}")
+        return updated
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Ошибка переноса чата {old_chat_id} в {new_chat_id}: {e}")
+        return 0
+    finally:
+        session.close()
+
+
+def mark_reachable(user_id: int) -> bool:
+    """Снять отметку недоступности: пользователь снова написал боту
+
+    Вызывается на каждое входящее обновление, поэтому один и тот же
+    пользователь проверяется не чаще раза в _PROBE_TTL_SECONDS.
+    """
+    now = time.monotonic()
+    if now - _recently_probed.get(user_id, 0) < _PROBE_TTL_SECONDS:
+        return False
+    _recently_probed[user_id] = now
+
+    if len(_recently_probed) > 10000:
+        for probed_user_id, probed_at in list(_recently_probed.items()):
+            if now - probed_at >= _PROBE_TTL_SECONDS:
+                del _recently_probed[probed_user_id]
+
+    session = get_session()
+    try:
+        updated = session.query(User).filter(
+            User.user_id == user_id,
+            User.unreachable_at.isnot(None)
+        ).update({
+            "unreachable_at": None,
+            "unreachable_reason": None
+        }, synchronize_session=False)
+        session.commit()
+
+        if updated:
+            logger.info(f"✅ Пользователь {user_id} снова доступен")
+        return bool(updated)
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Ошибка снятия недоступности пользователя {user_id}: {e}")
+        return False
+    finally:
+        session.close()
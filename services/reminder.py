@@ -3,116 +3,147 @@ import logging
 from datetime import datetime, timedelta
 from typing import List
 
+from sqlalchemy import Date, cast, extract, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
 from database import get_session
-from database.models import Challenge, User, ChallengeStatus, Organization
-from utils.time import get_current_org_time, get_org_timezone
+from database.models import Challenge, User, ChallengeStatus, Organization, ReminderLog
+from services.message_dispatcher import Priority, get_message_dispatcher
+from services.recipient_health import reachable_filter
 
 logger = logging.getLogger(__name__)
 
 class SimpleReminderService:
     """ПРОСТОЙ сервис напоминаний о невыполненных челленджах"""
     
+    # Окно напоминаний по местному времени организации: [18:00, 21:00).
+    # Задача запускается каждый час, поэтому пропущенный запуск в 18:00
+    # догоняется в 19:00, а ReminderLog не дает напомнить дважды за день
+    reminder_hour_start = 18
+    reminder_hour_end = 21
+    
     def __init__(self, bot):
         self.bot = bot
         self.active = True
     
     async def send_daily_reminders(self):
-        """Отправляем напоминания всем организациям"""
+        """Отправляем напоминания всем организациям, у которых сейчас вечер"""
         logger.info("🔔 Запуск простых напоминаний о челленджах")
         
-        session = get_session()
         try:
-            # Получаем все организации
-            organizations = session.query(Organization).all()
+            users = self._get_users_with_pending_challenges()
+            if not users:
+                logger.info("✅ Напоминания: получателей нет")
+                return
+            
+            users = self._claim_reminders(users)
+            logger.info(f"📋 Напоминания: {len(users)} пользователей с челленджами")
             
-            for org in organizations:
+            for user in users:
                 try:
-                    await self._check_and_send_for_org(org)
+                    await self._send_simple_reminder(user)
                 except Exception as e:
-                    logger.error(f"❌ Ошибка для организации {org.name}: {e}")
+                    logger.error(f"❌ Не удалось отправить пользователю {user.get('user_id')}: {e}")
                     continue
             
             logger.info("✅ Напоминания отправлены")
             
         except Exception as e:
             logger.error(f"❌ Ошибка отправки напоминаний: {e}")
-        finally:
-            session.close()
     
-    async def _check_and_send_for_org(self, org: Organization):
-        """Проверяем и отправляем напоминания для одной организации"""
-        if not org.timezone:
-            return
-        
-        # Получаем время организации из твоего time.py
-        try:
-            org_time = get_current_org_time(org.id)
-        except:
-            return
-        
-        # Отправляем в 18:00 по местному времени (просто вечером)
-        if org_time.hour != 18:
-            return
-        
+    def _get_users_with_pending_challenges(self) -> List[dict]:
+        """Получатели напоминаний по всем организациям одним запросом
+
+        Берем организации, у которых местное время попадает в окно
+        напоминаний, и пользователей с невыполненными челленджами, которым
+        сегодня еще не напоминали. COUNT() OVER дает число челленджей,
+        ROW_NUMBER() OVER оставляет три последних для текста напоминания.
+        """
         session = get_session()
         try:
-            # Получаем пользователей с невыполненными челленджами
-            users = self._get_users_with_pending_challenges(org.id)
-            
-            logger.info(f"📋 Организация {org.name}: {len(users)} пользователей с челленджами")
+            local_now = func.timezone(Organization.timezone, func.now())
+            local_date = cast(local_now, Date)
+            
+            already_reminded = select(ReminderLog.id).where(
+                ReminderLog.user_id == User.user_id,
+                ReminderLog.local_date == local_date
+            ).exists()
+            
+            pending = session.query(
+                User.user_id.label("user_id"),
+                User.name.label("name"),
+                User.chat_id.label("chat_id"),
+                local_date.label("local_date"),
+                Challenge.text.label("text"),
+                func.row_number().over(
+                    partition_by=User.user_id,
+                    order_by=Challenge.created_at.desc()
+                ).label("rn"),
+                func.count().over(partition_by=User.user_id).label("challenge_count")
+            ).join(
+                Organization, Organization.id == User.org_id
+            ).join(
+                Challenge, Challenge.user_id == User.user_id
+            ).filter(
+                User.chat_id.isnot(None),
+                reachable_filter(),
+                Organization.timezone.in_(select(func.pg_timezone_names().table_valued("name").c.name)),
+                extract("hour", local_now) >= self.reminder_hour_start,
+                extract("hour", local_now) < self.reminder_hour_end,
+                Challenge.status.in_([ChallengeStatus.PENDING.value, ChallengeStatus.ACTIVE.value]),
+                ~already_reminded
+            ).subquery()
+            
+            rows = session.query(pending).filter(
+                pending.c.rn <= 3
+            ).order_by(pending.c.user_id, pending.c.rn).all()
+            
+            result = {}
+            for row in rows:
+                user_data = result.setdefault(row.user_id, {
+                    'user_id': row.user_id,
+                    'name': row.name,
+                    'chat_id': row.chat_id,
+                    'local_date': row.local_date,
+                    'challenge_count': row.challenge_count,
+                    'challenges': []
+                })
+                user_data['challenges'].append(row.text)
+            
+            return list(result.values())
             
-            for user in users:
-                try:
-                    await self._send_simple_reminder(user)
-                    # Пауза между сообщениями
-                    import asyncio
-                    await asyncio.sleep(0.05)
-                except Exception as e:
-                    logger.error(f"❌ Не удалось отправить пользователю {user.get('user_id')}: {e}")
-                    continue
-                    
+        except Exception as e:
+            logger.error(f"Ошибка получения пользователей: {e}")
+            return []
         finally:
             session.close()
     
-    def _get_users_with_pending_challenges(self, org_id: int) -> List[dict]:
-        """Получаем пользователей с невыполненными челленджами"""
+    def _claim_reminders(self, users: List[dict]) -> List[dict]:
+        """Записать напоминания в ReminderLog и вернуть тех, кому их еще не было
+
+        Запись делается до отправки: при параллельном запуске напоминание
+        получит только тот, кто первым вставил строку.
+        """
         session = get_session()
         try:
-            # Простой запрос - находим пользователей с активными челленджами
-            users = session.query(User).filter(
-                User.org_id == org_id,
-                User.chat_id.isnot(None),
-                User.is_active == True
-            ).all()
-            
-            result = []
-            
-            for user in users:
-                # Считаем активные челленджи для пользователя
-                challenge_count = session.query(Challenge).filter(
-                    Challenge.user_id == user.user_id,
-                    Challenge.status.in_([ChallengeStatus.PENDING.value, ChallengeStatus.ACTIVE.value])
-                ).count()
-                
-                if challenge_count > 0:
-                    # Получаем первые 3 челленджа для примера
-                    challenges = session.query(Challenge).filter(
-                        Challenge.user_id == user.user_id,
-                        Challenge.status.in_([ChallengeStatus.PENDING.value, ChallengeStatus.ACTIVE.value])
-                    ).order_by(Challenge.created_at.desc()).limit(3).all()
-                    
-                    result.append({
-                        'user_id': user.user_id,
-                        'name': user.name,
-                        'chat_id': user.chat_id,
-                        'challenge_count': challenge_count,
-                        'challenges': [challenge.text for challenge in challenges]
-                    })
-            
-            return result
+            stmt = pg_insert(ReminderLog).values([
+                {
+                    "user_id": user["user_id"],
+                    "local_date": user["local_date"],
+                    "sent_at": datetime.utcnow()
+                }
+                for user in users
+            ]).on_conflict_do_nothing(
+                index_elements=[ReminderLog.user_id, ReminderLog.local_date]
+            ).returning(ReminderLog.user_id)
+            
+            claimed = {row.user_id for row in session.execute(stmt)}
+            session.commit()
+            return [user for user in users if user["user_id"] in claimed]
             
         except Exception as e:
-            logger.error(f"Ошибка получения пользователей: {e}")
+            session.rollback()
+            logger.error(f"Ошибка записи напоминаний: {e}")
             return []
         finally:
             session.close()
@@ -140,9 +171,10 @@ class SimpleReminderService:
             
             message += "\n🎯 Проверь в разделе 'Активность'"
             
-            await self.bot.send_message(
+            await get_message_dispatcher(self.bot).send_message(
                 chat_id=chat_id,
-                text=message
+                text=message,
+                priority=Priority.SCHEDULED
             )
             
             logger.info(f"📨 Напоминание отправлено пользователю {user_data['user_id']}")
@@ -182,6 +182,53 @@ class ScheduleManager:
         finally:
             session.close()
     
+    @staticmethod
+    def update_schedule_attachment(schedule_id: int, attachment_type: Optional[str],
+                                   file_id: Optional[str]) -> bool:
+        """Прикрепить вложение к расписанию (None - убрать вложение)"""
+        session = get_session()
+        try:
+            schedule = session.query(MessageSchedule).filter(
+                MessageSchedule.id == schedule_id
+            ).first()
+            
+            if schedule:
+                schedule.attachment_type = attachment_type
+                schedule.attachment_file_id = file_id
+                schedule.attachment_path = None
+                schedule.updated_at = datetime.utcnow()
+                session.commit()
+                return True
+            return False
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Ошибка обновления вложения: {e}")
+            return False
+        finally:
+            session.close()
+    
+    @staticmethod
+    def update_schedule_spread(schedule_id: int, spread_minutes: int) -> bool:
+        """Обновить окно, на которое растягивается отправка"""
+        session = get_session()
+        try:
+            schedule = session.query(MessageSchedule).filter(
+                MessageSchedule.id == schedule_id
+            ).first()
+            
+            if schedule:
+                schedule.spread_minutes = max(spread_minutes, 0)
+                schedule.updated_at = datetime.utcnow()
+                session.commit()
+                return True
+            return False
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Ошибка обновления окна отправки: {e}")
+            return False
+        finally:
+            session.close()
+    
     @staticmethod
     def toggle_schedule_status(schedule_id: int) -> bool:
         """Переключить статус расписания"""
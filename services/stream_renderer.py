@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from typing import AsyncIterator, List, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+from config import load_config
+from utils.helpers import split_long_message
+
+logger = logging.getLogger(__name__)
+
+STREAM_CURSOR = " ▌"  # Показывает, что ответ еще пишется
+
+
+class TelegramStreamRenderer:
+    """Показывает потоковый ответ, постепенно редактируя сообщение
+
+    - Сообщение-заглушка ("🤔 Думаю...") редактируется по мере генерации,
+      но не чаще раза в edit_interval секунд, чтобы не упереться в лимит
+      Telegram на редактирование;
+    - когда текст длиннее 4000 символов, он делится split_long_message:
+      заполненные части остаются отдельными сообщениями, продолжение
+      дописывается в новое;
+    - во время генерации текст отправляется без разметки (незакрытая `*`
+      ломает Markdown), финальная версия - с parse_mode, а если Telegram
+      ее не принял - обычным текстом.
+    """
+
+    def __init__(self, placeholder: Message, parse_mode: Optional[str] = "Markdown",
+                 edit_interval: float = None):
+        """
+        Args:
+            placeholder: Сообщение, в которое пишется ответ
+            parse_mode: Разметка финального текста
+            edit_interval: Минимальный интервал между редактированиями
+        """
+        self.parse_mode = parse_mode
+        self.edit_interval = edit_interval if edit_interval is not None else load_config().ai_stream_edit_interval
+        self.text = ""
+        self.edits = 0
+        self._messages: List[Message] = [placeholder]
+        self._shown: List[str] = [placeholder.text or ""]
+        self._next_edit_at = 0.0
+
+    async def render(self, chunks: AsyncIterator[str]) -> str:
+        """Показать весь поток и вернуть итоговый текст ответа"""
+        loop = asyncio.get_running_loop()
+        async for chunk in chunks:
+            self.text += chunk
+            if loop.time() >= self._next_edit_at:
+                await self._show(self.text + STREAM_CURSOR, final=False)
+                self._next_edit_at = max(self._next_edit_at, loop.time() + self.edit_interval)
+
+        await self._show(self.text or "🤖 Пустой ответ. Попробуйте переформулировать вопрос.", final=True)
+        return self.text
+
+    async def _show(self, text: str, final: bool):
+        parts = split_long_message(text)
+        for index, part in enumerate(parts):
+            if index < len(self._messages):
+                if self._shown[index] != part or final:
+                    await self._edit(index, part, final)
+            else:
+                await self._send(part, final)
+
+    async def _edit(self, index: int, text: str, final: bool):
+        message = self._messages[index]
+        try:
+            if final and self.parse_mode:
+                try:
+                    await message.edit_text(text, parse_mode=self.parse_mode)
+                except TelegramBadRequest as e:
+                    if "not modified" in str(e):
+                        return
+                    # Модель вернула невалидную разметку - показываем как есть
+                    await message.edit_text(text, parse_mode=None)
+            else:
+                await message.edit_text(text, parse_mode=None)
+            self._shown[index] = text
+            self.edits += 1
+        except TelegramRetryAfter as e:
+            # Лимит на редактирование: пропускаем промежуточные обновления
+            logger.warning(f"⏳ Редактирование ответа ограничено Telegram на {e.retry_after} с")
+            self._next_edit_at = asyncio.get_running_loop().time() + e.retry_after
+            if final:
+                await asyncio.sleep(e.retry_after)
+                await self._edit(index, text, final)
+        except TelegramBadRequest as e:
+            if "not modified" not in str(e):
+                logger.error(f"❌ Не удалось обновить сообщение с ответом: {e}")
+
+    async def _send(self, text: str, final: bool):
+        anchor = self._messages[-1]
+        parse_mode = self.parse_mode if final else None
+        try:
+            message = await anchor.answer(text, parse_mode=parse_mode)
+        except TelegramBadRequest:
+            message = await anchor.answer(text, parse_mode=None)
+        self._messages.append(message)
+        self._shown.append(text)
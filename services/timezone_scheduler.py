@@ -3,50 +3,63 @@ import asyncio
 import logging
 from datetime import datetime, time, timedelta
 import pytz
-from typing import Dict, List, Set, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 import hashlib
 
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from config import load_config
 from database import get_session
-from database.models import MessageSchedule, User, Organization, MessageScheduleStatus, MessageSentLog
+from services.delivery import REASON_BLOCKED, REASON_CHAT_NOT_FOUND, REASON_DEACTIVATED, classify_error
+from services.fanout import fan_out
+from services.media_delivery import media_for, save_file_id
+from services.message_dispatcher import Priority, get_message_dispatcher
+from services.recipient_health import reachable_filter
+from database.models import (
+    MessageSchedule, User, Organization, MessageScheduleStatus,
+    MessageSentLog, ScheduleFireLog
+)
 
 logger = logging.getLogger(__name__)
 
+# Срабатывания растянутых отправок, которые можно дослать: отправка шла,
+# когда реплика упала (sending) или потеряла лидерство (interrupted)
+RESUMABLE_STATUSES = ("sending", "interrupted")
+
 class TimezoneMessageScheduler:
     """Планировщик сообщений с учетом часового пояса организации"""
     
     def __init__(self, bot: Bot):
         self.bot = bot
-        self.is_running = False
         self.last_check_date = None
+        # Окно догоняющей отправки; не меньше прежнего допуска в 5 минут
+        catchup_minutes = max(load_config().schedule_catchup_minutes, 5)
+        self.catchup_window = timedelta(minutes=catchup_minutes)
+        self._spreading: Dict[int, asyncio.Task] = {}  # Растянутые отправки в процессе по id расписания
         logger.info("✅ TimezoneMessageScheduler инициализирован")
     
-    async def start(self):
-        """Запуск планировщика"""
-        self.is_running = True
-        logger.info("🚀 Планировщик сообщений (с учетом часового пояса) запущен")
-        
-        while self.is_running:
-            try:
-                # Получаем текущее время с часовым поясом UTC
-                current_utc = datetime.now(pytz.UTC)
-                
-                # Проверяем, наступил ли новый день
-                await self._check_new_day(current_utc)
-                
-                # Проверяем и отправляем сообщения
-                await self._check_and_send_messages(current_utc)
-                
-                # Ждем 60 секунд
-                await asyncio.sleep(60)
-                    
-            except Exception as e:
-                logger.error(f"Ошибка в планировщике: {e}", exc_info=True)
-                await asyncio.sleep(60)
+    def shutdown(self):
+        """Отменить растянутые отправки (реплика больше не лидер)
+
+        Отмененная отправка помечает срабатывание как прерванное, и новый
+        лидер досылает его тем, кому сообщение еще не ушло.
+        """
+        if not self._spreading:
+            return
+        logger.info(f"🛑 Отменяю растянутые отправки: {len(self._spreading)}")
+        for task in list(self._spreading.values()):
+            task.cancel()
     
-    async def stop(self):
-        """Остановка планировщика"""
-        self.is_running = False
-        logger.info("⏹️ Планировщик остановлен")
+    async def tick(self):
+        """Одна проверка расписания (запускается JobScheduler раз в минуту)"""
+        # Получаем текущее время с часовым поясом UTC
+        current_utc = datetime.now(pytz.UTC)
+        
+        # Проверяем, наступил ли новый день
+        await self._check_new_day(current_utc)
+        
+        # Проверяем и отправляем сообщения
+        await self._check_and_send_messages(current_utc)
     
     async def _check_new_day(self, current_utc: datetime):
         """Проверяем, наступил ли новый день"""
@@ -73,6 +86,15 @@ class TimezoneMessageScheduler:
                 return
             
             logger.debug(f"Проверяю {len(schedules)} активных расписаний")
+            due = []
+            
+            # Последние срабатывания всех расписаний одним запросом
+            fire_logs = {
+                log.schedule_id: log
+                for log in session.query(ScheduleFireLog).filter(
+                    ScheduleFireLog.schedule_id.in_([schedule.id for schedule in schedules])
+                ).all()
+            }
             
             for schedule in schedules:
                 try:
@@ -97,12 +119,23 @@ class TimezoneMessageScheduler:
                         current_org_time = current_utc_aware.astimezone(org_tz)
                         org_timezone = "Asia/Novosibirsk"
                     
+                    if schedule.id in self._spreading:
+                        # Растянутая отправка этого расписания еще идет
+                        continue
+                    
+                    fire_log = fire_logs.get(schedule.id)
+                    if fire_log is not None and fire_log.status in RESUMABLE_STATUSES:
+                        if self._resume_occurrence(schedule, fire_log, current_utc_aware):
+                            due.append((schedule, org, fire_log.last_occurrence_at))
+                            continue
+                    
                     # Проверяем, нужно ли отправлять сообщение
                     should_send = await self._should_send_schedule(
                         schedule, 
                         current_utc_aware, 
                         current_org_time, 
-                        org_tz
+                        org_tz,
+                        fire_log
                     )
                     
                     if should_send:
@@ -113,73 +146,280 @@ class TimezoneMessageScheduler:
                             f"   Текущее время организации: {current_org_time.strftime('%H:%M')}"
                         )
                         
-                        # Отправляем сообщение
-                        sent_count = await self._send_scheduled_message(schedule, org, current_utc_aware)
-                        
-                        if sent_count > 0:
-                            logger.info(f"✅ Сообщение '{schedule.title}' отправлено {sent_count} пользователям")
-                        else:
-                            logger.warning(f"⚠️ Сообщение '{schedule.title}' не отправлено никому")
+                        due.append((schedule, org, self._last_occurrence(schedule, current_org_time, org_tz)))
                             
                 except Exception as e:
                     logger.error(f"❌ Ошибка обработки расписания {schedule.id}: {e}", exc_info=True)
+            
+            # Все организации отправляют одновременно: диспетчер делит между
+            # ними пропускную способность, а не обслуживает их по очереди
+            waiting = []
+            for schedule, org, occurrence_utc in due:
+                task = asyncio.create_task(
+                    self._send_and_report(schedule, org, current_utc_aware, occurrence_utc)
+                )
+                if schedule.spread_minutes:
+                    # Растянутая отправка идет в фоне и не задерживает следующую проверку
+                    self._spreading[schedule.id] = task
+                    task.add_done_callback(
+                        lambda _, schedule_id=schedule.id: self._spreading.pop(schedule_id, None)
+                    )
+                else:
+                    waiting.append(task)
+            
+            if waiting:
+                await asyncio.gather(*waiting)
                     
         except Exception as e:
             logger.error(f"❌ Ошибка проверки расписания: {e}", exc_info=True)
         finally:
             session.close()
     
+    async def _send_and_report(
+        self,
+        schedule: MessageSchedule,
+        org: Organization,
+        sent_time: datetime,
+        occurrence_utc: datetime
+    ):
+        try:
+            sent_count = await self._send_scheduled_message(schedule, org, sent_time, occurrence_utc)
+            
+            if sent_count > 0:
+                logger.info(f"✅ Сообщение '{schedule.title}' отправлено {sent_count} пользователям")
+            else:
+                logger.warning(f"⚠️ Сообщение '{schedule.title}' не отправлено никому")
+        except asyncio.CancelledError:
+            if schedule.spread_minutes:
+                self._set_fire_status(schedule.id, occurrence_utc, "interrupted")
+                logger.warning(f"⏸️ Отправка '{schedule.title}' прервана, оставшимся ее дошлет новый лидер")
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка отправки расписания {schedule.id}: {e}", exc_info=True)
+        
+        if schedule.spread_minutes:
+            self._set_fire_status(schedule.id, occurrence_utc, "fired")
+    
+    @staticmethod
+    def _last_occurrence(
+        schedule: MessageSchedule,
+        current_org_time: datetime,
+        org_tz: pytz.BaseTzInfo
+    ) -> datetime:
+        """Последнее наступившее плановое срабатывание (наивное UTC)"""
+        # Плановое время на сегодня в часовом поясе организации
+        occurrence_local = org_tz.localize(
+            datetime.combine(current_org_time.date(), schedule.scheduled_time)
+        )
+        
+        # Если сегодняшнее время еще не наступило, последним было вчерашнее
+        if occurrence_local > current_org_time:
+            occurrence_local = org_tz.localize(
+                datetime.combine(
+                    current_org_time.date() - timedelta(days=1),
+                    schedule.scheduled_time
+                )
+            )
+        
+        # В базе храним наивное UTC время
+        return occurrence_local.astimezone(pytz.UTC).replace(tzinfo=None)
+    
     async def _should_send_schedule(
         self, 
         schedule: MessageSchedule, 
         current_utc: datetime,
         current_org_time: datetime,
-        org_tz: pytz.BaseTzInfo
+        org_tz: pytz.BaseTzInfo,
+        fire_log: ScheduleFireLog = None
     ) -> bool:
-        """Проверить, нужно ли отправлять сообщение по расписанию"""
-        session = get_session()
+        """Проверить, нужно ли отправлять сообщение по расписанию
+
+        Берем последнее плановое срабатывание, которое уже наступило, и
+        сравниваем его с записью в ScheduleFireLog. Если срабатывание еще не
+        обработано и опоздание укладывается в окно догоняющей отправки,
+        атомарно занимаем его и отправляем; более старое помечаем пропущенным.
+        """
         try:
-            # Проверяем по времени
-            schedule_time = schedule.scheduled_time
-            
-            # Создаем datetime для времени расписания на текущий день в часовом поясе организации
-            schedule_datetime_local = org_tz.localize(
-                datetime.combine(current_org_time.date(), schedule_time)
-            )
-            
-            # Конвертируем в UTC для сравнения
-            schedule_datetime_utc = schedule_datetime_local.astimezone(pytz.UTC)
+            occurrence_utc = self._last_occurrence(schedule, current_org_time, org_tz)
+            now_utc = current_utc.astimezone(pytz.UTC).replace(tzinfo=None)
             
-            # Убеждаемся, что current_utc также осведомленный (aware)
-            if current_utc.tzinfo is None:
-                current_utc_aware = current_utc.replace(tzinfo=pytz.UTC)
-            else:
-                current_utc_aware = current_utc
-            
-            # Проверяем, находится ли текущее время в пределах +-5 минут от времени отправки
-            time_diff = abs((current_utc_aware - schedule_datetime_utc).total_seconds())
-            
-            if time_diff > 300:  # 5 минут
+            # Срабатывания до создания расписания не догоняем
+            if schedule.created_at and occurrence_utc < schedule.created_at:
                 return False
             
-            # Проверяем, не отправлялось ли уже сегодня это сообщение
-            # Ищем запись в логах за сегодня
-            today_start_utc = current_utc_aware.replace(hour=0, minute=0, second=0, microsecond=0)
+            if fire_log is not None:
+                if fire_log.last_occurrence_at >= occurrence_utc:
+                    return False
+            elif self._was_sent_before_fire_log(schedule.id, occurrence_utc):
+                # Расписание отправлялось до появления журнала срабатываний
+                self._claim_occurrence(schedule.id, occurrence_utc, now_utc, "fired")
+                return False
             
-            existing_log = session.query(MessageSentLog).filter(
-                MessageSentLog.schedule_id == schedule.id,
-                MessageSentLog.sent_at >= today_start_utc
-            ).first()
+            lag = now_utc - occurrence_utc
+            if lag > self.catchup_window:
+                if self._claim_occurrence(schedule.id, occurrence_utc, now_utc, "skipped"):
+                    logger.warning(
+                        f"⏭️ Сообщение {schedule.id} пропущено: опоздание "
+                        f"{int(lag.total_seconds() // 60)} мин больше окна догоняющей отправки"
+                    )
+                return False
             
-            if existing_log:
-                logger.debug(f"Сообщение {schedule.id} уже отправлено сегодня в {existing_log.sent_at}")
+            # Растянутая отправка остается "sending", пока не дойдет до всех
+            status = "sending" if schedule.spread_minutes else "fired"
+            if not self._claim_occurrence(schedule.id, occurrence_utc, now_utc, status):
+                logger.debug(f"Срабатывание {occurrence_utc} сообщения {schedule.id} уже обработано")
                 return False
             
+            if lag > timedelta(minutes=5):
+                logger.info(
+                    f"⏪ Догоняющая отправка сообщения {schedule.id}: "
+                    f"опоздание {int(lag.total_seconds() // 60)} мин"
+                )
             return True
             
         except Exception as e:
             logger.error(f"Ошибка проверки отправки: {e}", exc_info=True)
             return False
+    
+    def _claim_occurrence(
+        self,
+        schedule_id: int,
+        occurrence_utc: datetime,
+        now_utc: datetime,
+        status: str
+    ) -> bool:
+        """Атомарно отметить срабатывание как обработанное
+
+        Возвращает True, только если запись обновила именно эта проверка:
+        одно и то же срабатывание не будет обработано дважды.
+        """
+        session = get_session()
+        try:
+            stmt = pg_insert(ScheduleFireLog).values(
+                schedule_id=schedule_id,
+                last_occurrence_at=occurrence_utc,
+                last_fired_at=now_utc,
+                status=status
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[ScheduleFireLog.schedule_id],
+                set_={
+                    "last_occurrence_at": stmt.excluded.last_occurrence_at,
+                    "last_fired_at": stmt.excluded.last_fired_at,
+                    "status": stmt.excluded.status,
+                },
+                where=ScheduleFireLog.last_occurrence_at < stmt.excluded.last_occurrence_at
+            ).returning(ScheduleFireLog.id)
+            
+            claimed = session.execute(stmt).first() is not None
+            session.commit()
+            return claimed
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Ошибка записи срабатывания расписания {schedule_id}: {e}")
+            return False
+        finally:
+            session.close()
+    
+    def _resume_occurrence(
+        self,
+        schedule: MessageSchedule,
+        fire_log: ScheduleFireLog,
+        current_utc: datetime
+    ) -> bool:
+        """Занять прерванную растянутую отправку, чтобы дослать ее оставшимся
+
+        Срабатывание занимается условным обновлением по last_fired_at, поэтому
+        досылает его только одна проверка. Если окно отправки и догоняющей
+        отправки уже прошло, срабатывание закрывается как частичное.
+        """
+        now_utc = current_utc.astimezone(pytz.UTC).replace(tzinfo=None)
+        deadline = (
+            fire_log.last_occurrence_at
+            + timedelta(minutes=schedule.spread_minutes or 0)
+            + self.catchup_window
+        )
+        status = "sending" if now_utc <= deadline else "partial"
+        
+        session = get_session()
+        try:
+            claimed = session.query(ScheduleFireLog).filter(
+                ScheduleFireLog.id == fire_log.id,
+                ScheduleFireLog.status == fire_log.status,
+                ScheduleFireLog.last_fired_at == fire_log.last_fired_at
+            ).update(
+                {"status": status, "last_fired_at": now_utc}, synchronize_session=False
+            ) == 1
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Ошибка занятия прерванной отправки {schedule.id}: {e}")
+            return False
+        finally:
+            session.close()
+        
+        if not claimed:
+            return False
+        if status == "partial":
+            logger.warning(
+                f"⏭️ Прерванная отправка сообщения {schedule.id} не дослана: "
+                f"окно отправки прошло"
+            )
+            return False
+        logger.info(f"⏯️ Досылаю прерванную отправку сообщения {schedule.id} ({fire_log.last_occurrence_at})")
+        return True
+    
+    def _set_fire_status(self, schedule_id: int, occurrence_utc: datetime, status: str):
+        """Закрыть срабатывание растянутой отправки (fired или interrupted)"""
+        session = get_session()
+        try:
+            session.query(ScheduleFireLog).filter(
+                ScheduleFireLog.schedule_id == schedule_id,
+                ScheduleFireLog.last_occurrence_at == occurrence_utc,
+                ScheduleFireLog.status == "sending"
+            ).update({"status": status}, synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Ошибка обновления срабатывания расписания {schedule_id}: {e}")
+        finally:
+            session.close()
+    
+    @staticmethod
+    def _log_entry(schedule_id: int, user_id: int, sent_time: datetime,
+                   error: Optional[Exception] = None) -> Dict[str, Any]:
+        # sent_at сравнивается с наивным UTC временем срабатывания
+        if sent_time.tzinfo is not None:
+            sent_time = sent_time.astimezone(pytz.UTC).replace(tzinfo=None)
+        if error is None:
+            return {"schedule_id": schedule_id, "user_id": user_id, "sent_at": sent_time, "status": "sent"}
+        return {
+            "schedule_id": schedule_id,
+            "user_id": user_id,
+            "sent_at": sent_time,
+            "status": "failed",
+            "error_message": str(error)[:500]
+        }
+    
+    def _save_sent_logs(self, entries: List[Dict[str, Any]]):
+        session = get_session()
+        try:
+            session.bulk_insert_mappings(MessageSentLog, entries)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Ошибка записи лога отправки: {e}")
+        finally:
+            session.close()
+    
+    def _was_sent_before_fire_log(self, schedule_id: int, occurrence_utc: datetime) -> bool:
+        """Проверить MessageSentLog для расписаний без записи о срабатывании"""
+        session = get_session()
+        try:
+            return session.query(MessageSentLog.id).filter(
+                MessageSentLog.schedule_id == schedule_id,
+                MessageSentLog.sent_at >= occurrence_utc - timedelta(minutes=5)
+            ).first() is not None
         finally:
             session.close()
     
@@ -187,17 +427,30 @@ class TimezoneMessageScheduler:
         self, 
         schedule: MessageSchedule, 
         org: Organization,
-        sent_time: datetime
+        sent_time: datetime,
+        occurrence_utc: datetime
     ) -> int:
-        """Отправить запланированное сообщение"""
+        """Отправить запланированное сообщение
+
+        Получатели, которым это срабатывание уже отправлялось (прерванная
+        отправка), пропускаются. Растянутая отправка пишет лог по каждому
+        получателю сразу, чтобы после сбоя ее можно было дослать остальным.
+        """
         session = get_session()
         sent_count = 0
         
         try:
+            already_sent = session.query(MessageSentLog.user_id).filter(
+                MessageSentLog.schedule_id == schedule.id,
+                MessageSentLog.sent_at >= occurrence_utc
+            )
+            
             # Получаем пользователей организации
             users = session.query(User).filter(
                 User.org_id == org.id,
-                User.chat_id.isnot(None)
+                User.chat_id.isnot(None),
+                reachable_filter(),
+                ~User.id.in_(already_sent)
             ).all()
             
             if not users:
@@ -206,49 +459,78 @@ class TimezoneMessageScheduler:
             
             logger.info(f"📤 Отправка сообщения '{schedule.title}' для организации {org.name} ({len(users)} пользователей)")
             
-            for user in users:
-                try:
-                    await self.bot.send_message(
-                        chat_id=user.chat_id,
-                        text=f"{schedule.title}\n\n{schedule.content}"
-                    )
-                    
-                    # Логируем отправку
-                    log_entry = MessageSentLog(
-                        schedule_id=schedule.id,
-                        user_id=user.id,
-                        sent_at=sent_time,
-                        status="sent"
+            dispatcher = get_message_dispatcher(self.bot)
+            text = f"{schedule.title}\n\n{schedule.content}"
+            media = media_for(schedule)
+            
+            # Окно растягивания: i-й получатель не раньше started + i * step
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            step = (schedule.spread_minutes or 0) * 60 / len(users)
+            positions = {user.id: i for i, user in enumerate(users)}
+            
+            async def deliver(user: User):
+                if media:
+                    return await media.send(
+                        dispatcher, user.chat_id, text,
+                        priority=Priority.SCHEDULED, org_id=org.id
                     )
-                    session.add(log_entry)
-                    
-                    sent_count += 1
-                    
-                    # Небольшая задержка, чтобы не превышать лимиты Telegram
-                    if sent_count % 20 == 0:
-                        await asyncio.sleep(1)
-                    elif sent_count % 5 == 0:
-                        await asyncio.sleep(0.2)
-                        
+                return await dispatcher.send_message(
+                    chat_id=user.chat_id,
+                    text=text,
+                    priority=Priority.SCHEDULED,
+                    org_id=org.id
+                )
+            
+            async def send(user: User):
+                delay = started + positions[user.id] * step - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if not step:
+                    return await deliver(user)
+                
+                try:
+                    result = await deliver(user)
                 except Exception as e:
-                    error_msg = str(e).lower()
-                    log_entry = MessageSentLog(
-                        schedule_id=schedule.id,
-                        user_id=user.id,
-                        sent_at=sent_time,
-                        status="failed",
-                        error_message=str(e)[:500]
+                    await asyncio.to_thread(
+                        self._save_sent_logs, [self._log_entry(schedule.id, user.id, sent_time, e)]
                     )
-                    session.add(log_entry)
-                    
-                    if "chat not found" in error_msg or "user is deactivated" in error_msg:
-                        logger.warning(f"Пользователь {user.user_id} недоступен (org: {org.id})")
-                    elif "bot was blocked" in error_msg:
-                        logger.warning(f"Бот заблокирован пользователем {user.user_id}")
-                    else:
-                        logger.warning(f"Ошибка отправки пользователю {user.user_id}: {e}")
+                    raise
+                await asyncio.to_thread(
+                    self._save_sent_logs, [self._log_entry(schedule.id, user.id, sent_time)]
+                )
+                return result
             
-            session.commit()
+            if step:
+                logger.info(f"🌊 Отправка '{schedule.title}' растянута на {schedule.spread_minutes} мин")
+            
+            results = await fan_out(users, send)
+            
+            if media and media.uploads and media.file_id:
+                # Следующие срабатывания расписания отправят уже file_id
+                save_file_id(MessageSchedule, schedule.id, media.file_id)
+            
+            # Логируем все отправки одной пачкой (растянутая уже записала свои)
+            log_entries = []
+            for result in results:
+                user = result.item
+                log_entries.append(self._log_entry(schedule.id, user.id, sent_time, result.error))
+                if result.ok:
+                    sent_count += 1
+                    continue
+                
+                error = classify_error(result.error)
+                
+                if error.reason in (REASON_CHAT_NOT_FOUND, REASON_DEACTIVATED):
+                    logger.warning(f"Пользователь {user.user_id} недоступен (org: {org.id})")
+                elif error.reason == REASON_BLOCKED:
+                    logger.warning(f"Бот заблокирован пользователем {user.user_id}")
+                else:
+                    logger.warning(f"Ошибка отправки пользователю {user.user_id}: {result.error}")
+            
+            if not step:
+                session.bulk_insert_mappings(MessageSentLog, log_entries)
+                session.commit()
             return sent_count
             
         except Exception as e:
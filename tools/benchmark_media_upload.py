@@ -0,0 +1,85 @@
+"""Сколько байт уходит в Telegram при рассылке фото на 500 получателей
+
+Сравнивает наивную отправку (файл загружается каждому получателю) и
+UploadOnceMedia (файл загружается один раз, дальше отправляется file_id).
+Вместо Telegram используется фейковый бот, который считает загруженные
+байты, поэтому скрипт не требует токена и сети.
+
+Запуск из корня проекта:
+    python tools/benchmark_media_upload.py [--recipients 500] [--size-kb 300]
+"""
+import argparse
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram.types import BufferedInputFile, InputFile  # noqa: E402
+
+from services.fanout import fan_out  # noqa: E402
+from services.media_delivery import MEDIA_PHOTO, UploadOnceMedia  # noqa: E402
+from services.message_dispatcher import MessageDispatcher, Priority  # noqa: E402
+
+
+class CountingBot:
+    """Фейковый бот: считает байты загрузок и отвечает как Telegram"""
+
+    def __init__(self):
+        self.bytes_uploaded = 0
+        self.uploads = 0
+        self.requests = 0
+
+    async def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        self.requests += 1
+        if isinstance(photo, InputFile):
+            self.uploads += 1
+            self.bytes_uploaded += len(photo.data)
+        await asyncio.sleep(0.001)
+        return SimpleNamespace(photo=[SimpleNamespace(file_id="AgACAgIAAxkBAAI-benchmark")], document=None)
+
+
+async def run(recipients: int, size: int, naive: bool):
+    bot = CountingBot()
+    dispatcher = MessageDispatcher(bot, rate_per_second=10000, per_chat_interval=0)
+    dispatcher.start()
+
+    data = os.urandom(size)
+    media = UploadOnceMedia(MEDIA_PHOTO, source=BufferedInputFile(data, filename="report.png"))
+
+    async def send(chat_id: int):
+        if naive:
+            photo = BufferedInputFile(data, filename="report.png")
+            return await dispatcher.call("send_photo", chat_id, Priority.BULK, photo=photo, caption="Отчет")
+        return await media.send(dispatcher, chat_id, "Отчет", priority=Priority.BULK)
+
+    results = await fan_out(range(recipients), send, concurrency=30)
+    await dispatcher.stop()
+
+    return {
+        "sent": sum(result.ok for result in results),
+        "uploads": bot.uploads,
+        "bytes": bot.bytes_uploaded,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--recipients", type=int, default=500)
+    parser.add_argument("--size-kb", type=int, default=300)
+    args = parser.parse_args()
+
+    size = args.size_kb * 1024
+    print(f"Рассылка фото {args.size_kb} КБ на {args.recipients} получателей\n")
+
+    for title, naive in (("Загрузка каждому", True), ("Загрузка один раз", False)):
+        stats = asyncio.run(run(args.recipients, size, naive))
+        print(
+            f"{title:<20} отправлено={stats['sent']:<5} загрузок={stats['uploads']:<5} "
+            f"байт={stats['bytes']:>12,}  ({stats['bytes'] / 1024 / 1024:.1f} МБ)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Сколько пользователь ждет результатов AI-опроса после последнего ответа
+
+Замеряет то же, что делает finish_ai_full_survey: подбор вопросов по
+метрикам и оценку ответов score_answers_with_ai. Сравниваются три режима:
+последовательная оценка по одной метрике (как было), параллельная оценка
+по метрикам и пакетная оценка всех метрик одним JSON-запросом. Вместо
+модели используется локальная заглушка с заданной задержкой ответа,
+поэтому скрипт не требует ключа и сети. С --base-url запросы идут через
+настоящий клиент к OpenAI-совместимому серверу, например к заглушке
+tools/stub_llm_server.py (задержку тогда задает сервер).
+
+Запуск из корня проекта:
+    python tools/benchmark_survey_scoring.py [--latency 2.0] [--broken-metrics 0]
+    python tools/benchmark_survey_scoring.py --base-url http://127.0.0.1:8089/v1
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+from types import SimpleNamespace
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.hf_service import close_ai_client  # noqa: E402
+from services.metrics_analyzer import ProffKonstaltingMetrics  # noqa: E402
+
+
+class StubLLM:
+    """Заглушка chat.completions: отвечает через latency секунд
+
+    На пакетный запрос возвращает JSON с баллами по всем метрикам из
+    промпта (кроме первых broken_metrics - для них балл вне шкалы), на
+    запрос по одной метрике - цифру балла.
+    """
+
+    def __init__(self, latency: float, broken_metrics: int = 0):
+        self.latency = latency
+        self.broken_metrics = broken_metrics
+        self.requests = 0
+        self.chat = SimpleNamespace(completions=self)
+
+    async def create(self, messages, **kwargs):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+
+        prompt = messages[-1]["content"]
+        metric_keys = re.findall(r'МЕТРИКА "(\w+)"', prompt)
+        if metric_keys:
+            scores = {
+                key: 99 if index < self.broken_metrics else 2
+                for index, key in enumerate(metric_keys)
+            }
+            content = json.dumps({"scores": scores})
+        else:
+            content = "2"
+
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(total_tokens=200)
+        )
+
+
+def survey_context():
+    """Контекст пользователя, ответившего на базовые вопросы опроса"""
+    analyzer = ProffKonstaltingMetrics()
+    answers = [
+        {"question": question, "answer": "Стараюсь помогать команде и учиться на ошибках"}
+        for questions in analyzer.survey_questions.values()
+        for question in questions[:2]
+    ]
+    return {"profile": {"name": "Тест"}, "answers": answers, "has_history": False}
+
+
+def server_requests(base_url: str) -> int:
+    """Сколько запросов принял сервер-заглушка"""
+    return httpx.get(f"{base_url}/stub/stats").json()["requests"]
+
+
+async def run(mode: str, latency: float, broken_metrics: int, base_url: str = None):
+    analyzer = ProffKonstaltingMetrics()
+    if base_url:
+        requests_before = server_requests(base_url)
+    else:
+        stub = StubLLM(latency, broken_metrics)
+        # Заглушка вместо AI API; ключ не нужен
+        analyzer.ai_service.is_active = True
+        analyzer.ai_service.client = stub
+        analyzer.ai_service.hf_service.is_active = True
+        analyzer.ai_service.hf_service.client = stub
+
+    user_context = survey_context()
+    started = time.perf_counter()
+
+    ai_questions = await analyzer.generate_ai_questions_based_on_answers(user_context)
+    answers = user_context["answers"]
+    if mode == "sequential":
+        scores = {}
+        for metric_key, questions in ai_questions.items():
+            scores[metric_key] = await analyzer._score_metric(metric_key, questions, answers) or 1
+    else:
+        scores = await analyzer.score_answers_with_ai(answers, ai_questions, batched=(mode == "batched"))
+
+    seconds = time.perf_counter() - started
+    if base_url:
+        # Клиент привязан к event loop этого прогона
+        await close_ai_client()
+        requests = server_requests(base_url) - requests_before
+    else:
+        requests = stub.requests
+    return {
+        "seconds": seconds,
+        "requests": requests,
+        "metrics": len(scores),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=2.0, help="Задержка ответа модели, с")
+    parser.add_argument("--broken-metrics", type=int, default=0,
+                        help="Сколько метрик пакетный ответ оценит некорректно")
+    parser.add_argument("--base-url", help="OpenAI-совместимый сервер вместо встроенной заглушки")
+    args = parser.parse_args()
+
+    if args.base_url:
+        os.environ["AI_BASE_URL"] = args.base_url
+        os.environ.setdefault("HUGGINGFACE_API_KEY", "stub")
+        print(f"AI-опрос, модель на {args.base_url}\n")
+    else:
+        print(f"AI-опрос, задержка модели {args.latency:.1f} с\n")
+    for title, mode in (("По одной метрике", "sequential"),
+                        ("Параллельно", "per_metric"),
+                        ("Одним запросом", "batched")):
+        stats = asyncio.run(run(mode, args.latency, args.broken_metrics, args.base_url))
+        print(
+            f"{title:<18} метрик={stats['metrics']:<3} запросов={stats['requests']:<3} "
+            f"время={stats['seconds']:.1f} с"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+"""Локальная OpenAI-совместимая заглушка модели для нагрузочных тестов
+
+Реализует ту часть /v1/chat/completions, которой пользуется
+HuggingFaceService: обычные и потоковые (stream=True, SSE) ответы,
+response_format json_object и usage. Задержка ответа берется из
+заданного распределения, часть запросов можно завершать ошибкой или 429
+с Retry-After, а ответы подбираются по регулярным выражениям из файла
+(--responses) или из встроенных шаблонов под промпты бота. С --seed
+задержки и ошибки воспроизводимы от запуска к запуску.
+
+Запуск из корня проекта:
+    python tools/stub_llm_server.py [--port 8089] [--latency lognormal:0:0.5]
+        [--error-rate 0.05] [--rate-limit-rate 0.02] [--responses responses.json]
+
+Бот и бенчмарки направляются на заглушку переменными окружения:
+    AI_BASE_URL=http://127.0.0.1:8089/v1 HUGGINGFACE_API_KEY=stub
+
+Файл ответов - JSON-список правил, первое совпавшее срабатывает:
+    [{"pattern": "МЕТРИКА", "response": {"scores": {"leadership": 3}}},
+     {"pattern": "мотивац", "response": "Вперед! 💪", "latency": 0.1},
+     {"pattern": "сломай", "status": 503}]
+
+Счетчики запросов: GET /v1/stub/stats
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+from aiohttp import web
+
+DEFAULT_TEXT = (
+    "Это ответ локальной заглушки модели. Он нужен, чтобы проверить задержки, "
+    "очередь запросов и отображение ответа без обращения к настоящему AI API. "
+    "Регулярность важнее интенсивности: делайте небольшие шаги каждый день, "
+    "отмечайте прогресс и не забывайте про отдых."
+)
+
+
+def parse_latency(spec: str, rng: random.Random) -> Callable[[], float]:
+    """Распределение задержки: 0.5, uniform:0.2:1.5, normal:1:0.3, lognormal:0:0.5, exp:0.8"""
+    kind, _, params = spec.partition(":")
+    if not params:
+        value = float(kind)
+        return lambda: value
+
+    args = [float(value) for value in params.split(":")]
+    distributions = {
+        "uniform": lambda: rng.uniform(args[0], args[1]),
+        "normal": lambda: rng.gauss(args[0], args[1]),
+        "lognormal": lambda: rng.lognormvariate(args[0], args[1]),
+        "exp": lambda: rng.expovariate(1 / args[0]),
+    }
+    if kind not in distributions:
+        raise argparse.ArgumentTypeError(f"Неизвестное распределение задержки: {kind}")
+    sample = distributions[kind]
+    return lambda: max(sample(), 0.0)
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / 3)
+
+
+def builtin_response(prompt: str, json_mode: bool) -> Any:
+    """Ответ под промпты бота, если в файле ответов ничего не совпало"""
+    metric_keys = re.findall(r'МЕТРИКА "(\w+)"', prompt)
+    if metric_keys:
+        return {"scores": {key: 2 for key in metric_keys}}
+    if "ВЕРНИ ТОЛЬКО ЦИФРУ" in prompt:
+        return "2"
+    if '"phrases"' in prompt:
+        count_match = re.search(r"Создай (\d+)", prompt)
+        count = int(count_match.group(1)) if count_match else 5
+        return {"phrases": [f"Каждый шаг приближает к цели, фраза {number} 💪" for number in range(1, count + 1)]}
+    if '"why_this_challenge"' in prompt:
+        return {
+            "text": "Сделайте 3 подхода по 20 приседаний и запишите самочувствие после каждого.",
+            "points": 10,
+            "difficulty": "easy",
+            "estimated_time": "15 минут",
+            "required_resources": [],
+            "success_criteria": ["Выполнены все подходы"],
+            "why_this_challenge": "Подходит для поддержания формы",
+            "success_tips": ["Разомнитесь", "Следите за дыханием"],
+            "related_skills": ["выносливость"],
+        }
+    if json_mode:
+        return {"text": DEFAULT_TEXT}
+    return DEFAULT_TEXT
+
+
+class StubLLMServer:
+    """Обработчик /v1/chat/completions с настраиваемыми задержками и сбоями"""
+
+    def __init__(self, latency: Callable[[], float], token_interval: float = 0.02,
+                 error_rate: float = 0.0, error_status: int = 500,
+                 rate_limit_rate: float = 0.0, retry_after: float = 5.0,
+                 rules: Optional[List[Dict[str, Any]]] = None, seed: Optional[int] = None):
+        self.latency = latency
+        self.token_interval = token_interval
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.rules = [
+            {**rule, "regex": re.compile(rule.get("pattern", ""), re.DOTALL | re.IGNORECASE)}
+            for rule in rules or []
+        ]
+        self.rng = random.Random(seed)
+        self.stats = {"requests": 0, "streamed": 0, "errors": 0, "rate_limited": 0, "in_flight": 0}
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_get("/v1/models", self.models)
+        app.router.add_get("/v1/stub/stats", self.get_stats)
+        return app
+
+    async def models(self, request: web.Request) -> web.Response:
+        return web.json_response({"object": "list", "data": [{"id": "stub", "object": "model"}]})
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.stats["requests"] += 1
+        self.stats["in_flight"] += 1
+        try:
+            return await self._complete(request, body)
+        finally:
+            self.stats["in_flight"] -= 1
+
+    async def _complete(self, request: web.Request, body: Dict[str, Any]) -> web.StreamResponse:
+        prompt = "\n".join(
+            str(message.get("content", "")) for message in body.get("messages", [])
+        )
+        json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+        rule = next((rule for rule in self.rules if rule["regex"].search(prompt)), None)
+
+        # Ошибки отдаются после задержки, как у перегруженного бэкенда
+        latency = rule.get("latency", self.latency()) if rule else self.latency()
+        if rule and rule.get("status"):
+            await asyncio.sleep(latency)
+            return self._error(rule["status"])
+        roll = self.rng.random()
+        if roll < self.rate_limit_rate:
+            return self._error(429)
+        if roll < self.rate_limit_rate + self.error_rate:
+            await asyncio.sleep(latency)
+            return self._error(self.error_status)
+
+        content = rule["response"] if rule and "response" in rule else builtin_response(prompt, json_mode)
+        if not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False)
+
+        usage = {
+            "prompt_tokens": estimate_tokens(prompt),
+            "completion_tokens": estimate_tokens(content),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        model = body.get("model", "stub")
+
+        chunks = re.findall(r"\S+\s*", content) or [content]
+        if body.get("stream"):
+            self.stats["streamed"] += 1
+            include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+            return await self._stream(request, completion_id, model, chunks, latency,
+                                      usage if include_usage else None)
+
+        await asyncio.sleep(latency + self.token_interval * len(chunks))
+        return web.json_response({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": usage,
+        })
+
+    async def _stream(self, request: web.Request, completion_id: str, model: str,
+                      chunks: List[str], latency: float,
+                      usage: Optional[Dict[str, int]]) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+
+        def event(choices: List[Dict[str, Any]], **extra) -> bytes:
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": choices,
+                **extra,
+            }
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode()
+
+        # Задержка - время до первого токена, дальше токены идут с интервалом
+        await asyncio.sleep(latency)
+        await response.write(event([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]))
+        for chunk in chunks:
+            await response.write(event([{"index": 0, "delta": {"content": chunk}, "finish_reason": None}]))
+            await asyncio.sleep(self.token_interval)
+        await response.write(event([{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if usage:
+            await response.write(event([], usage=usage))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def _error(self, status: int) -> web.Response:
+        headers = {}
+        if status == 429:
+            headers["Retry-After"] = f"{self.retry_after:g}"
+            self.stats["rate_limited"] += 1
+        else:
+            self.stats["errors"] += 1
+        return web.json_response(
+            {"error": {"message": f"Заглушка вернула ошибку {status}", "type": "stub_error", "code": status}},
+            status=status,
+            headers=headers
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", default="0.5",
+                        help="Задержка ответа (до первого токена), с: 0.5, uniform:0.2:1.5, "
+                             "normal:1:0.3, lognormal:0:0.5, exp:0.8")
+    parser.add_argument("--token-interval", type=float, default=0.02,
+                        help="Интервал между частями потокового ответа, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля запросов, завершаемых ошибкой")
+    parser.add_argument("--error-status", type=int, default=500, help="Код ошибки (500, 503, 402...)")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Доля запросов, получающих 429")
+    parser.add_argument("--retry-after", type=float, default=5.0, help="Retry-After для 429, с")
+    parser.add_argument("--responses", help="JSON-файл с правилами ответов по шаблонам промпта")
+    parser.add_argument("--seed", type=int, help="Зерно генератора для воспроизводимых задержек и ошибок")
+    args = parser.parse_args()
+
+    rules = []
+    if args.responses:
+        with open(args.responses, encoding="utf-8") as file:
+            rules = json.load(file)
+
+    rng = random.Random(args.seed)
+    server = StubLLMServer(
+        latency=parse_latency(args.latency, rng),
+        token_interval=args.token_interval,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        rules=rules,
+        seed=args.seed
+    )
+    print(f"Заглушка модели: AI_BASE_URL=http://{args.host}:{args.port}/v1")
+    web.run_app(server.make_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()